@@ -0,0 +1,297 @@
+"""\
+Build and search a local index of NYC addresses from PLUTO, so that
+most addresses can be geocoded without a network request.
+
+Usage:
+  address_index.py build <file>
+  address_index.py search <file> <address>
+
+Options:
+  -h --help                 Show this screen.
+
+Environment variables:
+  DATABASE_URL              The Postgres URL to the NYC-DB instance.
+
+Once the index is built, set ADDRESS_INDEX to its path to have
+geocoding.search() consult it before the remote geocoder.
+"""
+
+import os
+import re
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+import docopt
+import dotenv
+
+import fun
+import profiling
+from sorted_index import SortedIndex, write_sorted_index
+
+
+# Fetches every address in PLUTO. Its borough is the first digit of
+# its BBL, so we don't need PLUTO's borough column.
+PLUTO_ADDRESSES_SQL = """
+SELECT bbl, address, zipcode FROM pluto_18v1 WHERE address IS NOT NULL
+"""
+
+BOROUGH_NAMES = {
+    1: 'Manhattan',
+    2: 'Bronx',
+    3: 'Brooklyn',
+    4: 'Queens',
+    5: 'Staten Island',
+}
+
+BOROUGHS_BY_NAME = {name.upper(): code for code, name in BOROUGH_NAMES.items()}
+
+# Words at the end of a search that don't narrow it down any further.
+IGNORED_TRAILING_WORDS = {'NY', 'NYC', 'USA', 'US'}
+
+STREET_SUFFIXES = {
+    'ALLEY': 'ALY',
+    'AV': 'AVE',
+    'AVENUE': 'AVE',
+    'BOULEVARD': 'BLVD',
+    'CIRCLE': 'CIR',
+    'COURT': 'CT',
+    'CRESCENT': 'CRES',
+    'DRIVE': 'DR',
+    'EXPRESSWAY': 'EXPY',
+    'EXTENSION': 'EXT',
+    'HIGHWAY': 'HWY',
+    'LANE': 'LN',
+    'PARKWAY': 'PKWY',
+    'PLACE': 'PL',
+    'PLAZA': 'PLZ',
+    'ROAD': 'RD',
+    'SQUARE': 'SQ',
+    'STREET': 'ST',
+    'TERRACE': 'TER',
+    'TURNPIKE': 'TPKE',
+}
+
+DIRECTIONS = {
+    'EAST': 'E',
+    'WEST': 'W',
+    'NORTH': 'N',
+    'SOUTH': 'S',
+}
+
+ORDINAL_WORDS = {
+    word: str(i) for i, word in enumerate([
+        'FIRST', 'SECOND', 'THIRD', 'FOURTH', 'FIFTH', 'SIXTH', 'SEVENTH',
+        'EIGHTH', 'NINTH', 'TENTH', 'ELEVENTH', 'TWELFTH', 'THIRTEENTH',
+        'FOURTEENTH', 'FIFTEENTH', 'SIXTEENTH', 'SEVENTEENTH', 'EIGHTEENTH',
+        'NINETEENTH', 'TWENTIETH',
+    ], start=1)
+}
+
+ORDINAL_RE = re.compile(r'^(\d+)(?:ST|ND|RD|TH)$')
+
+NON_ADDRESS_CHARS_RE = re.compile(r'[^A-Z0-9\- ]+')
+
+ZIPCODE_RE = re.compile(r'^\d{5}$')
+
+# The most keys to look at when an address only matches as a prefix.
+MAX_PREFIX_MATCHES = 20
+
+# Values in the index pack a BBL and a ZIP code (or 0) into one integer.
+ZIPCODE_FACTOR = 100_000
+
+
+def normalize_word(word: str) -> str:
+    word = STREET_SUFFIXES.get(word) or DIRECTIONS.get(word) or ORDINAL_WORDS.get(word) or word
+    match = ORDINAL_RE.match(word)
+    return match.group(1) if match else word
+
+
+def split_words(text: str) -> List[str]:
+    return [
+        word.strip('-')
+        for word in NON_ADDRESS_CHARS_RE.sub(' ', text.upper()).split()
+        if word.strip('-')
+    ]
+
+
+def normalize_address(text: str) -> str:
+    '''
+    Normalizes the given street address, e.g. "666 Fifth Avenue" and
+    PLUTO's "666 5 AVENUE" both become "666 5 AVE".
+    '''
+
+    return ' '.join(normalize_word(word) for word in split_words(text))
+
+
+class AddressQuery(NamedTuple):
+    address: str
+    borough: Optional[int]
+    zipcode: Optional[int]
+
+
+def parse_query(text: str) -> AddressQuery:
+    '''
+    Splits a search like "666 Fifth Avenue, Manhattan, NY 10103" into
+    its normalized street address, borough and ZIP code.
+    '''
+
+    words = split_words(text)
+    borough: Optional[int] = None
+    zipcode: Optional[int] = None
+    while len(words) > 2:
+        last = words[-1]
+        last_two = ' '.join(words[-2:])
+        if zipcode is None and ZIPCODE_RE.match(last):
+            zipcode = int(last)
+            words.pop()
+        elif last in IGNORED_TRAILING_WORDS:
+            words.pop()
+        elif last_two == 'NEW YORK':
+            del words[-2:]
+        elif borough is None and last_two in BOROUGHS_BY_NAME:
+            borough = BOROUGHS_BY_NAME[last_two]
+            del words[-2:]
+        elif borough is None and last in BOROUGHS_BY_NAME:
+            borough = BOROUGHS_BY_NAME[last]
+            words.pop()
+            if words[-1] == 'THE':
+                words.pop()
+        else:
+            break
+    return AddressQuery(' '.join(normalize_word(word) for word in words), borough, zipcode)
+
+
+def pack_value(bbl: str, zipcode: Optional[int]) -> int:
+    return int(bbl) * ZIPCODE_FACTOR + (zipcode or 0)
+
+
+def unpack_value(value: int) -> Tuple[str, Optional[int]]:
+    bbl, zipcode = divmod(value, ZIPCODE_FACTOR)
+    return f"{bbl:010d}", zipcode or None
+
+
+def parse_zipcode(value: Any) -> Optional[int]:
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def make_feature_json(address: str, bbl: str, zipcode: Optional[int]) -> Dict[str, Any]:
+    '''
+    Returns a feature shaped like the ones the remote geocoder
+    returns. We don't know the address' coordinates, so its geometry
+    is None, which is how callers can tell it came from the index.
+    '''
+
+    borough_code = int(bbl[0])
+    borough = BOROUGH_NAMES[borough_code]
+    return {
+        'type': 'Feature',
+        'geometry': None,
+        'properties': {
+            'postalcode': f"{zipcode:05d}" if zipcode else '',
+            'name': address,
+            'region': 'New York State',
+            'locality': 'New York',
+            'borough': borough,
+            'borough_gid': f"whosonfirst:borough:{borough_code}",
+            'label': f"{address}, {borough}, New York, NY, USA",
+            'pad_bbl': bbl,
+        },
+    }
+
+
+class AddressMatch(NamedTuple):
+    address: str
+    bbl: str
+    zipcode: Optional[int]
+
+
+class AddressIndex:
+    '''
+    A memory-mapped index from normalized addresses to the BBLs and
+    ZIP codes at them.
+    '''
+
+    def __init__(self, path: Path):
+        self.index = SortedIndex(path)
+
+    def _filter(self, query: AddressQuery,
+                entries: Iterable[Tuple[str, List[int]]]) -> List[AddressMatch]:
+        matches = []
+        for address, values in entries:
+            for value in values:
+                match = AddressMatch(address, *unpack_value(value))
+                if ((query.borough is None or int(match.bbl[0]) == query.borough) and
+                        (query.zipcode is None or match.zipcode == query.zipcode)):
+                    matches.append(match)
+        return matches
+
+    def find(self, text: str) -> List[AddressMatch]:
+        '''
+        Returns everything at the given address, or if there's nothing
+        there, everything at addresses that start with all of its words,
+        e.g. "1 W 42" matches "1 W 42 ST" but "45 E 1 ST" doesn't
+        match "45 E 10 ST".
+        '''
+
+        query = parse_query(text)
+        matches = self._filter(query, [(query.address, self.index.get(query.address))])
+        if not matches and len(query.address.split()) > 1:
+            matches = self._filter(query, self.index.search_prefix(query.address + ' ',
+                                                                   MAX_PREFIX_MATCHES))
+        return matches
+
+    @profiling.profiled('address_index.search')
+    def search_json(self, text: str) -> Optional[List[Dict[str, Any]]]:
+        '''
+        Returns a feature for the given search if it matches exactly
+        one BBL, or None if it matches none or several (e.g. "100
+        Broadway" without a borough).
+        '''
+
+        matches = self.find(text)
+        if len({match.bbl for match in matches}) != 1:
+            return None
+        return [make_feature_json(*matches[0])]
+
+    def close(self) -> None:
+        self.index.close()
+
+
+def build_address_index(conn, path: Path) -> int:
+    '''
+    Builds an address index at the given path from PLUTO, returning
+    the number of distinct addresses in it.
+    '''
+
+    entries: Dict[str, Set[int]] = {}
+    for row in fun.friendly_iter(conn, PLUTO_ADDRESSES_SQL, name='PlutoAddress'):
+        address = normalize_address(row.address)
+        if address:
+            entries.setdefault(address, set()).add(
+                pack_value(row.bbl, parse_zipcode(row.zipcode)))
+    write_sorted_index(path, entries)
+    return len(entries)
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    dotenv.load_dotenv()
+
+    path = Path(args['<file>'])
+    if args['build']:
+        nycdb = profiling.connect(os.environ['DATABASE_URL'])
+        count = build_address_index(nycdb, path)
+        print(f"Indexed {count:,} addresses.")
+    elif args['search']:
+        features = AddressIndex(path).search_json(args['<address>'])
+        if features is None:
+            print("No single match.")
+        else:
+            print(json.dumps(features[0]['properties'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
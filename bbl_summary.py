@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import datetime
+import threading
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Sequence
+
+from dbhash import AbstractDbHash, SqlDbHash
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_object(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if '$decimal' in obj:
+            return Decimal(obj['$decimal'])
+        if '$datetime' in obj:
+            return datetime.datetime.fromisoformat(obj['$datetime'])
+        if '$date' in obj:
+            return datetime.date.fromisoformat(obj['$date'])
+    return obj
+
+
+def dumps(data: Any) -> str:
+    '''
+    Like json.dumps(), but preserves Decimal and date values, which
+    is what psycopg2 gives us for numeric and date columns.
+    '''
+
+    return json.dumps(data, default=_encode_value, separators=(',', ':'))
+
+
+def loads(raw: str) -> Any:
+    return json.loads(raw, object_hook=_decode_object)
+
+
+GENERATION_PREFIX = 'generation:'
+
+
+def invalidate_datasets(dbhash: AbstractDbHash, datasets: Iterable[str]) -> None:
+    '''
+    Marks every summary that was built from any of the given NYC-DB
+    datasets as stale, by bumping the datasets' generation counters.
+    '''
+
+    keys = [f'{GENERATION_PREFIX}{dataset}' for dataset in sorted(set(datasets))]
+    if not keys:
+        return
+    with dbhash.transaction():
+        current = dbhash.get_many(keys)
+        dbhash.set_many((key, str(int(current.get(key, '0')) + 1)) for key in keys)
+
+
+class BBLSummaryStore:
+    '''
+    A store of precomputed, JSON-serializable summaries keyed by BBL,
+    kept in the given AbstractDbHash.
+
+    Each summary is stamped with the generations of the NYC-DB
+    datasets it was built from. Invalidating a dataset bumps its
+    generation, which makes every summary built from it stale
+    without having to touch the summaries themselves.
+    '''
+
+    SUMMARY_PREFIX = 'summary:'
+
+    def __init__(self, dbhash: AbstractDbHash, datasets: Sequence[str]):
+        self.dbhash = dbhash
+        self.datasets = sorted(datasets)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def _generation_keys(self) -> List[str]:
+        return [f'{GENERATION_PREFIX}{dataset}' for dataset in self.datasets]
+
+    def _stamp(self, values: Dict[str, str]) -> str:
+        return ','.join(values.get(key, '0') for key in self._generation_keys) + '\n'
+
+    def _get_many(self, bbls: List[str]) -> Dict[str, Any]:
+        keys = [f'{self.SUMMARY_PREFIX}{bbl}' for bbl in bbls]
+        values = self.dbhash.get_many(keys + self._generation_keys)
+        stamp = self._stamp(values)
+        summaries: Dict[str, Any] = {}
+        for bbl, key in zip(bbls, keys):
+            raw = values.get(key)
+            if raw is not None and raw.startswith(stamp):
+                summaries[bbl] = raw[len(stamp):]
+        return summaries
+
+    def get(self, bbl: str) -> Any:
+        '''
+        Returns the given BBL's summary, or None if it hasn't been
+        built or is stale.
+        '''
+
+        with self._lock:
+            raw = self._get_many([bbl]).get(bbl)
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return loads(raw)
+
+    def stale_bbls(self, bbls: Iterable[str]) -> List[str]:
+        '''
+        Returns the given BBLs whose summaries are missing or stale.
+        '''
+
+        bbls = list(bbls)
+        with self._lock:
+            fresh = self._get_many(bbls)
+        return [bbl for bbl in bbls if bbl not in fresh]
+
+    def put(self, bbl: str, summary: Any) -> None:
+        self.put_many({bbl: summary})
+
+    def put_many(self, summaries: Dict[str, Any]) -> None:
+        '''
+        Stores the given summaries, stamped with the current
+        generations of our datasets, in a single transaction.
+        '''
+
+        with self._lock, self.dbhash.transaction():
+            stamp = self._stamp(self.dbhash.get_many(self._generation_keys))
+            self.dbhash.set_many(
+                (f'{self.SUMMARY_PREFIX}{bbl}', stamp + dumps(summary))
+                for bbl, summary in summaries.items()
+            )
+
+    def invalidate(self, datasets: Iterable[str]) -> None:
+        with self._lock:
+            invalidate_datasets(self.dbhash, datasets)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def open_dbhash(path: str) -> SqlDbHash:
+    return SqlDbHash(sqlite3.connect(path, check_same_thread=False), 'bbl_summary')
+
+
+def open_store(path: str, datasets: Sequence[str]) -> BBLSummaryStore:
+    '''
+    Opens a summary store kept in the SQLite database at the given
+    path. The store can be shared between threads.
+    '''
+
+    return BBLSummaryStore(open_dbhash(path), datasets)
@@ -0,0 +1,608 @@
+"""\
+Benchmark various parts of this project.
+
+Usage:
+  benchmark.py dbhash [--keys=<n>]
+  benchmark.py rows [--rows=<n>] [--calls=<n>]
+  benchmark.py suite [--sizes=<sizes>] [--repeat=<n>] [--output=<file>]
+                     [--baseline=<file>] [--threshold=<pct>] [--save-baseline]
+  benchmark.py startup [--budget=<ms>] [--repeat=<n>]
+
+Options:
+  -h --help                 Show this screen.
+  --keys=<n>                Number of keys to benchmark with [default: 10000].
+  --rows=<n>                Number of rows in large result sets [default: 100000].
+  --calls=<n>               Number of small result sets to fetch [default: 10000].
+  --sizes=<sizes>           Comma-separated numbers of keys to benchmark
+                            dbhash implementations with
+                            [default: 1000,100000,1000000].
+  --repeat=<n>              Run the suite this many times and keep the
+                            fastest time of each benchmark [default: 3].
+  --output=<file>           Write the suite's results to the given file
+                            as JSON.
+  --baseline=<file>         The JSON results to compare the suite's
+                            results against [default: benchmark_baseline.json].
+  --threshold=<pct>         How many percent slower than the baseline a
+                            benchmark can be before it's considered a
+                            regression [default: 20].
+  --save-baseline           Save the suite's results as the new baseline.
+  --budget=<ms>             How many milliseconds each entry point's
+                            "--help" may take before startup is
+                            considered too slow [default: 250].
+"""
+
+import io
+import sys
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import subprocess
+import platform
+import contextlib
+from collections import namedtuple
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import docopt
+
+import dbhash
+import fun
+import lastmod
+import introspect_schema
+from introspect_schema import ColumnMeta, DataType, DatasetMeta, TableMeta
+
+
+MY_DIR = Path(__file__).parent.resolve()
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    seconds: float
+    ops: int
+
+    @property
+    def ops_per_sec(self) -> float:
+        return self.ops / self.seconds if self.seconds else float('inf')
+
+
+def timed(name: str, ops: int, fn: Callable[[], Any]) -> BenchmarkResult:
+    start = time.perf_counter()
+    fn()
+    return BenchmarkResult(name, time.perf_counter() - start, ops)
+
+
+class DbHashFactory(NamedTuple):
+    name: str
+
+    # Creates a new (or reopens an existing) dbhash in the given directory.
+    open: Callable[[Path], dbhash.AbstractDbHash]
+
+    close: Callable[[dbhash.AbstractDbHash], None]
+
+
+def _close_sql(dbh: dbhash.AbstractDbHash) -> None:
+    assert isinstance(dbh, dbhash.SqlDbHash)
+    dbh.conn.close()
+
+
+def _close_log(dbh: dbhash.AbstractDbHash) -> None:
+    assert isinstance(dbh, dbhash.LogDbHash)
+    dbh.close()
+
+
+# The contents of every DictDbHash created by the benchmarks, keyed
+# by their directory, so that they can be "reopened". Entries only
+# live as long as the directory from dbhash_dir() does.
+_dict_dbhash_storage: Dict[Path, Dict[str, str]] = {}
+
+
+@contextlib.contextmanager
+def dbhash_dir() -> Iterator[Path]:
+    '''
+    Yields a temporary directory to benchmark a dbhash in, discarding
+    the dbhash's contents (wherever they're stored) afterwards.
+    '''
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir)
+        try:
+            yield path
+        finally:
+            _dict_dbhash_storage.pop(path, None)
+
+DBHASH_FACTORIES = [
+    DbHashFactory(
+        'DictDbHash',
+        lambda path: dbhash.DictDbHash(_dict_dbhash_storage.setdefault(path, {})),
+        lambda dbh: None
+    ),
+    DbHashFactory(
+        'SqlDbHash',
+        lambda path: dbhash.SqlDbHash(sqlite3.connect(str(path / 'sql.db')), 'bench'),
+        _close_sql
+    ),
+    DbHashFactory(
+        'LogDbHash',
+        lambda path: dbhash.LogDbHash(path / 'log'),
+        _close_log
+    ),
+]
+
+
+def benchmark_dbhash(factory: DbHashFactory, path: Path, num_keys: int) -> List[BenchmarkResult]:
+    keys = [f'key:{i}' for i in range(num_keys)]
+    results: List[BenchmarkResult] = []
+    dbh = factory.open(path)
+
+    def set_all():
+        for key in keys:
+            dbh[key] = f'value for {key}'
+
+    def get_all():
+        for key in keys:
+            dbh.get(key)
+
+    def set_all_in_transaction():
+        with dbh.transaction():
+            dbh.set_many((key, f'new value for {key}') for key in keys)
+
+    def reopen():
+        nonlocal dbh
+        factory.close(dbh)
+        dbh = factory.open(path)
+
+    def delete_all():
+        for key in keys:
+            del dbh[key]
+
+    results.append(timed('set', num_keys, set_all))
+    results.append(timed('get', num_keys, get_all))
+    results.append(timed('set_many', num_keys, set_all_in_transaction))
+    results.append(timed('reopen', 1, reopen))
+    results.append(timed('delete', num_keys, delete_all))
+    factory.close(dbh)
+    return results
+
+
+def main_dbhash(num_keys: int):
+    print(f"Benchmarking dbhash implementations with {num_keys} keys.\n")
+    print(f"{'implementation':<16}{'operation':<12}{'seconds':>10}{'ops/sec':>14}")
+    for factory in DBHASH_FACTORIES:
+        with dbhash_dir() as path:
+            for result in benchmark_dbhash(factory, path, num_keys):
+                print(f"{factory.name:<16}{result.name:<12}{result.seconds:>10.3f}"
+                      f"{result.ops_per_sec:>14,.0f}")
+
+
+# Approximations of the shapes of result sets from `SELECT *` on some
+# wide NYC-DB tables.
+PLUTO_COLUMNS = ['borough', 'block', 'lot', 'bbl', 'class'] + [f'pluto_col{i}' for i in range(85)]
+
+HPD_VIOLATIONS_COLUMNS = ['violationid', 'buildingid', 'bbl', 'class'] + [
+    f'hpd_col{i}' for i in range(36)
+]
+
+
+class SyntheticCursor:
+    '''
+    A stand-in for a psycopg2 cursor that returns the same rows
+    every time it's executed.
+    '''
+
+    def __init__(self, colnames: List[str], num_rows: int):
+        self.description = [(name,) for name in colnames]
+        self.rows = [tuple(range(len(colnames)))] * num_rows
+
+    def execute(self, sql: str, params: Any=None) -> None:
+        pass
+
+    def fetchall(self) -> List[Tuple]:
+        return self.rows
+
+
+def legacy_friendly_fetchall(cursor, name: str):
+    '''
+    The original implementation of fun.friendly_fetchall(), which
+    builds a new row class on every call.
+    '''
+
+    colnames: List[str] = []
+    for desc in cursor.description:
+        colname = desc[0]
+        while colname in colnames + fun.RESERVED_NAMES:
+            colname += '_'
+        colnames.append(colname)
+
+    Result = namedtuple(name, colnames)  # type: ignore
+    return [Result(*r) for r in cursor.fetchall()]
+
+
+ROW_IMPLEMENTATIONS: List[Tuple[str, Callable]] = [
+    ('legacy', legacy_friendly_fetchall),
+    ('friendly_fetchall', fun.friendly_fetchall),
+]
+
+
+def benchmark_rows(colnames: List[str], num_rows: int, calls: int) -> List[Tuple[str, BenchmarkResult]]:
+    results: List[Tuple[str, BenchmarkResult]] = []
+    small = SyntheticCursor(colnames, 10)
+    large = SyntheticCursor(colnames, num_rows)
+    for impl_name, fetchall in ROW_IMPLEMENTATIONS:
+        def fetch_small():
+            for _ in range(calls):
+                fetchall(small, 'Row')
+
+        def fetch_large():
+            fetchall(large, 'Row')
+
+        results.append((impl_name, timed('small', calls, fetch_small)))
+        results.append((impl_name, timed('large', num_rows, fetch_large)))
+    return results
+
+
+def main_rows(num_rows: int, calls: int):
+    print(f"Benchmarking row materialization with {calls} 10-row result sets "
+          f"and one {num_rows}-row result set.\n")
+    print(f"{'table':<16}{'implementation':<20}{'result set':<12}{'seconds':>10}{'ops/sec':>14}")
+    for table, colnames in [('pluto_18v1', PLUTO_COLUMNS),
+                            ('hpd_violations', HPD_VIOLATIONS_COLUMNS)]:
+        for impl_name, result in benchmark_rows(colnames, num_rows, calls):
+            print(f"{table:<16}{impl_name:<20}{result.name:<12}{result.seconds:>10.3f}"
+                  f"{result.ops_per_sec:>14,.0f}")
+
+
+# The number of individual operations to time against each dbhash in
+# the suite, regardless of how many keys it contains.
+SUITE_SAMPLE_OPS = 10_000
+
+# The number of URLs to store in Lastmod benchmarks.
+SUITE_LASTMOD_URLS = 1000
+
+# The number of tables in the synthetic catalog that we document.
+SUITE_CATALOG_TABLES = 200
+
+
+def benchmark_dbhash_at_scale(factory: DbHashFactory, path: Path,
+                              num_keys: int) -> List[BenchmarkResult]:
+    '''
+    Loads the given number of keys into a dbhash in bulk, then times
+    individual operations on a random sample of them.
+    '''
+
+    dbh = factory.open(path)
+    rng = random.Random(num_keys)
+    keys = [f'key:{i}' for i in range(num_keys)]
+    sample = [keys[rng.randrange(num_keys)] for _ in range(min(num_keys, SUITE_SAMPLE_OPS))]
+    to_delete = list(dict.fromkeys(sample))
+
+    def load():
+        with dbh.transaction():
+            dbh.set_many((key, f'value for {key}') for key in keys)
+
+    def get():
+        for key in sample:
+            dbh.get(key)
+
+    def get_many():
+        dbh.get_many(sample)
+
+    def set_():
+        for key in sample:
+            dbh[key] = f'new value for {key}'
+
+    def delete():
+        for key in to_delete:
+            del dbh[key]
+
+    results = [
+        timed('load', num_keys, load),
+        timed('get', len(sample), get),
+        timed('get_many', len(sample), get_many),
+        timed('set', len(sample), set_),
+        timed('delete', len(to_delete), delete),
+    ]
+    factory.close(dbh)
+    return results
+
+
+def benchmark_lastmod(dbh: dbhash.AbstractDbHash) -> List[BenchmarkResult]:
+    lm = lastmod.Lastmod(dbh)
+    infos = [
+        lastmod.LastmodInfo(url=f'https://example.com/{i}.csv', etag=f'"{i}"',
+                            last_modified='Wed, 21 Oct 2015 07:28:00 GMT',
+                            size=i, sha256='0' * 64)
+        for i in range(SUITE_LASTMOD_URLS)
+    ]
+    urls = [info.url for info in infos]
+
+    def set_info():
+        for info in infos:
+            lm.set_info(info)
+
+    def get_info():
+        for url in urls:
+            lm.get_info(url)
+
+    return [
+        timed('set_info', len(infos), set_info),
+        timed('get_info', len(urls), get_info),
+        timed('set_infos', len(infos), lambda: lm.set_infos(infos)),
+        timed('get_infos', len(urls), lambda: lm.get_infos(urls)),
+    ]
+
+
+def make_synthetic_catalog(num_tables: int) -> List[DatasetMeta]:
+    '''
+    Returns a catalog of datasets shaped roughly like NYC-DB's, with
+    five tables per dataset and twenty columns per table.
+    '''
+
+    types = [DataType.text, DataType.integer, DataType.date, DataType.numeric,
+             DataType.character, DataType.array]
+    datasets: List[DatasetMeta] = []
+    for i in range(num_tables):
+        if i % 5 == 0:
+            datasets.append(DatasetMeta(f'dataset_{i // 5}', []))
+        table = TableMeta(
+            f'table_{i}',
+            verbose_name=f'Table {i}',
+            description=f'A synthetic table for benchmarking, number {i}. ' * 5,
+            description_source='the benchmark suite',
+            dataset=datasets[-1].name,
+            is_in_db_schema=True,
+        )
+        for j in range(20):
+            data_type = types[j % len(types)]
+            table.columns[f'column_{j}'] = ColumnMeta(
+                f'column_{j}',
+                verbose_name=f'Column {j}',
+                description=f'A synthetic column for benchmarking, number {j}.',
+                data_type=data_type,
+                data_subtype=DataType.text if data_type == DataType.array else None,
+                numeric_scale=2 if data_type == DataType.numeric else None,
+                character_maximum_length=10 if data_type == DataType.character else None,
+                is_nullable=bool(j % 2),
+                is_in_db_schema=True,
+            )
+        datasets[-1].tables.append(table)
+    return datasets
+
+
+def benchmark_document_datasets(num_tables: int) -> List[BenchmarkResult]:
+    datasets = make_synthetic_catalog(num_tables)
+    warm = introspect_schema.CachingTableRenderer({}, {})
+
+    def document(render: Callable[[TableMeta], str]):
+        with contextlib.redirect_stdout(io.StringIO()):
+            introspect_schema.document_datasets(datasets, render=render)
+
+    results = [timed('render', num_tables, lambda: document(introspect_schema.render_table))]
+    document(warm.render)
+    cached = introspect_schema.CachingTableRenderer({}, warm.fragments)
+    results.append(timed('cached', num_tables, lambda: document(cached.render)))
+    return results
+
+
+def run_suite_once(sizes: List[int]) -> Dict[str, BenchmarkResult]:
+    results: Dict[str, BenchmarkResult] = {}
+
+    def add(prefix: str, group: List[BenchmarkResult]):
+        for result in group:
+            results[f'{prefix}/{result.name}'] = result
+
+    for factory in DBHASH_FACTORIES:
+        for size in sizes:
+            with dbhash_dir() as path:
+                add(f'dbhash/{factory.name}/{size}',
+                    benchmark_dbhash_at_scale(factory, path, size))
+    add('lastmod/DictDbHash', benchmark_lastmod(dbhash.DictDbHash({})))
+    add('lastmod/SqlDbHash', benchmark_lastmod(
+        dbhash.SqlDbHash(sqlite3.connect(':memory:'), 'lastmod')))
+    for table, colnames in [('pluto_18v1', PLUTO_COLUMNS),
+                            ('hpd_violations', HPD_VIOLATIONS_COLUMNS)]:
+        small = SyntheticCursor(colnames, 10)
+        large = SyntheticCursor(colnames, 100_000)
+        add(f'rows/{table}', [
+            timed('small', 1000, lambda: [fun.friendly_fetchall(small, 'Row')
+                                          for _ in range(1000)]),
+            timed('large', 100_000, lambda: fun.friendly_fetchall(large, 'Row')),
+        ])
+    add(f'document_datasets/{SUITE_CATALOG_TABLES}',
+        benchmark_document_datasets(SUITE_CATALOG_TABLES))
+    return results
+
+
+def run_suite(sizes: List[int], repeat: int) -> Dict[str, BenchmarkResult]:
+    '''
+    Runs the whole suite the given number of times, returning the
+    fastest result of each benchmark.
+    '''
+
+    best: Dict[str, BenchmarkResult] = {}
+    for _ in range(repeat):
+        for name, result in run_suite_once(sizes).items():
+            if name not in best or result.seconds < best[name].seconds:
+                best[name] = result
+    return best
+
+
+def results_to_json(results: Dict[str, BenchmarkResult]) -> Dict[str, Any]:
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {
+            name: {
+                'seconds': result.seconds,
+                'ops': result.ops,
+                'ops_per_sec': result.ops_per_sec,
+            }
+            for name, result in results.items()
+        },
+    }
+
+
+class Comparison(NamedTuple):
+    name: str
+    ops_per_sec: float
+
+    # The benchmark's throughput in the baseline, or None if the
+    # baseline doesn't have it.
+    baseline_ops_per_sec: Optional[float]
+
+    @property
+    def change(self) -> Optional[float]:
+        '''
+        The relative change in throughput from the baseline, e.g.
+        -0.25 if the benchmark is 25% slower.
+        '''
+
+        if not self.baseline_ops_per_sec:
+            return None
+        return self.ops_per_sec / self.baseline_ops_per_sec - 1
+
+    def is_regression(self, threshold: float) -> bool:
+        return self.change is not None and self.change < -threshold
+
+
+def compare_results(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> List[Comparison]:
+    baseline_results = {} if baseline is None else baseline['results']
+    return [
+        Comparison(name, result['ops_per_sec'],
+                   baseline_results.get(name, {}).get('ops_per_sec'))
+        for name, result in results['results'].items()
+    ]
+
+
+def print_comparisons(comparisons: List[Comparison], threshold: float) -> None:
+    print(f"{'benchmark':<40}{'ops/sec':>14}{'baseline':>14}{'change':>10}")
+    for c in comparisons:
+        baseline = '' if c.baseline_ops_per_sec is None else f"{c.baseline_ops_per_sec:,.0f}"
+        change = '' if c.change is None else f"{c.change:+.1%}"
+        flag = '  REGRESSION' if c.is_regression(threshold) else ''
+        print(f"{c.name:<40}{c.ops_per_sec:>14,.0f}{baseline:>14}{change:>10}{flag}")
+
+
+def main_suite(sizes: List[int], repeat: int, output: Optional[str], baseline_path: str,
+               threshold: float, save_baseline: bool) -> int:
+    results = results_to_json(run_suite(sizes, repeat))
+    baseline_file = Path(baseline_path)
+    baseline = json.loads(baseline_file.read_text()) if baseline_file.exists() else None
+    comparisons = compare_results(results, baseline)
+    print_comparisons(comparisons, threshold)
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+    if save_baseline:
+        baseline_file.write_text(json.dumps(results, indent=2))
+        print(f"\nSaved baseline to {baseline_file}.")
+    regressions = [c for c in comparisons if c.is_regression(threshold)]
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks regressed by more than {threshold:.0%}.")
+        return 1
+    return 0
+
+
+# The command-line entry points whose startup time we care about.
+STARTUP_SCRIPTS = [
+    'fun.py', 'introspect_schema.py', 'update_dataset_lastmod.py', 'server.py',
+    'nycdb_extract.py', 'address_index.py', 'portfolio_index.py',
+]
+
+
+class ImportTime(NamedTuple):
+    module: str
+
+    # How deeply the import is nested inside other imports, where
+    # 0 means it was imported directly by the script or the
+    # interpreter's own startup.
+    depth: int
+
+    self_us: int
+    cumulative_us: int
+
+
+def parse_importtime(stderr: str) -> List[ImportTime]:
+    '''
+    Parses the output of "python -X importtime".
+    '''
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2][1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        imports.append(ImportTime(name.strip(), depth, int(fields[0]), int(fields[1])))
+    return imports
+
+
+class StartupResult(NamedTuple):
+    script: str
+    seconds: float
+    imports: List[ImportTime]
+
+    def heaviest(self, count: int) -> List[ImportTime]:
+        top_level = [i for i in self.imports if i.depth == 0]
+        return sorted(top_level, key=lambda i: i.cumulative_us, reverse=True)[:count]
+
+
+def measure_startup(script: str, repeat: int) -> StartupResult:
+    '''
+    Runs "<script> --help" in a fresh interpreter the given number of
+    times, returning the fastest run.
+    '''
+
+    best: Optional[StartupResult] = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'],
+                              cwd=MY_DIR, capture_output=True, text=True, check=True)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best.seconds:
+            best = StartupResult(script, seconds, parse_importtime(proc.stderr))
+    assert best is not None
+    return best
+
+
+def main_startup(budget_ms: float, repeat: int) -> int:
+    too_slow = []
+    for script in STARTUP_SCRIPTS:
+        result = measure_startup(script, repeat)
+        ms = result.seconds * 1000
+        flag = '  TOO SLOW' if ms > budget_ms else ''
+        print(f"{script} --help: {ms:.0f} ms{flag}")
+        for i in result.heaviest(5):
+            print(f"  {i.cumulative_us / 1000:>7.1f} ms  {i.module}")
+        if flag:
+            too_slow.append(script)
+    if too_slow:
+        print(f"\n{len(too_slow)} entry points took longer than {budget_ms:.0f} ms to start.")
+        return 1
+    return 0
+
+
+def main():
+    args = docopt.docopt(__doc__)
+
+    if args['dbhash']:
+        main_dbhash(int(args['--keys']))
+    elif args['rows']:
+        main_rows(int(args['--rows']), int(args['--calls']))
+    elif args['suite']:
+        sys.exit(main_suite(
+            sizes=[int(size) for size in args['--sizes'].split(',')],
+            repeat=int(args['--repeat']),
+            output=args['--output'],
+            baseline_path=args['--baseline'],
+            threshold=float(args['--threshold']) / 100,
+            save_baseline=args['--save-baseline'],
+        ))
+    elif args['startup']:
+        sys.exit(main_startup(float(args['--budget']), int(args['--repeat'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import lastmod
+import downloader
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse(text: str) -> Dict[str, Any]:
+    # PyYAML is slow to import, and we only need it when the cached
+    # copy is stale.
+    import yaml
+
+    # datasets.yml used to be parsed with a bare yaml.load(), which
+    # PyYAML 6 rejects without a Loader, and which isn't safe anyway.
+    # Use the safe loader, C-accelerated if libyaml is available.
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+
+def cache_path_for(path: Path) -> Path:
+    return path.with_name(f"{path.name}.json")
+
+
+def _save_cache(cache_path: Path, stat: os.stat_result, sha256: str,
+                data: Dict[str, Any]) -> None:
+    try:
+        serialized = json.dumps({
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': sha256,
+            'data': data,
+        })
+    except TypeError:
+        # The YAML contains something JSON can't represent, so don't
+        # bother caching it.
+        return
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    tmp_path.write_text(serialized, encoding='utf-8')
+    os.replace(tmp_path, cache_path)
+
+
+def load(path: Path, cache_path: Optional[Path]=None) -> Dict[str, Any]:
+    '''
+    Loads the given YAML file, using a parsed copy cached in a JSON
+    file alongside it if the YAML hasn't changed since it was cached.
+
+    The cache is considered valid if the YAML file's modification time
+    and size match, or if its contents hash to the same value.
+    '''
+
+    cache_path = cache_path or cache_path_for(path)
+    stat = path.stat()
+    try:
+        cache = json.loads(cache_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        cache = None
+    if (cache is not None and cache.get('mtime_ns') == stat.st_mtime_ns and
+            cache.get('size') == stat.st_size):
+        return cache['data']
+
+    content = path.read_bytes()
+    sha256 = hashlib.sha256(content).hexdigest()
+    if cache is not None and cache.get('sha256') == sha256:
+        data = cache['data']
+    else:
+        data = parse(content.decode('utf-8'))
+    _save_cache(cache_path, stat, sha256, data)
+    return data
+
+
+def refresh(path: Path, url: str, lm: lastmod.Lastmod) -> bool:
+    '''
+    Revalidates the given YAML file against the URL it came from,
+    downloading it again if it has changed. Returns whether it was
+    downloaded.
+
+    If the URL can't be reached but we already have a copy of the
+    file, the copy is kept.
+    '''
+
+    lminfo = lm.get_info(url)
+    headers: Dict[str, str] = {}
+    if path.exists():
+        if lminfo.etag:
+            headers['If-None-Match'] = lminfo.etag
+        if lminfo.last_modified:
+            headers['If-Modified-Since'] = lminfo.last_modified
+    try:
+        result = downloader.download(url, path, headers=headers)
+    except Exception:
+        if not path.exists():
+            raise
+        logger.exception(f"Unable to revalidate {url}, using cached copy.")
+        return False
+    if result is None:
+        return False
+    lm.set_info(lastmod.LastmodInfo(
+        url=url,
+        etag=result.etag,
+        last_modified=result.last_modified,
+        size=result.size,
+        sha256=result.sha256
+    ))
+    return True
@@ -1,8 +1,40 @@
+import os
 import abc
-from typing import Optional, Iterable, Any, Dict
+import mmap
+import json
+import zlib
+import struct
+import logging
+import contextlib
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional, Iterable, Iterator, Any, Dict, Tuple, List, Sequence, Union
 from sqlite3 import Connection, Cursor
 
 
+# The maximum number of keys to look up in a single SELECT. SQLite
+# limits the number of parameters in a statement to 999 by default.
+GET_MANY_CHUNK_SIZE = 500
+
+# Every LogDbHash log file starts with this, followed by a random
+# identifier that changes whenever the log is compacted.
+LOG_MAGIC = b'DBHASHLOG1'
+
+LOG_ID_SIZE = 16
+
+LOG_HEADER_SIZE = len(LOG_MAGIC) + LOG_ID_SIZE
+
+# Each record in a LogDbHash log starts with a CRC-32 of the rest of
+# the record, followed by the length of its key and the length of
+# its value (or LOG_TOMBSTONE if the record is a deletion).
+LOG_RECORD_HEADER = struct.Struct('<IIi')
+
+LOG_TOMBSTONE = -1
+
+
+logger = logging.getLogger(__name__)
+
+
 class AbstractDbHash(abc.ABC):
     @abc.abstractmethod
     def get(self, key: str) -> Optional[str]:
@@ -16,6 +48,18 @@ class AbstractDbHash(abc.ABC):
     def __delitem__(self, key: str) -> None:
         ...
 
+    @abc.abstractmethod
+    def items(self, prefix: str='') -> Iterator[Tuple[str, str]]:
+        '''
+        Iterate through all key-value pairs whose keys start with
+        the given prefix, in no particular order.
+        '''
+
+        ...
+
+    def keys(self, prefix: str='') -> Iterator[str]:
+        return (key for key, _ in self.items(prefix))
+
     def __getitem__(self, key: str) -> str:
         item = self.get(key)
         if item is None:
@@ -31,6 +75,41 @@ class AbstractDbHash(abc.ABC):
         elif key in self:
             del self[key]
 
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        '''
+        Returns a mapping from each of the given keys to its value,
+        omitting any keys that don't exist.
+        '''
+
+        result: Dict[str, str] = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        for key, value in items:
+            self[key] = value
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        '''
+        Deletes all the given keys. Unlike `del`, it isn't an error
+        if any of them don't exist.
+        '''
+
+        for key in keys:
+            self.set_or_delete(key, None)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        '''
+        A context manager that groups all the writes made inside it
+        together, if the implementation supports it.
+        '''
+
+        yield
+
 
 class DictDbHash(AbstractDbHash):
     def __init__(self, d: Dict[str, str]):
@@ -45,6 +124,185 @@ class DictDbHash(AbstractDbHash):
     def __delitem__(self, key: str) -> None:
         del self.d[key]
 
+    def items(self, prefix: str='') -> Iterator[Tuple[str, str]]:
+        return iter([(k, v) for k, v in self.d.items() if k.startswith(prefix)])
+
+
+class CachingDbHash(AbstractDbHash):
+    '''
+    Wraps another AbstractDbHash with a bounded, in-process LRU read
+    cache. Lookups of missing keys are cached too.
+
+    In write-through mode (the default), writes go straight to the
+    backend. In write-back mode, they're held in memory until flush()
+    is called, or until the end of the outermost transaction().
+    '''
+
+    def __init__(self, backend: AbstractDbHash, max_entries: int=10_000,
+                 write_back: bool=False):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.write_back = write_back
+        self.hits = 0
+        self.misses = 0
+
+        # Cached values, ordered from least to most recently used. A
+        # value of None means we know the key doesn't exist.
+        self._cache: OrderedDict[str, Optional[str]] = OrderedDict()
+
+        # Writes that haven't been flushed to the backend yet. A value
+        # of None means the key is pending deletion.
+        self._dirty: Dict[str, Optional[str]] = {}
+
+        self._transaction_depth = 0
+
+    def _remember(self, key: str, value: Optional[str]) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _lookup(self, key: str) -> Tuple[bool, Optional[str]]:
+        if key in self._dirty:
+            self.hits += 1
+            return True, self._dirty[key]
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return True, self._cache[key]
+        return False, None
+
+    def _write(self, items: Dict[str, Optional[str]]) -> None:
+        if not self.write_back:
+            # Only cache values once the backend has accepted them, so
+            # we never serve a value that failed to persist.
+            self._write_to_backend(items)
+        for key, value in items.items():
+            self._remember(key, value)
+        if self.write_back:
+            self._dirty.update(items)
+
+    def _write_to_backend(self, items: Dict[str, Optional[str]]) -> None:
+        to_set = [(key, value) for key, value in items.items() if value is not None]
+        to_delete = [key for key, value in items.items() if value is None]
+        with self.backend.transaction():
+            if to_set:
+                self.backend.set_many(to_set)
+            if to_delete:
+                self.backend.delete_many(to_delete)
+
+    def get(self, key: str) -> Optional[str]:
+        found, value = self._lookup(key)
+        if not found:
+            self.misses += 1
+            value = self.backend.get(key)
+            self._remember(key, value)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        result: Dict[str, Optional[str]] = {}
+        missing: List[str] = []
+        for key in keys:
+            found, value = self._lookup(key)
+            if found:
+                result[key] = value
+            else:
+                missing.append(key)
+        if missing:
+            self.misses += len(missing)
+            fetched = self.backend.get_many(missing)
+            for key in missing:
+                result[key] = fetched.get(key)
+                self._remember(key, result[key])
+        return {key: value for key, value in result.items() if value is not None}
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self._write({key: value})
+
+    def __delitem__(self, key: str) -> None:
+        if self.get(key) is None:
+            raise KeyError(key)
+        self._write({key: None})
+
+    def set_or_delete(self, key: str, value: Optional[str]) -> None:
+        if value is not None or self.get(key) is not None:
+            self._write({key: value})
+
+    def set_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        self._write(dict(items))
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        self._write({key: None for key in keys})
+
+    def items(self, prefix: str='') -> Iterator[Tuple[str, str]]:
+        self.flush()
+        return self.backend.items(prefix)
+
+    def keys(self, prefix: str='') -> Iterator[str]:
+        self.flush()
+        return self.backend.keys(prefix)
+
+    def flush(self) -> None:
+        '''
+        Writes any pending changes to the backend.
+        '''
+
+        if self._dirty:
+            self._write_to_backend(self._dirty)
+            self._dirty = {}
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        dirty = dict(self._dirty)
+        self._transaction_depth = 1
+        try:
+            if self.write_back:
+                yield
+                self.flush()
+            else:
+                with self.backend.transaction():
+                    yield
+        except BaseException:
+            # We don't know which of our cached values were rolled
+            # back, so forget all of them.
+            self._cache.clear()
+            self._dirty = dirty
+            raise
+        finally:
+            self._transaction_depth = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def prefix_upper_bound(prefix: str) -> Optional[str]:
+    '''
+    Returns the smallest string that is greater than every string
+    starting with the given prefix, in code point order, or None if
+    there is no such string.
+    '''
+
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            # Surrogates can't be encoded, so skip past them.
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+    return None
+
 
 class SqlDbHash(AbstractDbHash):
     def __init__(self, conn: Connection, table: str, param_subst: str='?', autocommit: bool=True):
@@ -52,6 +310,7 @@ class SqlDbHash(AbstractDbHash):
         self.param_subst = param_subst
         self.autocommit = autocommit
         self.conn = conn
+        self._transaction_depth = 0
         self._init_db()
 
     def _init_db(self) -> None:
@@ -64,32 +323,395 @@ class SqlDbHash(AbstractDbHash):
             """
         )
 
-    def _exec_sql(self, sql: str, params: Iterable[Any]=tuple()) -> Cursor:
+    def _exec_sql(self, sql: str, params: Sequence[Any]=tuple()) -> Cursor:
         sql = sql.replace('?', self.param_subst)
         cur = self.conn.cursor()
         cur.execute(sql, params)
         return cur
 
-    def __setitem__(self, key: str, value: str) -> None:
-        if self.get(key) is not None:
-            self._exec_sql(f"UPDATE {self.table} SET value = ? WHERE key = ?",
-                           (value, key))
-        else:
-            self._exec_sql(
-                f"INSERT INTO {self.table} (key, value) VALUES (?, ?)", (key, value))
+    def _exec_many_sql(self, sql: str, params: Iterable[Sequence[Any]]) -> None:
+        sql = sql.replace('?', self.param_subst)
+        cur = self.conn.cursor()
+        cur.executemany(sql, params)
+
+    def _maybe_commit(self) -> None:
         if self.autocommit:
             self.conn.commit()
 
+    @property
+    def _upsert_sql(self) -> str:
+        return (
+            f"INSERT INTO {self.table} (key, value) VALUES (?, ?) "
+            f"ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+        )
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self._exec_sql(self._upsert_sql, (key, value))
+        self._maybe_commit()
+
     def __delitem__(self, key: str) -> None:
-        if key not in self:
-            raise KeyError(key)
-        self._exec_sql(
+        cur = self._exec_sql(
             f"DELETE FROM {self.table} WHERE key = ?", (key,))
-        if self.autocommit:
-            self.conn.commit()
+        if cur.rowcount == 0:
+            raise KeyError(key)
+        self._maybe_commit()
+
+    def set_or_delete(self, key: str, value: Optional[str]) -> None:
+        if value is not None:
+            self[key] = value
+        else:
+            self.delete_many([key])
 
     def get(self, key: str) -> Optional[str]:
         cur = self._exec_sql(
             f"SELECT value FROM {self.table} WHERE key = ?", (key,))
         result = cur.fetchone()
         return None if result is None else result[0]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        result: Dict[str, str] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), GET_MANY_CHUNK_SIZE):
+            chunk = unique_keys[i:i + GET_MANY_CHUNK_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            cur = self._exec_sql(
+                f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})",
+                chunk)
+            result.update(cur.fetchall())
+        return result
+
+    def set_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        self._exec_many_sql(self._upsert_sql, items)
+        self._maybe_commit()
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        self._exec_many_sql(
+            f"DELETE FROM {self.table} WHERE key = ?", ((key,) for key in keys))
+        self._maybe_commit()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        '''
+        Turns off autocommit for the duration of the context, committing
+        all writes at once when it exits (or rolling them back if an
+        exception is raised). Nested transactions are folded into the
+        outermost one.
+        '''
+
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        autocommit = self.autocommit
+        self.autocommit = False
+        self._transaction_depth = 1
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self._transaction_depth = 0
+            self.autocommit = autocommit
+
+    def _prefix_where(self, prefix: str) -> Tuple[str, Sequence[str]]:
+        # Keys with the prefix are exactly those in a range, which
+        # (unlike substr()) lets the primary key's index be used. This
+        # relies on keys being compared in code point order, as they are
+        # with SQLite's default collation.
+        if not prefix:
+            return '', ()
+        upper = prefix_upper_bound(prefix)
+        if upper is None:
+            return 'WHERE key >= ?', (prefix,)
+        return 'WHERE key >= ? AND key < ?', (prefix, upper)
+
+    def items(self, prefix: str='') -> Iterator[Tuple[str, str]]:
+        where, params = self._prefix_where(prefix)
+        cur = self._exec_sql(f"SELECT key, value FROM {self.table} {where}", params)
+        return iter(cur.fetchall())
+
+    def keys(self, prefix: str='') -> Iterator[str]:
+        where, params = self._prefix_where(prefix)
+        cur = self._exec_sql(f"SELECT key FROM {self.table} {where}", params)
+        return (row[0] for row in cur.fetchall())
+
+
+class LogDbHash(AbstractDbHash):
+    '''
+    An AbstractDbHash stored in an append-only log file, with an
+    in-memory index from keys to the offsets of their latest values,
+    which are read through mmap.
+
+    Every write appends a record to the log. Once more than
+    compact_ratio of the log consists of overwritten or deleted
+    records, it's compacted by rewriting just the live records to a
+    new file.
+
+    The index is saved to a sidecar file when the log is closed or
+    compacted, so it doesn't need to be rebuilt by scanning the whole
+    log when it's reopened. If the last record of the log was only
+    partially written (e.g. because of a crash), it's discarded.
+    '''
+
+    def __init__(self, path: Union[str, Path], compact_ratio: float=0.5,
+                 compact_min_bytes: int=1024 * 1024, sync: bool=False):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(f"{self.path.name}.idx")
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.sync = sync
+
+        # A mapping from keys to the offsets and lengths of their values.
+        self._index: Dict[str, Tuple[int, int]] = {}
+
+        # The number of bytes in the log taken up by dead records.
+        self._garbage = 0
+
+        self._transaction_depth = 0
+
+        # While in a transaction, the index entries of every key that
+        # was changed in it, as they were before the transaction started.
+        self._undo: Dict[str, Optional[Tuple[int, int]]] = {}
+
+        self._open()
+
+    def _create_log(self, log_id: bytes) -> None:
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_path.open('wb') as f:
+            f.write(LOG_MAGIC + log_id)
+        os.replace(tmp_path, self.path)
+
+    def _open(self) -> None:
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            self._create_log(os.urandom(LOG_ID_SIZE))
+        self._file = self.path.open('r+b')
+        header = self._file.read(LOG_HEADER_SIZE)
+        if len(header) < LOG_HEADER_SIZE or not header.startswith(LOG_MAGIC):
+            raise ValueError(f"{self.path} is not a dbhash log")
+        self._log_id = header[len(LOG_MAGIC):]
+        self._size = self._file.seek(0, os.SEEK_END)
+        self._map()
+        self._replay(self._load_index())
+
+    def _map(self) -> None:
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remap(self) -> None:
+        self._file.flush()
+        self._mmap.close()
+        self._map()
+
+    def _load_index(self) -> int:
+        '''
+        Loads the index from the sidecar file, if it's valid, and
+        returns the log offset that it's up-to-date with.
+        '''
+
+        try:
+            data = json.loads(self.index_path.read_text(encoding='utf-8'))
+            if data['log_id'] == self._log_id.hex() and data['log_size'] <= self._size:
+                self._index = {key: (off, vlen) for key, (off, vlen) in data['index'].items()}
+                self._garbage = data['garbage']
+                return data['log_size']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self._index = {}
+        self._garbage = 0
+        return LOG_HEADER_SIZE
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+        tmp_path.write_text(json.dumps({
+            'log_id': self._log_id.hex(),
+            'log_size': self._size,
+            'garbage': self._garbage,
+            'index': self._index,
+        }), encoding='utf-8')
+        os.replace(tmp_path, self.index_path)
+
+    def _replay(self, pos: int) -> None:
+        mm = self._mmap
+        size = self._size
+        while pos + LOG_RECORD_HEADER.size <= size:
+            crc, klen, vlen = LOG_RECORD_HEADER.unpack_from(mm, pos)
+            key_start = pos + LOG_RECORD_HEADER.size
+            end = key_start + klen + max(vlen, 0)
+            if end > size or zlib.crc32(mm[pos + 4:end]) != crc:
+                break
+            key = mm[key_start:key_start + klen].decode('utf-8')
+            entry = None if vlen == LOG_TOMBSTONE else (key_start + klen, vlen)
+            self._apply(key, entry, end - pos)
+            pos = end
+        if pos < size:
+            logger.warning(f"Discarding {size - pos} bytes of incomplete data at "
+                           f"the end of {self.path}.")
+            self._truncate(pos)
+
+    def _truncate(self, size: int) -> None:
+        self._mmap.close()
+        self._file.truncate(size)
+        self._size = size
+        self._map()
+
+    def _record_size(self, key: str, vlen: int) -> int:
+        return LOG_RECORD_HEADER.size + len(key.encode('utf-8')) + max(vlen, 0)
+
+    def _apply(self, key: str, entry: Optional[Tuple[int, int]], record_size: int) -> None:
+        old = self._index.get(key)
+        if old is not None:
+            self._garbage += self._record_size(key, old[1])
+        if entry is None:
+            self._index.pop(key, None)
+            self._garbage += record_size
+        else:
+            self._index[key] = entry
+
+    def _append(self, items: Iterable[Tuple[str, Optional[str]]]) -> None:
+        buf = bytearray()
+        entries: List[Tuple[str, Optional[Tuple[int, int]], int]] = []
+        for key, value in items:
+            kb = key.encode('utf-8')
+            vb = b'' if value is None else value.encode('utf-8')
+            vlen = LOG_TOMBSTONE if value is None else len(vb)
+            body = struct.pack('<Ii', len(kb), vlen) + kb + vb
+            value_offset = self._size + len(buf) + LOG_RECORD_HEADER.size + len(kb)
+            entries.append((key, None if value is None else (value_offset, vlen),
+                            4 + len(body)))
+            buf += struct.pack('<I', zlib.crc32(body)) + body
+        if not buf:
+            return
+        self._file.seek(self._size)
+        self._file.write(buf)
+        self._size += len(buf)
+        for key, entry, record_size in entries:
+            if self._transaction_depth and key not in self._undo:
+                self._undo[key] = self._index.get(key)
+            self._apply(key, entry, record_size)
+        if not self._transaction_depth:
+            self._commit()
+
+    def _commit(self) -> None:
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        if (self._size >= self.compact_min_bytes and
+                self._garbage > self._size * self.compact_ratio):
+            self.compact()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        offset, vlen = entry
+        if offset + vlen > len(self._mmap):
+            self._remap()
+        return self._mmap[offset:offset + vlen].decode('utf-8')
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self._append([(key, value)])
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._index:
+            raise KeyError(key)
+        self._append([(key, None)])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def set_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        self._append(items)
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        self._append((key, None) for key in keys if key in self._index)
+
+    def items(self, prefix: str='') -> Iterator[Tuple[str, str]]:
+        return iter([(key, self[key]) for key in self.keys(prefix)])
+
+    def keys(self, prefix: str='') -> Iterator[str]:
+        return iter([key for key in self._index if key.startswith(prefix)])
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        '''
+        Defers flushing the log until the context exits. If an
+        exception is raised, all the records appended in the context
+        are discarded.
+        '''
+
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        start_size = self._size
+        start_garbage = self._garbage
+        self._transaction_depth = 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth = 0
+            for key, entry in self._undo.items():
+                if entry is None:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = entry
+            self._garbage = start_garbage
+            self._undo = {}
+            self._file.flush()
+            self._truncate(start_size)
+            raise
+        self._transaction_depth = 0
+        self._undo = {}
+        self._commit()
+
+    def compact(self) -> None:
+        '''
+        Rewrites the log so that it only contains live records.
+        '''
+
+        self._remap()
+        log_id = os.urandom(LOG_ID_SIZE)
+        tmp_path = self.path.with_name(f"{self.path.name}.compact")
+        index: Dict[str, Tuple[int, int]] = {}
+        pos = LOG_HEADER_SIZE
+        with tmp_path.open('wb') as f:
+            f.write(LOG_MAGIC + log_id)
+            for key, (offset, vlen) in self._index.items():
+                kb = key.encode('utf-8')
+                body = struct.pack('<Ii', len(kb), vlen) + kb + self._mmap[offset:offset + vlen]
+                f.write(struct.pack('<I', zlib.crc32(body)) + body)
+                index[key] = (pos + LOG_RECORD_HEADER.size + len(kb), vlen)
+                pos += 4 + len(body)
+            f.flush()
+            os.fsync(f.fileno())
+        self._mmap.close()
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = self.path.open('r+b')
+        self._log_id = log_id
+        self._index = index
+        self._garbage = 0
+        self._size = pos
+        self._map()
+        self._save_index()
+
+    def close(self) -> None:
+        '''
+        Flushes the log and saves the index, so that the log can be
+        reopened quickly.
+        '''
+
+        self._file.flush()
+        self._save_index()
+        self._mmap.close()
+        self._file.close()
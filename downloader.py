@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+
+# The number of bytes to read from the network and write to disk at
+# a time. This bounds how much of a download is held in memory.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadResult(NamedTuple):
+    path: Path
+    size: int
+    sha256: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    # Whether the download picked up where a previous, interrupted
+    # download left off.
+    resumed: bool
+
+
+def part_path(dest: Path) -> Path:
+    return dest.with_name(f"{dest.name}.part")
+
+
+def part_meta_path(dest: Path) -> Path:
+    return dest.with_name(f"{dest.name}.part.json")
+
+
+def _read_part_meta(dest: Path) -> Dict[str, Optional[str]]:
+    try:
+        return json.loads(part_meta_path(dest).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def _discard_part(dest: Path) -> None:
+    for path in [part_path(dest), part_meta_path(dest)]:
+        if path.exists():
+            path.unlink()
+
+
+def resume_headers(dest: Path) -> Dict[str, str]:
+    '''
+    Returns the headers needed to resume an interrupted download of
+    the given file, or an empty dict if there's nothing to resume.
+    '''
+
+    part = part_path(dest)
+    meta = _read_part_meta(dest)
+    validator = meta.get('etag') or meta.get('last_modified')
+    if not (part.exists() and validator):
+        return {}
+    return {
+        'Range': f"bytes={part.stat().st_size}-",
+        'If-Range': validator,
+    }
+
+
+def _hash_file(path: Path, hasher) -> int:
+    size = 0
+    with path.open('rb') as f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                return size
+            hasher.update(chunk)
+            size += len(chunk)
+
+
+def _content_range_start(res: 'requests.Response') -> Optional[int]:
+    # e.g. "bytes 1000-1999/2000".
+    content_range = res.headers.get('Content-Range', '')
+    if not content_range.startswith('bytes '):
+        return None
+    try:
+        return int(content_range[len('bytes '):].split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def save_response(res: 'requests.Response', dest: Path,
+                  chunk_size: int=DOWNLOAD_CHUNK_SIZE) -> DownloadResult:
+    '''
+    Streams the body of the given 200 or 206 response to the given
+    file, a chunk at a time. A 206 response is appended to the partial
+    download left behind by a previous call.
+
+    The body is written to a temporary ".part" file that only
+    replaces the destination once it's complete, so an interrupted
+    download can be resumed later via resume_headers().
+    '''
+
+    part = part_path(dest)
+    hasher = hashlib.sha256()
+    resumed = res.status_code == 206
+    if resumed:
+        size = _hash_file(part, hasher) if part.exists() else 0
+        if _content_range_start(res) != size:
+            _discard_part(dest)
+            raise Exception(f"Server did not resume {res.url} where we left off")
+    elif res.status_code == 200:
+        size = 0
+    else:
+        raise Exception(f"Expected 200 or 206 response, got {res.status_code}")
+
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part_meta_path(dest).write_text(json.dumps({
+        'url': res.url,
+        'etag': etag,
+        'last_modified': last_modified,
+    }), encoding='utf-8')
+    with part.open('ab' if resumed else 'wb') as f:
+        for chunk in res.iter_content(chunk_size):
+            f.write(chunk)
+            hasher.update(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part, dest)
+    part_meta_path(dest).unlink()
+    return DownloadResult(
+        path=dest,
+        size=size,
+        sha256=hasher.hexdigest(),
+        etag=etag,
+        last_modified=last_modified,
+        resumed=resumed
+    )
+
+
+def download(url: str, dest: Path, session: Optional['requests.Session']=None,
+             headers: Optional[Dict[str, str]]=None,
+             chunk_size: int=DOWNLOAD_CHUNK_SIZE) -> Optional[DownloadResult]:
+    '''
+    Downloads the given URL to the given file, resuming a previous
+    interrupted download if possible. Any conditional request headers
+    passed in are sent along too; if the server responds with a 304,
+    nothing is downloaded and None is returned.
+    '''
+
+    import requests
+
+    all_headers = {'Accept-Encoding': 'identity', **(headers or {}), **resume_headers(dest)}
+    with (session or requests).get(url, headers=all_headers, stream=True) as res:
+        if res.status_code == 304:
+            return None
+        if res.status_code == 416:
+            # Our partial download is no good, so start over.
+            _discard_part(dest)
+            return download(url, dest, session, headers, chunk_size)
+        return save_response(res, dest, chunk_size)
@@ -2,60 +2,674 @@
 Find some information about your landlord.
 
 Usage:
-  fun.py <address>
+  fun.py <address> [--portfolio] [--profile] [--profile-json=<file>]
+  fun.py --batch [<file>] [--workers=<n>] [--profile] [--profile-json=<file>]
+  fun.py --build-summaries [--chunk-size=<n>] [--profile] [--profile-json=<file>]
 
 Options:
   -h --help                 Show this screen.
+  --portfolio               Also list the other properties associated
+                            with the names and addresses of the
+                            property's ACRIS parties.
+  --batch                   Look up every address in the given file
+                            (or stdin), one per line, and output one
+                            JSON record per address. Records only
+                            include the columns the report uses.
+  --workers=<n>             Number of concurrent lookups to run in
+                            batch mode [default: 4].
+  --build-summaries         Precompute the report for every BBL in
+                            PLUTO whose summary is missing or stale.
+  --chunk-size=<n>          Number of BBLs to build summaries for per
+                            query [default: 1000].
+  --profile                 Print a summary of where time was spent, by
+                            SQL statement, HTTP request and stage, to
+                            stderr.
+  --profile-json=<file>     Write a trace of every timed SQL statement,
+                            HTTP request and stage to the given file.
 
 Environment variables:
   DATABASE_URL              The Postgres URL to the NYC-DB instance.
+  GEOCODING_CACHE_DB        Optional path to a SQLite database used to
+                            cache geocoding results.
+  ADDRESS_INDEX             Optional path to a local address index made
+                            by address_index.py, which is consulted
+                            before the remote geocoder.
+  BBL_SUMMARY_DB            Optional path to a SQLite database of
+                            precomputed BBL reports, which are consulted
+                            before querying NYC-DB.
+  PORTFOLIO_INDEX           Path to a portfolio index made by
+                            portfolio_index.py, for --portfolio.
+  NYCDB_EXTRACT_DB          Optional path to an offline extract of
+                            NYC-DB made by nycdb_extract.py. If set,
+                            reports are built from it instead of from
+                            DATABASE_URL (except --build-summaries,
+                            which always uses DATABASE_URL).
 """
 
 import os
 import sys
-from collections import namedtuple
-from typing import List
+import json
+import atexit
+import uuid
+import functools
+import itertools
+from collections import namedtuple, deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import (
+    List, Dict, Any, Optional, NamedTuple, Iterable, Iterator, TextIO, Deque,
+    Callable, Tuple, TYPE_CHECKING)
 import docopt
 import dotenv
-import psycopg2
 
-import geocoding
+import bbl_summary
+import profiling
 
-
-dotenv.load_dotenv()
+if TYPE_CHECKING:
+    import geocoding
+    import portfolio_index
 
 
 RESERVED_NAMES = ['class']
 
+# The maximum number of batch lookups to queue up per worker, so
+# that we don't read an entire huge address list into memory.
+BATCH_QUEUE_FACTOR = 4
 
-def friendly_fetchall(cursor, name: str):
-    colnames: List[str] = []
-    for desc in cursor.description:
-        colname = desc[0]
-        while colname in colnames + RESERVED_NAMES:
+# The number of rows friendly_iter() fetches from the database at a time.
+ITERSIZE = 2000
+
+
+@functools.lru_cache(maxsize=256)
+def get_row_class(name: str, colnames: Tuple[str, ...]):
+    '''
+    Returns a namedtuple class for rows with the given column names,
+    renaming any columns that are duplicates or reserved words. The
+    class is cached, so it's only built once per distinct query shape.
+    '''
+
+    seen = set(RESERVED_NAMES)
+    fieldnames: List[str] = []
+    for colname in colnames:
+        while colname in seen:
             colname += '_'
-        colnames.append(colname)
+        seen.add(colname)
+        fieldnames.append(colname)
+    return namedtuple(name, fieldnames)
+
 
-    Result = namedtuple(name, colnames)  # type: ignore
-    return [Result(*r) for r in cursor.fetchall()]  # type: ignore
+def _row_class_for_cursor(cursor, name: str):
+    return get_row_class(name, tuple(desc[0] for desc in cursor.description))
 
 
-def friendly_execute(cursor, sql: str, name: str='Row'):
-    cursor.execute(sql)
+def friendly_fetchall(cursor, name: str):
+    make_row = _row_class_for_cursor(cursor, name)._make
+    return [make_row(r) for r in cursor.fetchall()]
+
+
+@profiling.profiled('friendly_execute')
+def friendly_execute(cursor, sql: str, name: str='Row', params: Any=None):
+    cursor.execute(sql, params)
     return friendly_fetchall(cursor, name=name)
 
 
-def get_count(cursor, sql) -> int:
-    cursor.execute(f"SELECT COUNT(*) {sql}")
-    return cursor.fetchone()[0]
+def friendly_iter(conn, sql: str, name: str='Row', params: Any=None,
+                  itersize: int=ITERSIZE) -> Iterator[Any]:
+    '''
+    Like friendly_execute(), but lazily yields rows from a server-side
+    cursor, fetching them from the database `itersize` at a time,
+    so that huge result sets don't need to fit in memory.
+    '''
+
+    with conn.cursor(name=f"friendly_iter_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = itersize
+        cursor.execute(sql, params)
+        rows = cursor.fetchmany(itersize)
+        if not rows:
+            return
+        # Server-side cursors only have a description once we've
+        # fetched from them.
+        make_row = _row_class_for_cursor(cursor, name)._make
+        while rows:
+            yield from map(make_row, rows)
+            rows = cursor.fetchmany(itersize)
+
+
+class HPDViolation(NamedTuple):
+    inspectiondate: Any
+    novdescription: Optional[str]
+
+
+class DOBViolation(NamedTuple):
+    issuedate: Any
+    description: Optional[str]
+
+
+class PlutoInfo(NamedTuple):
+    bbl: str
+    numfloors: Any
+    yearbuilt: Optional[int]
+
+
+class ACRISDocument(NamedTuple):
+    documentid: str
+    docdate: Any
+    recordedfiled: Any
+    doctype: Optional[str]
+    docamount: Any
+    pcttransferred: Any
+
+
+class ACRISParty(NamedTuple):
+    documentid: str
+    name: Optional[str]
+    address1: Optional[str]
+    address2: Optional[str]
+    city: Optional[str]
+    state: Optional[str]
+    country: Optional[str]
+
+
+# The maximum number of HPD and DOB violations to include in a report.
+MAX_VIOLATIONS = 10
+
+# Fetches the violation counts, the most recent violations and the
+# PLUTO info for a list of BBLs in a single round trip. Each row is
+# tagged with its source and BBL; the violation counts are computed
+# by a window function over all of a BBL's violations before the
+# top violations are picked, so every violation row carries the
+# total for its source.
+#
+# NYC-DB's bbl columns are char(10), so we cast the parameter to
+# match them, which lets Postgres use their indexes.
+VIOLATIONS_AND_PLUTO_SQL = f"""
+SELECT * FROM (
+    SELECT 'hpd' AS source, bbl,
+           ROW_NUMBER() OVER (PARTITION BY bbl ORDER BY inspectiondate DESC) AS rank,
+           COUNT(*) OVER (PARTITION BY bbl) AS total,
+           inspectiondate AS date, novdescription AS description,
+           NULL::numeric AS numfloors, NULL::integer AS yearbuilt
+    FROM hpd_violations
+    WHERE bbl = ANY(%(bbls)s::char(10)[])
+    UNION ALL
+    SELECT 'dob', bbl,
+           ROW_NUMBER() OVER (PARTITION BY bbl ORDER BY issuedate DESC),
+           COUNT(*) OVER (PARTITION BY bbl),
+           issuedate, description, NULL, NULL
+    FROM dob_violations
+    WHERE bbl = ANY(%(bbls)s::char(10)[])
+    UNION ALL
+    SELECT 'pluto', bbl, ROW_NUMBER() OVER (PARTITION BY bbl), NULL,
+           NULL, NULL, numfloors, yearbuilt
+    FROM pluto_18v1
+    WHERE bbl = ANY(%(bbls)s::char(10)[])
+) AS report
+WHERE rank <= {MAX_VIOLATIONS} OR source = 'pluto'
+ORDER BY bbl, source, rank
+"""
+
+# Fetches every ACRIS document for a list of BBLs along with its
+# parties, one row per party (or a single row with NULL party
+# columns if the document has no parties).
+#
+# A document can have several identical real_property_legals rows
+# for the same BBL. These are collapsed with DISTINCT, so each
+# document is reported once per BBL, rather than once per legals row
+# as reports used to, and its parties aren't repeated.
+DOCUMENTS_AND_PARTIES_SQL = """
+SELECT rpl.bbl, rpm.documentid, rpm.docdate, rpm.recordedfiled, rpm.doctype,
+       rpm.docamount, rpm.pcttransferred,
+       rpp.documentid, rpp.name, rpp.address1, rpp.address2, rpp.city,
+       rpp.state, rpp.country
+FROM (
+    SELECT DISTINCT bbl, documentid FROM real_property_legals
+    WHERE bbl = ANY(%(bbls)s::char(10)[])
+) AS rpl
+JOIN real_property_master AS rpm ON rpm.documentid = rpl.documentid
+LEFT JOIN real_property_parties AS rpp ON rpp.documentid = rpm.documentid
+ORDER BY rpl.bbl, rpm.recordedfiled, rpm.documentid
+"""
+
+# The queries that make up a BBL report, by name. They are all
+# parameterized by a list of BBLs.
+REPORT_QUERIES = {
+    'violations_and_pluto': VIOLATIONS_AND_PLUTO_SQL,
+    'documents_and_parties': DOCUMENTS_AND_PARTIES_SQL,
+}
+
+# The (table, column) pairs that the report queries look rows up by.
+# Each of these should be the leading column of an index for the
+# report to be fast.
+REPORT_LOOKUP_COLUMNS = [
+    ('hpd_violations', 'bbl'),
+    ('dob_violations', 'bbl'),
+    ('pluto_18v1', 'bbl'),
+    ('real_property_legals', 'bbl'),
+    ('real_property_master', 'documentid'),
+    ('real_property_parties', 'documentid'),
+]
+
+# The NYC-DB datasets that a BBL report is built from.
+REPORT_DATASETS = ['hpd_violations', 'dob_violations', 'pluto_18v1', 'acris']
+
+# The number of BBLs to build summaries for per query.
+SUMMARY_CHUNK_SIZE = 1000
+
+# The maximum number of BBLs to list per portfolio.
+MAX_PORTFOLIO_BBLS = 20
+
+
+class BBLReport(NamedTuple):
+    bbl: str
+    num_hpd_viols: int
+    num_dob_viols: int
+    hpd_viols: List[HPDViolation]
+    dob_viols: List[DOBViolation]
+    plutos: List[PlutoInfo]
+    docs: List[ACRISDocument]
+
+    # A mapping from ACRIS document IDs to their parties.
+    parties: Dict[str, List[ACRISParty]]
+
+
+@profiling.profiled('get_bbl_reports')
+def get_bbl_reports(cur, bbls: List[str]) -> Dict[str, BBLReport]:
+    '''
+    Fetches everything we know about the given BBLs in two queries,
+    projecting only the columns the report actually uses.
+
+    Cursors for storage backends other than Postgres can provide
+    their own versions of REPORT_QUERIES as a `report_queries`
+    attribute.
+    '''
+
+    queries = getattr(cur, 'report_queries', REPORT_QUERIES)
+    params = {'bbls': bbls}
+    reports = {
+        bbl: BBLReport(bbl, 0, 0, [], [], [], [], {})
+        for bbl in bbls
+    }
+    cur.execute(queries['violations_and_pluto'], params)
+    for source, bbl, _, total, date, description, numfloors, yearbuilt in cur.fetchall():
+        report = reports[bbl]
+        if source == 'hpd':
+            reports[bbl] = report._replace(num_hpd_viols=total)
+            report.hpd_viols.append(HPDViolation(date, description))
+        elif source == 'dob':
+            reports[bbl] = report._replace(num_dob_viols=total)
+            report.dob_viols.append(DOBViolation(date, description))
+        else:
+            report.plutos.append(PlutoInfo(bbl, numfloors, yearbuilt))
+
+    cur.execute(queries['documents_and_parties'], params)
+    for row in cur.fetchall():
+        report = reports[row[0]]
+        doc = ACRISDocument._make(row[1:7])
+        if doc.documentid not in report.parties:
+            report.docs.append(doc)
+            report.parties[doc.documentid] = []
+        if row[7] is not None:
+            report.parties[doc.documentid].append(ACRISParty._make(row[7:]))
+
+    return reports
+
+
+def get_bbl_report(cur, bbl: str) -> BBLReport:
+    return get_bbl_reports(cur, [bbl])[bbl]
+
+
+def bbl_report_to_summary(report: BBLReport) -> Dict[str, Any]:
+    return {
+        'num_hpd_viols': report.num_hpd_viols,
+        'num_dob_viols': report.num_dob_viols,
+        'hpd_viols': [list(v) for v in report.hpd_viols],
+        'dob_viols': [list(v) for v in report.dob_viols],
+        'plutos': [list(p) for p in report.plutos],
+        'docs': [list(d) for d in report.docs],
+        'parties': {
+            docid: [list(p) for p in parties]
+            for docid, parties in report.parties.items()
+        },
+    }
+
+
+def bbl_report_from_summary(bbl: str, summary: Dict[str, Any]) -> BBLReport:
+    return BBLReport(
+        bbl=bbl,
+        num_hpd_viols=summary['num_hpd_viols'],
+        num_dob_viols=summary['num_dob_viols'],
+        hpd_viols=[HPDViolation._make(v) for v in summary['hpd_viols']],
+        dob_viols=[DOBViolation._make(v) for v in summary['dob_viols']],
+        plutos=[PlutoInfo._make(p) for p in summary['plutos']],
+        docs=[ACRISDocument._make(d) for d in summary['docs']],
+        parties={
+            docid: [ACRISParty._make(p) for p in parties]
+            for docid, parties in summary['parties'].items()
+        }
+    )
+
+
+def open_summary_store() -> Optional[bbl_summary.BBLSummaryStore]:
+    path = os.environ.get('BBL_SUMMARY_DB')
+    if path:
+        return bbl_summary.open_store(path, REPORT_DATASETS)
+    return None
+
+
+def open_portfolio_index() -> Optional['portfolio_index.PortfolioIndex']:
+    path = os.environ.get('PORTFOLIO_INDEX')
+    if path:
+        import portfolio_index
+
+        return portfolio_index.PortfolioIndex(Path(path))
+    return None
+
+
+def get_summarized_bbl_report(summaries: Optional[bbl_summary.BBLSummaryStore],
+                              bbl: str) -> Optional[BBLReport]:
+    if summaries is None:
+        return None
+    summary = summaries.get(bbl)
+    if summary is None:
+        return None
+    return bbl_report_from_summary(bbl, summary)
+
+
+def save_bbl_report_summary(summaries: Optional[bbl_summary.BBLSummaryStore],
+                            report: BBLReport) -> None:
+    if summaries is not None:
+        summaries.put(report.bbl, bbl_report_to_summary(report))
+
+
+def build_summaries(conn, summaries: bbl_summary.BBLSummaryStore,
+                    chunk_size: int=SUMMARY_CHUNK_SIZE) -> int:
+    '''
+    Builds summaries for every BBL in PLUTO whose summary is missing
+    or stale, chunk_size BBLs at a time, and returns the number of
+    summaries built.
+    '''
+
+    built = 0
+    rows = friendly_iter(conn, "SELECT bbl FROM pluto_18v1 ORDER BY bbl", name='PlutoBBL')
+    with conn.cursor() as cur:
+        while True:
+            chunk = [row.bbl for row in itertools.islice(rows, chunk_size)]
+            if not chunk:
+                break
+            stale = summaries.stale_bbls(chunk)
+            if stale:
+                reports = get_bbl_reports(cur, stale)
+                summaries.put_many({
+                    bbl: bbl_report_to_summary(report)
+                    for bbl, report in reports.items()
+                })
+                built += len(stale)
+    return built
+
+
+def print_bbl_report(report: BBLReport) -> None:
+    print(f"The property has {report.num_hpd_viols} HPD violations and "
+          f"{report.num_dob_viols} DOB violations.")
+
+    if report.hpd_viols:
+        print("Here are some HPD violations:")
+        for hpd_viol in report.hpd_viols:
+            print(f"  * {hpd_viol.inspectiondate} {hpd_viol.novdescription}")
+
+    if report.dob_viols:
+        print("Here are some DOB violations:")
+        for dob_viol in report.dob_viols:
+            print(f"  * {dob_viol.issuedate} {dob_viol.description}")
+
+    for pluto in report.plutos:
+        print(f"The property has {pluto.numfloors} floors and was built in {pluto.yearbuilt}.")
+
+    for d in report.docs:
+        amt = f" for ${d.docamount:,} ({d.pcttransferred}% transferred)" if d.docamount else ""
+        print(
+            f"On {d.docdate or d.recordedfiled} a {d.doctype}{amt} "
+            "was signed between:"
+        )
+        for p in report.parties[d.documentid]:
+            party = " / ".join(filter(None, [
+                p.name, p.address1, p.address2, p.city, p.state,
+                p.country if p.country != "US" else None
+            ]))
+            print(f"  {party}")
+
+
+def print_portfolios(report: BBLReport, portfolios: Iterable['portfolio_index.Portfolio'],
+                     max_bbls: int=MAX_PORTFOLIO_BBLS) -> None:
+    for portfolio in portfolios:
+        others = [bbl for bbl in portfolio.bbls if bbl != report.bbl]
+        if not others:
+            continue
+        print(f"The {portfolio.kind} {portfolio.label} is associated with "
+              f"{len(others)} other properties:")
+        for bbl in others[:max_bbls]:
+            print(f"  * {bbl}")
+        if len(others) > max_bbls:
+            print(f"  ...and {len(others) - max_bbls} more.")
+
+
+def bbl_report_to_dict(report: BBLReport) -> Dict[str, Any]:
+    '''
+    Returns the JSON-serializable form of the given report, which is
+    what batch mode outputs. Its violations, PLUTO info, documents and
+    parties only have the fields of their NamedTuple types above, not
+    every column of their NYC-DB tables.
+    '''
+
+    return {
+        'bbl': report.bbl,
+        'num_hpd_violations': report.num_hpd_viols,
+        'num_dob_violations': report.num_dob_viols,
+        'hpd_violations': [v._asdict() for v in report.hpd_viols],
+        'dob_violations': [v._asdict() for v in report.dob_viols],
+        'pluto': [p._asdict() for p in report.plutos],
+        'documents': [
+            {**d._asdict(), 'parties': [p._asdict() for p in report.parties[d.documentid]]}
+            for d in report.docs
+        ],
+    }
+
+
+def get_extract_path() -> Optional[str]:
+    return os.environ.get('NYCDB_EXTRACT_DB') or None
+
+
+def connect_nycdb():
+    '''
+    Connects to the offline extract of NYC-DB if there is one, or to
+    the NYC-DB instance at DATABASE_URL otherwise.
+    '''
+
+    extract_path = get_extract_path()
+    if extract_path:
+        import nycdb_extract
+
+        return nycdb_extract.connect(extract_path)
+    return profiling.connect(os.environ['DATABASE_URL'])
+
+
+def create_pool(max_connections: int):
+    '''
+    Like connect_nycdb(), but returns a thread-safe pool of up to
+    max_connections connections.
+    '''
+
+    extract_path = get_extract_path()
+    if extract_path:
+        import nycdb_extract
+
+        return nycdb_extract.ExtractPool(extract_path)
+
+    import psycopg2.pool
+
+    return psycopg2.pool.ThreadedConnectionPool(1, max_connections, os.environ['DATABASE_URL'],
+                                                **profiling.connection_kwargs())
+
+
+Geocoder = Callable[[str], Optional[List['geocoding.Feature']]]
+
+
+def create_geocoder() -> Geocoder:
+    # The geocoder pulls in requests and pydantic, so we only import
+    # it once we know we need to geocode something.
+    import geocoding
+
+    cache_db = os.environ.get('GEOCODING_CACHE_DB')
+    if cache_db:
+        cache = geocoding.open_cache(cache_db)
+        # The cache batches up writes of access times, so make sure the
+        # last batch is written before we exit.
+        atexit.register(cache.close)
+        return cache.search
+    return geocoding.search
+
+
+def fetch_bbl_report(pool, bbl: str,
+                     summaries: Optional[bbl_summary.BBLSummaryStore]=None) -> BBLReport:
+    '''
+    Returns the report for the given BBL from the given summary
+    store if it's there, or otherwise from NYC-DB, using a connection
+    from the given connection pool (see create_pool()).
+    '''
+
+    report = get_summarized_bbl_report(summaries, bbl)
+    if report is None:
+        nycdb = pool.getconn()
+        try:
+            with nycdb.cursor() as cur:
+                report = get_bbl_report(cur, bbl)
+            nycdb.rollback()
+        except Exception:
+            pool.putconn(nycdb, close=True)
+            raise
+        pool.putconn(nycdb)
+        save_bbl_report_summary(summaries, report)
+    return report
+
+
+def lookup_address_with(address: str, geocode: Geocoder,
+                        get_report: Callable[[str], BBLReport]) -> Dict[str, Any]:
+    '''
+    Looks up the given address with the given geocoder, getting the
+    report for its BBL with get_report, and returns a JSON-serializable
+    record of the results. Any errors are reported in the record's
+    "error" key rather than raised.
+    '''
+
+    record: Dict[str, Any] = {'address': address}
+    try:
+        features = geocode(address)
+        if not features:
+            record['error'] = "Unable to find geolocation info."
+            return record
+        props = features[0].properties
+        record['label'] = props.label
+        record.update(bbl_report_to_dict(get_report(props.pad_bbl)))
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def lookup_address(pool, address: str, geocode: Optional[Geocoder]=None,
+                   summaries: Optional[bbl_summary.BBLSummaryStore]=None) -> Dict[str, Any]:
+    '''
+    Like lookup_address_with(), but gets reports using connections
+    from the given connection pool.
+    '''
+
+    import geocoding
+
+    return lookup_address_with(address, geocode or geocoding.search,
+                               lambda bbl: fetch_bbl_report(pool, bbl, summaries))
+
+
+def run_batch(pool, addresses: Iterable[str], workers: int, outfile: TextIO,
+              geocode: Optional[Geocoder]=None,
+              summaries: Optional[bbl_summary.BBLSummaryStore]=None) -> None:
+    '''
+    Looks up all the given addresses concurrently, writing one JSON
+    record per address to the given file, in input order.
+    '''
+
+    def write_record(future: Future) -> None:
+        outfile.write(json.dumps(future.result(), default=str) + "\n")
+        outfile.flush()
+
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for address in addresses:
+            pending.append(executor.submit(lookup_address, pool, address, geocode,
+                                           summaries))
+            if len(pending) >= workers * BATCH_QUEUE_FACTOR:
+                write_record(pending.popleft())
+        while pending:
+            write_record(pending.popleft())
+
+
+def read_addresses(infile: TextIO) -> Iterator[str]:
+    for line in infile:
+        address = line.strip()
+        if address:
+            yield address
+
+
+def main_batch(filename: Optional[str], workers: int):
+    pool = create_pool(workers)
+    geocode = create_geocoder()
+    summaries = open_summary_store()
+    try:
+        if filename:
+            with open(filename, encoding='utf-8') as infile:
+                run_batch(pool, read_addresses(infile), workers, sys.stdout, geocode,
+                          summaries)
+        else:
+            run_batch(pool, read_addresses(sys.stdin), workers, sys.stdout, geocode,
+                      summaries)
+    finally:
+        pool.closeall()
+
+
+def main_build_summaries(chunk_size: int):
+    summaries = open_summary_store()
+    if summaries is None:
+        print("Please set BBL_SUMMARY_DB to the path of the summary database.")
+        sys.exit(1)
+    nycdb = profiling.connect(os.environ['DATABASE_URL'])
+    built = build_summaries(nycdb, summaries, chunk_size)
+    print(f"Built {built} BBL summaries.")
 
 
 def main():
     args = docopt.docopt(__doc__)
+    dotenv.load_dotenv()
+
+    with profiling.profile(args['--profile'], args['--profile-json']):
+        run(args)
+
+
+def run(args: Dict[str, Any]):
+    if args['--batch']:
+        main_batch(args['<file>'], workers=int(args['--workers']))
+        return
+
+    if args['--build-summaries']:
+        main_build_summaries(chunk_size=int(args['--chunk-size']))
+        return
 
     address: str = args['<address>']
 
-    features = geocoding.search(address)
+    portfolios = None
+    if args['--portfolio']:
+        portfolios = open_portfolio_index()
+        if portfolios is None:
+            print("Please set PORTFOLIO_INDEX to the path of the portfolio index.")
+            sys.exit(1)
+
+    features = create_geocoder()(address)
     if not features:
         print(f"Unable to find geolocation info for '{address}'.")
         sys.exit(1)
@@ -64,65 +678,21 @@ def main():
     bbl = props.pad_bbl
     print(f"Found {props.label} (BBL {bbl}).")
 
-    nycdb = psycopg2.connect(os.environ['DATABASE_URL'])
-
-    with nycdb.cursor() as cur:
-        num_hpd_viols = get_count(cur, f"FROM hpd_violations WHERE bbl = '{bbl}'")
-        num_dob_viols = get_count(cur, f"FROM dob_violations WHERE bbl = '{bbl}'")
-        print(f"The property has {num_hpd_viols} HPD violations and {num_dob_viols} DOB violations.")
-
-        if num_hpd_viols:
-            hpd_viols = friendly_execute(
-                cur,
-                f"SELECT * FROM hpd_violations WHERE bbl = '{bbl}' ORDER BY inspectiondate DESC LIMIT 10"
-            )
-            print("Here are some HPD violations:")
-            for v in hpd_viols:
-                print(f"  * {v.inspectiondate} {v.novdescription}")
-
-        if num_dob_viols:
-            dob_viols = friendly_execute(
-                cur,
-                f"SELECT * FROM dob_violations WHERE bbl = '{bbl}' ORDER BY issuedate DESC LIMIT 10"
-            )
-            print("Here are some DOB violations:")
-            for v in dob_viols:
-                print(f"  * {v.issuedate} {v.description}")
-
-        plutos = friendly_execute(
-            cur,
-            f"SELECT * FROM pluto_18v1 WHERE bbl = '{bbl}'"
-        )
-        for pluto in plutos:
-            print(f"The property has {pluto.numfloors} floors and was built in {pluto.yearbuilt}.")
-
-        docs = friendly_execute(
-            cur,
-            f"SELECT * "
-            f"FROM real_property_legals AS rpl, real_property_master AS rpm "
-            f"WHERE rpl.bbl = '{bbl}' AND "
-            f"rpl.documentid = rpm.documentid "
-            f"ORDER BY rpm.recordedfiled",
-            name='ACRISDocument'
-        )
-        for d in docs:
-            amt = f" for ${d.docamount:,} ({d.pcttransferred}% transferred)" if d.docamount else ""
-            print(
-                f"On {d.docdate or d.recordedfiled} a {d.doctype}{amt} "
-                "was signed between:"
-            )
-            parties = friendly_execute(
-                cur,
-                f"SELECT * FROM real_property_parties as rpp "
-                f"WHERE rpp.documentid = '{d.documentid}'",
-                name='ACRISParty'
-            )
-            for p in parties:
-                party = " / ".join(filter(None, [
-                    p.name, p.address1, p.address2, p.city, p.state,
-                    p.country if p.country != "US" else None
-                ]))
-                print(f"  {party}")
+    summaries = open_summary_store()
+    report = get_summarized_bbl_report(summaries, bbl)
+    if report is None:
+        nycdb = connect_nycdb()
+        with nycdb.cursor() as cur:
+            report = get_bbl_report(cur, bbl)
+        save_bbl_report_summary(summaries, report)
+
+    with profiling.stage('print_bbl_report'):
+        print_bbl_report(report)
+
+    if portfolios is not None:
+        with profiling.stage('print_portfolios'):
+            print_portfolios(report, portfolios.find(
+                party for parties in report.parties.values() for party in parties))
 
 
 if __name__ == '__main__':
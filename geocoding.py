@@ -1,15 +1,72 @@
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, Callable, Iterable, TypeVar, TYPE_CHECKING
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import json
+import email.utils
+import time
 import logging
+import sqlite3
+import threading
 import pydantic
 import requests
+import requests.adapters
+
+import profiling
+from dbhash import AbstractDbHash, SqlDbHash
+
+if TYPE_CHECKING:
+    import address_index
+
+
+T = TypeVar('T')
 
 
 GEOCODING_SEARCH_URL = "https://geosearch.planninglabs.nyc/v1/search"
 GEOCODING_TIMEOUT = 3
 
+# The default maximum number of concurrent requests made by search_many().
+GEOCODING_CONCURRENCY = 8
+
+# The default maximum number of requests per second made by search_many().
+GEOCODING_RATE_LIMIT = 20.0
+
+# The default number of times search_many() retries a failed search.
+GEOCODING_RETRIES = 3
+
+# The default delay, in seconds, before search_many()'s first retry of
+# a failed search. It doubles with every subsequent retry.
+GEOCODING_BACKOFF = 0.5
+
+# How long, in seconds, to cache successful geocoding results.
+GEOCODING_CACHE_TTL = 60 * 60 * 24 * 30
+
+# How long, in seconds, to cache searches that had no results.
+GEOCODING_CACHE_NEGATIVE_TTL = 60 * 60 * 24
+
+# The maximum number of searches to cache.
+GEOCODING_CACHE_MAX_ENTRIES = 100_000
+
+# The maximum number of cache hits whose access times are kept in
+# memory before they're written to the cache's dbhash.
+GEOCODING_CACHE_ATIME_BATCH = 1000
+
 
 logger = logging.getLogger(__name__)
 
+_session: Optional[requests.Session] = None
+
+_session_lock = threading.Lock()
+
+# The local address index named by the ADDRESS_INDEX environment
+# variable, and its path, once it's been opened.
+_address_index: Optional['address_index.AddressIndex'] = None
+
+_address_index_path: Optional[str] = None
+
+_address_index_lock = threading.Lock()
+
 
 class FeatureGeometry(pydantic.BaseModel):
     # This is generally "Point".
@@ -49,35 +106,465 @@ class Feature(pydantic.BaseModel):
     # This is generally "Feature".
     type: str
 
-    geometry: FeatureGeometry
+    # This is None for features from the local address index (see
+    # address_index.py), which doesn't know where addresses are.
+    geometry: Optional[FeatureGeometry] = None
 
     properties: FeatureProperties
 
 
-def search(text: str) -> Optional[List[Feature]]:
+class GeocodingHTTPError(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float]=None):
+        super().__init__(f'Expected 200 response, got {status_code}')
+        self.status_code = status_code
+
+        # The number of seconds the server asked us to wait before
+        # retrying, if it sent a Retry-After header.
+        self.retry_after = retry_after
+
+    @property
+    def is_retryable(self) -> bool:
+        return self.status_code == 429 or self.status_code >= 500
+
+
+class TokenBucket:
+    '''
+    A thread-safe token bucket rate limiter that allows an average of
+    `rate` acquisitions per second, with bursts of up to `capacity`.
     '''
-    Retrieves geo search results for the given search
-    criteria. For more details, see:
 
-        https://geosearch.planninglabs.nyc/docs/#search
+    def __init__(self, rate: float, capacity: Optional[float]=None,
+                 clock: Callable[[], float]=time.monotonic,
+                 sleep: Callable[[float], None]=time.sleep):
+        self.rate = rate
+        self.capacity = max(1.0, rate) if capacity is None else capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._last = clock()
+        self._lock = threading.Lock()
 
-    If any errors occur, this function will log an
-    exception and return None.
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self.sleep(wait)
+
+
+def create_session(pool_size: int=GEOCODING_CONCURRENCY) -> requests.Session:
+    '''
+    Creates a session whose keep-alive connection pool is large enough
+    to be shared by the given number of threads.
     '''
 
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return profiling.instrument_session(session)
+
+
+def get_session() -> requests.Session:
+    '''
+    Returns a process-wide session, so that consecutive searches
+    can reuse the same connection.
+    '''
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def get_address_index() -> Optional['address_index.AddressIndex']:
+    '''
+    Returns the local address index at the path in the ADDRESS_INDEX
+    environment variable, or None if it isn't set.
+    '''
+
+    global _address_index, _address_index_path
+
+    path = os.environ.get('ADDRESS_INDEX')
+    if not path:
+        return None
+    with _address_index_lock:
+        if _address_index is None or _address_index_path != path:
+            import address_index
+
+            _address_index = address_index.AddressIndex(Path(path))
+            _address_index_path = path
+        return _address_index
+
+
+def _search_local_json(text: str) -> Optional[List[Dict[str, Any]]]:
+    index = get_address_index()
+    if index is None:
+        return None
+    return index.search_json(text)
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float]=None) -> Optional[float]:
+    '''
+    Parses the value of a Retry-After header, which is either a
+    number of seconds or an HTTP date, into a number of seconds
+    to wait. Returns None if the value is missing or malformed.
+    '''
+
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, date.timestamp() - now)
+
+
+def _fetch_features_json(text: str, session: Optional[requests.Session]=None) -> List[Dict[str, Any]]:
+    response = (session or get_session()).get(
+        GEOCODING_SEARCH_URL,
+        params={'text': text},
+        timeout=GEOCODING_TIMEOUT
+    )
+    if response.status_code != 200:
+        raise GeocodingHTTPError(response.status_code,
+                                 parse_retry_after(response.headers.get('Retry-After')))
+    return response.json()['features']
+
+
+def _search_json(text: str, session: Optional[requests.Session]=None) -> Optional[List[Dict[str, Any]]]:
     if not GEOCODING_SEARCH_URL:
         # Geocoding is disabled.
         return None
 
     try:
-        response = requests.get(
-            GEOCODING_SEARCH_URL,
-            {'text': text},
-            timeout=GEOCODING_TIMEOUT
-        )
-        if response.status_code != 200:
-            raise Exception(f'Expected 200 response, got {response.status_code}')
-        return [Feature(**kwargs) for kwargs in response.json()['features']]
+        return _fetch_features_json(text, session)
     except Exception:
         logger.exception(f'Error while retrieving data from {GEOCODING_SEARCH_URL}')
         return None
+
+
+@profiling.profiled('geocoding.search')
+def search(text: str, session: Optional[requests.Session]=None) -> Optional[List[Feature]]:
+    '''
+    Retrieves geo search results for the given search
+    criteria. For more details, see:
+
+        https://geosearch.planninglabs.nyc/docs/#search
+
+    If the ADDRESS_INDEX environment variable points at a local
+    address index (see address_index.py), it's consulted first, and
+    the remote geocoder is only used if it doesn't have a match.
+
+    If any errors occur, this function will log an
+    exception and return None.
+    '''
+
+    features = _search_local_json(text) or _search_json(text, session)
+    if features is None:
+        return None
+    return [Feature(**kwargs) for kwargs in features]
+
+
+def _search_json_with_retries(text: str, session: requests.Session,
+                              bucket: Optional[TokenBucket], retries: int,
+                              backoff: float) -> Optional[List[Dict[str, Any]]]:
+    if not GEOCODING_SEARCH_URL:
+        return None
+
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return _fetch_features_json(text, session)
+        except (requests.RequestException, GeocodingHTTPError) as e:
+            http_error = e if isinstance(e, GeocodingHTTPError) else None
+            if (http_error and not http_error.is_retryable) or attempt >= retries:
+                logger.error(f'Error while retrieving data from {GEOCODING_SEARCH_URL}',
+                             exc_info=e)
+                return None
+            delay = backoff * (2 ** attempt)
+            if http_error and http_error.retry_after is not None:
+                delay = max(delay, http_error.retry_after)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _search_many_and_parse(texts: Iterable[str],
+                           parse: Callable[[List[Dict[str, Any]]], T],
+                           concurrency: int, rate_limit: Optional[float],
+                           retries: int, backoff: float,
+                           session: Optional[requests.Session]) -> List[Optional[T]]:
+    session = session or create_session(concurrency)
+    bucket = TokenBucket(rate_limit) if rate_limit else None
+
+    def search_one(text: str) -> Optional[T]:
+        # One malformed response shouldn't throw away the results of
+        # every other search in the batch.
+        try:
+            features = _search_json_with_retries(text, session, bucket, retries, backoff)
+            return None if features is None else parse(features)
+        except Exception as e:
+            logger.error(f'Error while retrieving data from {GEOCODING_SEARCH_URL}',
+                         exc_info=e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(search_one, texts))
+
+
+def _search_many_json(texts: Iterable[str],
+                      concurrency: int=GEOCODING_CONCURRENCY,
+                      rate_limit: Optional[float]=GEOCODING_RATE_LIMIT,
+                      retries: int=GEOCODING_RETRIES,
+                      backoff: float=GEOCODING_BACKOFF,
+                      session: Optional[requests.Session]=None) -> List[Optional[List[Dict[str, Any]]]]:
+    return _search_many_and_parse(texts, lambda features: features, concurrency,
+                                  rate_limit, retries, backoff, session)
+
+
+def search_many(texts: Iterable[str],
+                concurrency: int=GEOCODING_CONCURRENCY,
+                rate_limit: Optional[float]=GEOCODING_RATE_LIMIT,
+                retries: int=GEOCODING_RETRIES,
+                backoff: float=GEOCODING_BACKOFF,
+                session: Optional[requests.Session]=None) -> List[Optional[List[Feature]]]:
+    '''
+    Like search(), but concurrently searches for all the given
+    texts, returning a list of results in the same order.
+
+    At most `concurrency` requests will be in flight at once, sharing
+    a single keep-alive session, and no more than `rate_limit`
+    requests will be made per second (on average). Network errors,
+    rate limit responses and server errors are retried up to
+    `retries` times with exponential backoff, waiting at least as
+    long as any Retry-After header asks. Any other kind of error,
+    such as a malformed response, is logged and results in None for
+    that text alone.
+    '''
+
+    return _search_many_and_parse(
+        texts,
+        lambda features: [Feature(**kwargs) for kwargs in features],
+        concurrency, rate_limit, retries, backoff, session
+    )
+
+
+def normalize_query(text: str) -> str:
+    return ' '.join(text.lower().replace(',', ' ').split())
+
+
+class GeocodingCache:
+    '''
+    A persistent read-through cache in front of search(), stored
+    in the given AbstractDbHash.
+
+    Entries are keyed on the normalized search text. Searches that
+    return no results are cached too (for a shorter amount of time),
+    but searches that fail are not. Once there are more than
+    max_entries cached searches, the least recently used ones are
+    evicted.
+
+    Access times of cache hits are kept in memory and written in
+    batches, when a search is added to the cache, when enough of them
+    pile up, or when flush() or close() is called.
+    '''
+
+    ENTRY_PREFIX = 'geocode:'
+
+    ATIME_PREFIX = 'geocode_atime:'
+
+    def __init__(self, dbhash: AbstractDbHash,
+                 ttl: float=GEOCODING_CACHE_TTL,
+                 negative_ttl: float=GEOCODING_CACHE_NEGATIVE_TTL,
+                 max_entries: int=GEOCODING_CACHE_MAX_ENTRIES,
+                 clock: Callable[[], float]=time.time,
+                 atime_batch: int=GEOCODING_CACHE_ATIME_BATCH):
+        self.dbhash = dbhash
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.atime_batch = atime_batch
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+        # A mapping from cache keys to their last access times, ordered
+        # from least to most recently used. It's lazily loaded from
+        # the dbhash the first time we need to add an entry.
+        self._lru: Optional[OrderedDict[str, float]] = None
+
+        # Access times that haven't been written to the dbhash yet, and
+        # how many times entries have been accessed since they were.
+        self._dirty_atimes: Dict[str, float] = {}
+        self._unflushed_touches = 0
+
+    def _load_lru(self) -> 'OrderedDict[str, float]':
+        if self._lru is None:
+            stored = {
+                key[len(self.ATIME_PREFIX):]: float(atime)
+                for key, atime in self.dbhash.items(self.ATIME_PREFIX)
+            }
+            stored.update(self._dirty_atimes)
+            atimes = sorted((atime, key) for key, atime in stored.items())
+            self._lru = OrderedDict((key, atime) for atime, key in atimes)
+        return self._lru
+
+    def _touch(self, key: str, now: float) -> None:
+        self._dirty_atimes[key] = now
+        if self._lru is not None:
+            self._lru[key] = now
+            self._lru.move_to_end(key)
+        self._unflushed_touches += 1
+        if self._unflushed_touches >= self.atime_batch:
+            self.flush()
+
+    def _remove(self, key: str) -> None:
+        self.dbhash.set_or_delete(self.ENTRY_PREFIX + key, None)
+        self.dbhash.set_or_delete(self.ATIME_PREFIX + key, None)
+        self._dirty_atimes.pop(key, None)
+        if self._lru is not None:
+            self._lru.pop(key, None)
+
+    def _get_fresh(self, key: str, now: float) -> Optional[List[Dict[str, Any]]]:
+        raw = self.dbhash.get(self.ENTRY_PREFIX + key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        features = entry['features']
+        ttl = self.ttl if features else self.negative_ttl
+        if now - entry['created'] > ttl:
+            self._remove(key)
+            return None
+        return features
+
+    def _put(self, key: str, features: List[Dict[str, Any]], now: float) -> None:
+        lru = self._load_lru()
+        with self.dbhash.transaction():
+            self.dbhash[self.ENTRY_PREFIX + key] = json.dumps({
+                'created': now,
+                'features': features,
+            })
+            self._touch(key, now)
+            while len(lru) > self.max_entries:
+                oldest = next(iter(lru))
+                self._remove(oldest)
+                self.evictions += 1
+            self.flush()
+
+    @profiling.profiled('geocoding.cache.search')
+    def search(self, text: str) -> Optional[List[Feature]]:
+        '''
+        Like search(), but consults the cache first (after the local
+        address index, if there is one).
+        '''
+
+        local_features = _search_local_json(text)
+        if local_features:
+            return [Feature(**kwargs) for kwargs in local_features]
+
+        key = normalize_query(text)
+        with self._lock:
+            now = self.clock()
+            features = self._get_fresh(key, now)
+            if features is not None:
+                self.hits += 1
+                self._touch(key, now)
+            else:
+                self.misses += 1
+        if features is None:
+            features = _search_json(text)
+            if features is None:
+                return None
+            with self._lock:
+                self._put(key, features, self.clock())
+        return [Feature(**kwargs) for kwargs in features]
+
+    def search_many(self, texts: Iterable[str], **kwargs) -> List[Optional[List[Feature]]]:
+        '''
+        Like search_many(), but consults the cache first. Only cache
+        misses are sent to the geocoder, once per unique normalized
+        text.
+        '''
+
+        texts = list(texts)
+        keys = [normalize_query(text) for text in texts]
+        results: Dict[str, Optional[List[Dict[str, Any]]]] = {}
+        misses: Dict[str, str] = {}
+        with self._lock:
+            now = self.clock()
+            for key, text in zip(keys, texts):
+                if key in results or key in misses:
+                    continue
+                features = self._get_fresh(key, now)
+                if features is not None:
+                    self.hits += 1
+                    self._touch(key, now)
+                    results[key] = features
+                else:
+                    self.misses += 1
+                    misses[key] = text
+        fetched = _search_many_json(misses.values(), **kwargs)
+        with self._lock, self.dbhash.transaction():
+            now = self.clock()
+            for key, features in zip(misses.keys(), fetched):
+                results[key] = features
+                if features is not None:
+                    self._put(key, features, now)
+        return [
+            None if results[key] is None else [Feature(**kw) for kw in results[key]]  # type: ignore
+            for key in keys
+        ]
+
+    def flush(self) -> None:
+        '''
+        Writes any access times that are only in memory to the dbhash,
+        in a single transaction.
+        '''
+
+        with self._lock:
+            if not self._dirty_atimes:
+                self._unflushed_touches = 0
+                return
+            with self.dbhash.transaction():
+                self.dbhash.set_many(
+                    (self.ATIME_PREFIX + key, repr(atime))
+                    for key, atime in self._dirty_atimes.items()
+                )
+            self._dirty_atimes = {}
+            self._unflushed_touches = 0
+
+    def close(self) -> None:
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def open_cache(path: str) -> GeocodingCache:
+    '''
+    Opens a geocoding cache stored in the SQLite database at the
+    given path. The cache can be shared between threads.
+    '''
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    return GeocodingCache(SqlDbHash(conn, 'geocoding_cache'))
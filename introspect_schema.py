@@ -2,11 +2,39 @@
 Output information about NYCDB's schema.
 
 Usage:
-  introspect_schema.py [--toc]
+  introspect_schema.py [--toc] [--refresh] [--force] [--profile]
+                       [--profile-json=<file>]
+  introspect_schema.py --advise-indexes [--bbl=<bbl>] [--plan-json=<file>]
+                       [--profile] [--profile-json=<file>]
 
 Options:
   -h --help                 Show this screen.
   --toc                     Add a table of contents.
+  --refresh                 Revalidate datasets.yml and the table metadata
+                            over the network, downloading only what has
+                            changed. Without this, only missing files are
+                            downloaded. Either way, the cached catalog
+                            snapshot is used if the files haven't changed
+                            since it was saved, and only tables whose
+                            metadata changed are re-rendered.
+  --force                   Ignore the cached catalog snapshot,
+                            re-introspect the database and re-render
+                            every table.
+  --advise-indexes          Instead of documenting the schema, output the
+                            CREATE INDEX statements that the landlord
+                            report queries in fun.py need but that are
+                            missing, along with a summary of how long each
+                            report query takes and which tables it scans
+                            sequentially.
+  --bbl=<bbl>               The BBL to run the report queries for when
+                            advising on indexes [default: 3002920026].
+  --plan-json=<file>        Write the full query plans and their summaries
+                            to the given file as JSON.
+  --profile                 Print a summary of where time was spent, by
+                            SQL statement, HTTP request and stage, to
+                            stderr.
+  --profile-json=<file>     Write a trace of every timed SQL statement,
+                            HTTP request and stage to the given file.
 
 Environment variables:
   DATABASE_URL              The Postgres URL to the NYC-DB instance.
@@ -14,32 +42,36 @@ Environment variables:
 
 import os
 import re
-from typing import Dict, Any, NamedTuple, List, Optional, Callable
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, NamedTuple, List, Optional, Callable, Tuple
 from pathlib import Path
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from enum import Enum
 import textwrap
 import json
 import dotenv
 import docopt
-import requests
-import yaml
-import psycopg2
 
-dotenv.load_dotenv()
+import lastmod
+import downloader
+import fun
+import nycdb_data
+import profiling
 
 
-MY_DIR = Path(__file__).parent.resolve()
+API_VIEW_REGEX = re.compile(r"^(https:\/\/data\.cityofnewyork\.us\/api\/views\/[0-9A-Za-z\-]+)")
+API_VIEW_SOURCE = 'the City of New York API metadata'
 
-DATA_DIR = MY_DIR / 'data'
-DATA_DIR.mkdir(parents=True, exist_ok=True)
+# The number of metadata files to download concurrently.
+METADATA_WORKERS = 8
 
-DATASETS_YML = DATA_DIR / "datasets.yml"
+# Where we cache the catalog and its rendered documentation between runs.
+SCHEMA_SNAPSHOT = nycdb_data.DATA_DIR / "schema_snapshot.json"
 
-DATASETS_YML_URL = "https://raw.githubusercontent.com/aepyornis/nyc-db/master/src/nycdb/datasets.yml"
 
-API_VIEW_REGEX = re.compile(r"^(https:\/\/data\.cityofnewyork\.us\/api\/views\/[0-9A-Za-z\-]+)")
-API_VIEW_SOURCE = 'the City of New York API metadata'
+logger = logging.getLogger(__name__)
 
 
 class DataType(Enum):
@@ -97,17 +129,6 @@ def wrap(text: str, initial_indent: str='', subsequent_indent: Optional[str]=Non
     )
 
 
-def download(url: str, dest: Path):
-    print(f"Downloading {url}.")
-    dest.write_bytes(requests.get(url).content)
-
-
-def download_datasets_yml() -> Dict[str, Any]:
-    if not DATASETS_YML.exists():
-        download(DATASETS_YML_URL, DATASETS_YML)
-    return yaml.load(DATASETS_YML.read_text())
-
-
 def clean_description(desc: str) -> str:
     desc = desc.strip()
     if desc and not desc.endswith('.'):
@@ -115,72 +136,156 @@ def clean_description(desc: str) -> str:
     return desc
 
 
-def download_table_metadata(datasets_yml: Dict[str, Any]) -> Dict[str, TableMeta]:
-    all_tables: Dict[str, TableMeta] = {}
+class TableMetadataFile(NamedTuple):
+    dataset: str
+    table_name: str
+    url: str
+    path: Path
+
+
+def get_table_metadata_files(datasets_yml: Dict[str, Any]) -> List[TableMetadataFile]:
+    files: List[TableMetadataFile] = []
     for dataset_name, dataset in datasets_yml.items():
         for fileinfo in dataset['files']:
-            url = fileinfo['url']
             stem = Path(fileinfo['dest']).stem
-            match = API_VIEW_REGEX.match(url)
+            match = API_VIEW_REGEX.match(fileinfo['url'])
             if match:
-                meta_url = match.group(1)
-                metafile = DATA_DIR / f"{stem}.json"
-                if not metafile.exists():
-                    download(meta_url, metafile)
-                meta = json.loads(metafile.read_text(encoding='utf-8'))
-                columns: Dict[str, ColumnMeta] = {}
-                for colmeta in meta['columns']:
-                    field_name = colmeta['fieldName']
-                    columns[field_name] = ColumnMeta(
-                        field_name,
-                        verbose_name=colmeta['name'],
-                        description=clean_description(colmeta.get('description', ''))
-                    )
-                table = TableMeta(
-                    stem,
-                    verbose_name=meta['name'],
-                    description=clean_description(meta['description']),
-                    description_source=API_VIEW_SOURCE,
+                files.append(TableMetadataFile(
                     dataset=dataset_name,
-                    columns=columns
-                )
-                all_tables[table.name] = table
-    return all_tables
+                    table_name=stem,
+                    url=match.group(1),
+                    path=nycdb_data.DATA_DIR / f"{stem}.json"
+                ))
+    return files
+
+
+def refresh_table_metadata_files(files: List[TableMetadataFile],
+                                 lm: lastmod.Lastmod,
+                                 workers: int=METADATA_WORKERS) -> None:
+    '''
+    Concurrently downloads any of the given metadata files that are
+    missing or have changed since we last downloaded them.
+
+    If a file can't be revalidated but we already have a copy of it,
+    the copy is used.
+    '''
+
+    import requests
+    import requests.adapters
+
+    lminfos = lm.get_infos(f.url for f in files)
+    session = profiling.instrument_session(requests.Session())
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    def refresh(f: TableMetadataFile) -> Optional[lastmod.LastmodInfo]:
+        lminfo = lminfos[f.url]
+        headers: Dict[str, str] = {}
+        if f.path.exists():
+            if lminfo.etag:
+                headers['If-None-Match'] = lminfo.etag
+            if lminfo.last_modified:
+                headers['If-Modified-Since'] = lminfo.last_modified
+        try:
+            result = downloader.download(f.url, f.path, session, headers)
+        except Exception:
+            if not f.path.exists():
+                raise
+            logger.exception(f"Unable to revalidate {f.url}, using cached copy.")
+            return None
+        if result is None:
+            return None
+        print(f"Downloaded {f.url}.")
+        return lastmod.LastmodInfo(
+            url=f.url,
+            etag=result.etag,
+            last_modified=result.last_modified,
+            size=result.size,
+            sha256=result.sha256
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        new_lminfos = list(executor.map(refresh, files))
+    lm.set_infos(info for info in new_lminfos if info is not None)
+
 
+def load_table_metadata_file(f: TableMetadataFile) -> TableMeta:
+    meta = json.loads(f.path.read_text(encoding='utf-8'))
+    columns: Dict[str, ColumnMeta] = {}
+    for colmeta in meta['columns']:
+        field_name = colmeta['fieldName']
+        columns[field_name] = ColumnMeta(
+            field_name,
+            verbose_name=colmeta['name'],
+            description=clean_description(colmeta.get('description', ''))
+        )
+    return TableMeta(
+        f.table_name,
+        verbose_name=meta['name'],
+        description=clean_description(meta['description']),
+        description_source=API_VIEW_SOURCE,
+        dataset=f.dataset,
+        columns=columns
+    )
 
+
+# Retrieves details about every column of every table in a schema,
+# resolving the element types of arrays and the base types of domains,
+# in a single pass over the system catalogs. The results mirror what
+# information_schema.columns and information_schema.element_types
+# would report, but are much faster to retrieve.
+CATALOG_COLUMNS_SQL = """
+SELECT c.relname, a.attname, NOT a.attnotnull,
+       CASE WHEN bt.typcategory = 'A' THEN 'ARRAY' ELSE format_type(bt.oid, NULL) END,
+       CASE WHEN bt.typcategory = 'A' THEN format_type(bt.typelem, NULL) END,
+       CASE
+           WHEN bt.oid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype) THEN 0
+           WHEN bt.oid = 'numeric'::regtype AND a.atttypmod <> -1
+               THEN (a.atttypmod - 4) & 65535
+       END,
+       CASE
+           WHEN bt.oid IN ('bpchar'::regtype, 'varchar'::regtype) AND a.atttypmod <> -1
+               THEN a.atttypmod - 4
+       END
+FROM pg_catalog.pg_attribute AS a
+JOIN pg_catalog.pg_class AS c ON c.oid = a.attrelid
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_type AS t ON t.oid = a.atttypid
+JOIN pg_catalog.pg_type AS bt
+    ON bt.oid = CASE WHEN t.typtype = 'd' THEN t.typbasetype ELSE t.oid END
+WHERE n.nspname = %s AND
+      c.relkind IN ('r', 'v', 'f', 'p') AND
+      a.attnum > 0 AND
+      NOT a.attisdropped
+ORDER BY c.relname, a.attnum
+"""
+
+
+def populate_table_metadata_from_catalog_rows(tables: Dict[str, TableMeta], rows):
+    for (table_name, column_name, is_nullable, data_type, element_type,
+         numeric_scale, character_maximum_length) in rows:
+        if table_name not in tables:
+            tables[table_name] = TableMeta(table_name)
+        table = tables[table_name]
+        table.is_in_db_schema = True
+        if column_name not in table.columns:
+            table.columns[column_name] = ColumnMeta(column_name)
+        column = table.columns[column_name]
+        column.is_nullable = is_nullable
+        column.numeric_scale = numeric_scale
+        column.character_maximum_length = character_maximum_length
+        column.data_type = DataType(data_type)
+        if column.data_type == DataType.array:
+            column.data_subtype = DataType(element_type)
+        column.is_in_db_schema = True
+
+
+@profiling.profiled('introspect_schema')
 def introspect_schema_and_populate_table_metadata(tables: Dict[str, TableMeta]):
-    nycdb = psycopg2.connect(os.environ['DATABASE_URL'])
+    nycdb = profiling.connect(os.environ['DATABASE_URL'])
     table_schema = "public"
     with nycdb.cursor() as cur:
-        cur.execute(
-            f"SELECT table_name, column_name, is_nullable, data_type, dtd_identifier, "
-            f"numeric_scale, character_maximum_length "
-            f"FROM information_schema.columns "
-            f"WHERE table_schema = '{table_schema}' "
-            f"ORDER BY table_name, ordinal_position"
-        )
-        for (table_name, column_name, is_nullable, data_type, dtd_identifier,
-             numeric_scale, character_maximum_length) in cur.fetchall():
-            if table_name not in tables:
-                tables[table_name] = TableMeta(table_name)
-            table = tables[table_name]
-            table.is_in_db_schema = True
-            if column_name not in table.columns:
-                table.columns[column_name] = ColumnMeta(column_name)
-            column = table.columns[column_name]
-            column.is_nullable = True if is_nullable == 'YES' else False
-            column.numeric_scale = numeric_scale
-            column.character_maximum_length = character_maximum_length
-            column.data_type = DataType(data_type)
-            if column.data_type == DataType.array:
-                cur.execute(f"SELECT data_type FROM information_schema.element_types AS e "
-                            f"WHERE e.object_schema = '{table_schema}' AND "
-                            f"e.object_name = '{table_name}' AND "
-                            f"e.object_type = 'TABLE' AND "
-                            f"e.collection_type_identifier = '{dtd_identifier}'")
-                array_type = DataType(cur.fetchone()[0])
-                column.data_subtype = array_type
-            column.is_in_db_schema = True
+        cur.execute(CATALOG_COLUMNS_SQL, (table_schema,))
+        populate_table_metadata_from_catalog_rows(tables, cur.fetchall())
 
     for table_name, table in list(tables.items()):
         if not table.is_in_db_schema:
@@ -216,13 +321,57 @@ def slugify(value: str) -> str:
     return value.lower().replace(' ', '-').replace('`', '')
 
 
-def document_datasets(datasets: List[DatasetMeta], show_toc: bool=True):
+def dataset_title(dataset: DatasetMeta) -> str:
+    return f"The `{dataset.name}` dataset"
+
+
+def table_title(table: TableMeta) -> str:
+    return f"The `{table.name}` table"
+
+
+def render_table(table: TableMeta) -> str:
+    '''
+    Returns the Markdown documentation for the given table.
+    '''
+
+    lines = [f"\n### {table_title(table)}"]
+    if table.description:
+        lines.append(f"\nFrom {table.description_source}:\n")
+        lines.append(wrap(table.description, "> "))
+    lines.append(f"\nThis table has the following columns:\n")
+    for column in table.columns.values():
+        article_adj = "A" if column.is_nullable else "A required"
+        assert column.data_type is not None
+        if column.data_type == DataType.array:
+            assert column.data_subtype is not None
+            dtype = f"{column.data_subtype.value} array"
+        elif column.data_type == DataType.numeric:
+            scale = column.numeric_scale
+            dtype = "numeric integer" if scale == 0 else "numeric float"
+        elif column.data_type == DataType.character:
+            maxlen = column.character_maximum_length
+            assert maxlen is not None
+            dtype = f"{maxlen}-character"
+        else:
+            dtype = column.data_type.value
+        lines.append(wrap(
+            f"* `{column.name}` - {article_adj} {dtype} value.\n",
+            "  ",
+            "    "
+        ))
+        if column.description:
+            desc = wrap(column.description, "    > ")
+            lines.append(f"\n{desc}\n")
+    return "\n".join(lines)
+
+
+@profiling.profiled('document_datasets')
+def document_datasets(datasets: List[DatasetMeta], show_toc: bool=True,
+                      render: Callable[[TableMeta], str]=render_table):
     print("# NYC-DB schema")
     print("\nThis documentation was automatically generated by a Python script.")
     print("\nNote that unless otherwise specified, all columns are nullable.")
 
-    dataset_title: Callable[[DatasetMeta], str] = lambda d: f"The `{d.name}` dataset"
-    table_title: Callable[[TableMeta], str] = lambda t: f"The `{t.name}` table"
     toclink: Callable[[str], str] = lambda title: f"[{title}](#{slugify(title)})"
 
     if show_toc:
@@ -236,45 +385,295 @@ def document_datasets(datasets: List[DatasetMeta], show_toc: bool=True):
     for dataset in datasets:
         print(f"\n## {dataset_title(dataset)}")
         for table in dataset.tables:
-            print(f"\n### {table_title(table)}")
-            if table.description:
-                print(f"\nFrom {table.description_source}:\n")
-                print(wrap(table.description, "> "))
-            print(f"\nThis table has the following columns:\n")
-            for column in table.columns.values():
-                article_adj = "A" if column.is_nullable else "A required"
-                assert column.data_type is not None
-                if column.data_type == DataType.array:
-                    assert column.data_subtype is not None
-                    dtype = f"{column.data_subtype.value} array"
-                elif column.data_type == DataType.numeric:
-                    scale = column.numeric_scale
-                    dtype = "numeric integer" if scale == 0 else "numeric float"
-                elif column.data_type == DataType.character:
-                    maxlen = column.character_maximum_length
-                    assert maxlen is not None
-                    dtype = f"{maxlen}-character"
-                else:
-                    dtype = column.data_type.value
-                print(wrap(
-                    f"* `{column.name}` - {article_adj} {dtype} value.\n",
-                    "  ",
-                    "    "
-                ))
-                if column.description:
-                    desc = wrap(column.description, "    > ")
-                    print(f"\n{desc}\n")
+            print(render(table))
+
+
+def fingerprint(value: Any) -> str:
+    '''
+    Returns a hash of the given JSON-serializable value.
+    '''
+
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def table_meta_to_dict(table: TableMeta) -> Dict[str, Any]:
+    d = asdict(table)
+    for column in d['columns'].values():
+        for key in ['data_type', 'data_subtype']:
+            if column[key] is not None:
+                column[key] = column[key].value
+    return d
+
+
+def table_meta_from_dict(d: Dict[str, Any]) -> TableMeta:
+    columns: Dict[str, ColumnMeta] = {}
+    for name, column in d['columns'].items():
+        column = dict(column)
+        for key in ['data_type', 'data_subtype']:
+            if column[key] is not None:
+                column[key] = DataType(column[key])
+        columns[name] = ColumnMeta(**column)
+    return TableMeta(**{**d, 'columns': columns})
+
+
+class SchemaSnapshot(NamedTuple):
+    # A fingerprint of everything the catalog was built from.
+    inputs_fingerprint: str
+
+    tables: Dict[str, TableMeta]
+
+    # A mapping from table names to the fingerprints of the tables
+    # and their rendered documentation.
+    fragments: Dict[str, Tuple[str, str]]
+
+
+def load_snapshot(path: Optional[Path]=None) -> Optional[SchemaSnapshot]:
+    path = path or SCHEMA_SNAPSHOT
+    try:
+        data = json.loads(path.read_text(encoding='utf-8'))
+        return SchemaSnapshot(
+            inputs_fingerprint=data['inputs_fingerprint'],
+            tables={t['name']: table_meta_from_dict(t) for t in data['tables']},
+            fragments={name: (fp, md) for name, (fp, md) in data['fragments'].items()}
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_snapshot(snapshot: SchemaSnapshot, path: Optional[Path]=None) -> None:
+    path = path or SCHEMA_SNAPSHOT
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps({
+        'inputs_fingerprint': snapshot.inputs_fingerprint,
+        'tables': [table_meta_to_dict(t) for t in snapshot.tables.values()],
+        'fragments': snapshot.fragments,
+    }, separators=(',', ':')), encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+class CachingTableRenderer:
+    '''
+    Renders tables with render_table(), reusing previously rendered
+    documentation for any table whose fingerprint hasn't changed.
+    A table's fingerprint covers its metadata and the etag of the
+    source metadata it came from.
+    '''
+
+    def __init__(self, etags: Dict[str, Optional[str]],
+                 fragments: Dict[str, Tuple[str, str]]):
+        self.etags = etags
+        self.old_fragments = fragments
+        self.fragments: Dict[str, Tuple[str, str]] = {}
+        self.rendered = 0
+        self.reused = 0
+
+    def render(self, table: TableMeta) -> str:
+        fp = fingerprint([table_meta_to_dict(table), self.etags.get(table.name)])
+        old = self.old_fragments.get(table.name)
+        if old is not None and old[0] == fp:
+            self.reused += 1
+            markdown = old[1]
+        else:
+            self.rendered += 1
+            markdown = render_table(table)
+        self.fragments[table.name] = (fp, markdown)
+        return markdown
+
+
+def get_inputs_fingerprint(files: List[TableMetadataFile]) -> str:
+    '''
+    Returns a fingerprint of datasets.yml and all the given table
+    metadata files, without reading the metadata files.
+    '''
+
+    file_stats: List[Any] = []
+    for f in files:
+        stat = f.path.stat() if f.path.exists() else None
+        file_stats.append([str(f.path), stat and stat.st_mtime_ns, stat and stat.st_size])
+    datasets_yml_hash = hashlib.sha256(nycdb_data.DATASETS_YML.read_bytes()).hexdigest()
+    return fingerprint([datasets_yml_hash, file_stats])
+
+
+# Retrieves every ordinary table in a schema along with the leading
+# column of each of its valid, non-partial indexes (or NULL if it has
+# no such indexes).
+INDEX_LEADING_COLUMNS_SQL = """
+SELECT c.relname, a.attname
+FROM pg_catalog.pg_class AS c
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+LEFT JOIN pg_catalog.pg_index AS i
+    ON i.indrelid = c.oid AND i.indisvalid AND i.indpred IS NULL
+LEFT JOIN pg_catalog.pg_attribute AS a
+    ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+WHERE n.nspname = %s AND c.relkind IN ('r', 'p')
+"""
+
+
+class IndexAdvice(NamedTuple):
+    # The (table, column) lookups that have no index leading with
+    # the column.
+    missing: List[Tuple[str, str]]
+
+    # The tables that are looked up but don't exist at all.
+    missing_tables: List[str]
+
+
+def advise_indexes(rows, lookups: List[Tuple[str, str]]) -> IndexAdvice:
+    '''
+    Given the rows of INDEX_LEADING_COLUMNS_SQL, returns the lookups
+    that aren't served by any index.
+    '''
+
+    tables = set()
+    indexed = set()
+    for table_name, column_name in rows:
+        tables.add(table_name)
+        if column_name is not None:
+            indexed.add((table_name, column_name))
+    return IndexAdvice(
+        missing=[lookup for lookup in lookups
+                 if lookup[0] in tables and lookup not in indexed],
+        missing_tables=sorted({table for table, _ in lookups if table not in tables}),
+    )
+
+
+def create_index_sql(table_name: str, column_name: str) -> str:
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table_name}_{column_name}_idx "
+            f"ON {table_name} ({column_name});")
+
+
+class PlanSummary(NamedTuple):
+    name: str
+    planning_ms: float
+    execution_ms: float
+    shared_hit_blocks: int
+    shared_read_blocks: int
+
+    # The tables that the plan reads with a sequential scan.
+    seq_scans: List[str]
+
+
+def iter_plan_nodes(node: Dict[str, Any]):
+    yield node
+    for child in node.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+
+def summarize_plan(name: str, explain_output: List[Dict[str, Any]]) -> PlanSummary:
+    '''
+    Summarizes the output of EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON).
+    '''
+
+    result = explain_output[0]
+    plan = result['Plan']
+    return PlanSummary(
+        name=name,
+        planning_ms=result.get('Planning Time', 0.0),
+        execution_ms=result.get('Execution Time', 0.0),
+        shared_hit_blocks=plan.get('Shared Hit Blocks', 0),
+        shared_read_blocks=plan.get('Shared Read Blocks', 0),
+        seq_scans=sorted({
+            node['Relation Name'] for node in iter_plan_nodes(plan)
+            if node['Node Type'] == 'Seq Scan'
+        }),
+    )
+
+
+def explain_report_queries(cur, bbl: str) -> List[Tuple[PlanSummary, Any]]:
+    '''
+    Runs each of the report queries in fun.py for the given BBL under
+    EXPLAIN ANALYZE, returning their plan summaries and full plans.
+    '''
+
+    results: List[Tuple[PlanSummary, Any]] = []
+    for name, sql in fun.REPORT_QUERIES.items():
+        cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", {'bbls': [bbl]})
+        explain_output = cur.fetchone()[0]
+        if isinstance(explain_output, str):
+            explain_output = json.loads(explain_output)
+        results.append((summarize_plan(name, explain_output), explain_output))
+    return results
+
+
+def print_index_advice(advice: IndexAdvice, summaries: List[PlanSummary]) -> None:
+    for summary in summaries:
+        print(f"-- {summary.name}: planned in {summary.planning_ms:.2f} ms, "
+              f"executed in {summary.execution_ms:.2f} ms, "
+              f"{summary.shared_hit_blocks} buffers hit, "
+              f"{summary.shared_read_blocks} read.")
+        for table_name in summary.seq_scans:
+            print(f"-- WARNING: {summary.name} sequentially scans {table_name}.")
+    for table_name in advice.missing_tables:
+        print(f"-- WARNING: {table_name} does not exist.")
+    if not advice.missing:
+        print("-- All report lookups are indexed.")
+    for table_name, column_name in advice.missing:
+        print(create_index_sql(table_name, column_name))
+
+
+def main_advise_indexes(bbl: str, plan_json: Optional[str]):
+    nycdb = profiling.connect(os.environ['DATABASE_URL'])
+    with nycdb.cursor() as cur:
+        cur.execute(INDEX_LEADING_COLUMNS_SQL, ('public',))
+        advice = advise_indexes(cur.fetchall(), fun.REPORT_LOOKUP_COLUMNS)
+        # The report queries can't run at all if any of their tables
+        # are missing.
+        explained = [] if advice.missing_tables else explain_report_queries(cur, bbl)
+    nycdb.rollback()
+    print_index_advice(advice, [summary for summary, _ in explained])
+    if plan_json:
+        Path(plan_json).write_text(json.dumps([
+            {'summary': summary._asdict(), 'plan': plan}
+            for summary, plan in explained
+        ], indent=2))
 
 
 def main():
     args = docopt.docopt(__doc__)
-
-    datasets_yml = download_datasets_yml()
-    tables = download_table_metadata(datasets_yml)
-    introspect_schema_and_populate_table_metadata(tables)
-    populate_table_metadata_with_dataset_names(tables, datasets_yml)
+    dotenv.load_dotenv()
+
+    with profiling.profile(args['--profile'], args['--profile-json']):
+        run(args)
+
+
+def run(args: Dict[str, Any]):
+    if args['--advise-indexes']:
+        main_advise_indexes(args['--bbl'], args['--plan-json'])
+        return
+
+    refresh = args['--refresh']
+    with profiling.stage('download_datasets_yml'):
+        datasets_yml = nycdb_data.download_datasets_yml(refresh=refresh)
+    lm = nycdb_data.open_metadata_lastmod()
+    files = get_table_metadata_files(datasets_yml)
+    stale_files = files if refresh else [f for f in files if not f.path.exists()]
+    if stale_files:
+        with profiling.stage('refresh_table_metadata_files'):
+            refresh_table_metadata_files(stale_files, lm)
+    lminfos = lm.get_infos(f.url for f in files)
+    etags = {f.table_name: lminfos[f.url].etag for f in files}
+    inputs_fingerprint = get_inputs_fingerprint(files)
+
+    snapshot = None if args['--force'] else load_snapshot()
+    if snapshot is not None and snapshot.inputs_fingerprint == inputs_fingerprint:
+        tables = snapshot.tables
+    else:
+        tables = {}
+        for f in files:
+            table = load_table_metadata_file(f)
+            tables[table.name] = table
+        introspect_schema_and_populate_table_metadata(tables)
+        populate_table_metadata_with_dataset_names(tables, datasets_yml)
+
+    renderer = CachingTableRenderer(etags, {} if snapshot is None else snapshot.fragments)
     datasets = create_datasets_metadata(datasets_yml, tables)
-    document_datasets(datasets, show_toc=args['--toc'])
+    document_datasets(datasets, show_toc=args['--toc'], render=renderer.render)
+
+    if (snapshot is None or snapshot.tables is not tables or renderer.rendered or
+            len(renderer.fragments) != len(snapshot.fragments)):
+        save_snapshot(SchemaSnapshot(inputs_fingerprint, tables, renderer.fragments))
 
 
 if __name__ == '__main__':
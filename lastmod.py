@@ -1,4 +1,5 @@
-from typing import Optional, NamedTuple
+import contextlib
+from typing import Optional, NamedTuple, Iterable, Dict, List, Tuple
 
 from dbhash import AbstractDbHash
 
@@ -8,21 +9,83 @@ class LastmodInfo(NamedTuple):
     etag: Optional[str] = None
     last_modified: Optional[str] = None
 
+    # The size, in bytes, of the last download of the URL.
+    size: Optional[int] = None
+
+    # The SHA-256 hex digest of the last download of the URL.
+    sha256: Optional[str] = None
+
+
+# The prefixes of the dbhash keys that store each field of a URL's
+# LastmodInfo. The rest of each key is the URL.
+FIELD_PREFIXES = {
+    'etag': 'etag:',
+    'last_modified': 'last_modified:',
+    'size': 'size:',
+    'sha256': 'sha256:',
+}
+
 
 class Lastmod:
     def __init__(self, dbhash: AbstractDbHash):
         self.dbhash = dbhash
 
     def set_info(self, info: LastmodInfo, commit=True) -> None:
-        self.dbhash.set_or_delete(
-            f'last_modified:{info.url}', info.last_modified)
+        self.set_infos([info], commit=commit)
+
+    def set_infos(self, infos: Iterable[LastmodInfo], commit=True) -> None:
+        '''
+        Stores all the given infos in a single batch. If commit is
+        False, the caller is expected to already be in a transaction
+        of the underlying dbhash, and to commit it later.
+        '''
 
-        self.dbhash.set_or_delete(
-            f'etag:{info.url}', info.etag)
+        to_set: List[Tuple[str, str]] = []
+        to_delete: List[str] = []
+        for info in infos:
+            for field, prefix in FIELD_PREFIXES.items():
+                value = getattr(info, field)
+                key = f'{prefix}{info.url}'
+                if value is None:
+                    to_delete.append(key)
+                else:
+                    to_set.append((key, str(value)))
+        with self.dbhash.transaction() if commit else contextlib.nullcontext():
+            self.dbhash.set_many(to_set)
+            self.dbhash.delete_many(to_delete)
 
     def get_info(self, url: str) -> LastmodInfo:
-        return LastmodInfo(
-            url=url,
-            etag=self.dbhash.get(f'etag:{url}'),
-            last_modified=self.dbhash.get(f'last_modified:{url}')
+        return self.get_infos([url])[url]
+
+    def get_infos(self, urls: Iterable[str]) -> Dict[str, LastmodInfo]:
+        '''
+        Retrieves the infos for all the given URLs in a single batch.
+        '''
+
+        urls = list(urls)
+        values = self.dbhash.get_many(
+            f'{prefix}{url}' for url in urls for prefix in FIELD_PREFIXES.values()
         )
+        infos: Dict[str, LastmodInfo] = {}
+        for url in urls:
+            fields = {
+                field: values.get(f'{prefix}{url}')
+                for field, prefix in FIELD_PREFIXES.items()
+            }
+            size = fields.pop('size')
+            infos[url] = LastmodInfo(url=url, size=None if size is None else int(size),
+                                     **fields)
+        return infos
+
+    def urls(self) -> List[str]:
+        '''
+        Returns every URL that has any lastmod info, in sorted order.
+        '''
+
+        urls = set()
+        for key in self.dbhash.keys():
+            for prefix in FIELD_PREFIXES.values():
+                if key.startswith(prefix):
+                    urls.add(key[len(prefix):])
+                    break
+        return sorted(urls)
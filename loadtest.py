@@ -0,0 +1,117 @@
+"""\
+Load test a running lookup server (see server.py).
+
+Usage:
+  loadtest.py <file> [--url=<url>] [--requests=<n>] [--concurrency=<n>]
+
+Options:
+  -h --help                 Show this screen.
+  --url=<url>               The base URL of the lookup server
+                            [default: http://127.0.0.1:8000].
+  --requests=<n>            Total number of requests to make [default: 1000].
+  --concurrency=<n>         Number of requests to make at once [default: 8].
+
+The file should contain one address per line. Requests cycle through
+the addresses in order, so repeated addresses exercise the server's
+caches.
+"""
+
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+import docopt
+import requests
+
+
+class RequestResult(NamedTuple):
+    seconds: float
+
+    # The HTTP status code of the response, or None if the request failed.
+    status_code: Optional[int]
+
+    # Whether the response's JSON record reported an error.
+    error: bool
+
+
+class LoadTestResult(NamedTuple):
+    results: List[RequestResult]
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        return len(self.results) / self.seconds if self.seconds else float('inf')
+
+    @property
+    def errors(self) -> int:
+        return sum(1 for r in self.results if r.status_code != 200 or r.error)
+
+    def percentile(self, pct: float) -> float:
+        return percentile(sorted(r.seconds for r in self.results), pct)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    '''
+    Returns the given percentile of the given sorted values, using the
+    nearest-rank method.
+    '''
+
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+def make_request(url: str, address: str) -> RequestResult:
+    start = time.perf_counter()
+    try:
+        res = _get_session().get(f'{url}/lookup', params={'address': address})
+        error = res.status_code == 200 and 'error' in res.json()
+        return RequestResult(time.perf_counter() - start, res.status_code, error)
+    except requests.RequestException:
+        return RequestResult(time.perf_counter() - start, None, True)
+
+
+def run_load_test(url: str, addresses: List[str], num_requests: int,
+                  concurrency: int) -> LoadTestResult:
+    url = url.rstrip('/')
+    to_request = list(itertools.islice(itertools.cycle(addresses), num_requests))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda address: make_request(url, address), to_request))
+    return LoadTestResult(results, time.perf_counter() - start)
+
+
+def print_load_test_result(result: LoadTestResult) -> None:
+    print(f"Made {len(result.results)} requests in {result.seconds:.2f}s "
+          f"({result.throughput:,.1f} requests/sec), {result.errors} errors.")
+    for pct in [50, 90, 99]:
+        print(f"  p{pct}: {result.percentile(pct) * 1000:.1f} ms")
+    print(f"  max: {result.percentile(100) * 1000:.1f} ms")
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    with open(args['<file>'], encoding='utf-8') as f:
+        addresses = [line.strip() for line in f if line.strip()]
+    if not addresses:
+        print("The address file is empty.")
+        return
+    result = run_load_test(args['--url'], addresses, int(args['--requests']),
+                           int(args['--concurrency']))
+    print_load_test_result(result)
+
+
+if __name__ == '__main__':
+    main()
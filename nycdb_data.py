@@ -0,0 +1,46 @@
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict
+
+import dbhash
+import lastmod
+import cached_yaml
+
+
+MY_DIR = Path(__file__).parent.resolve()
+
+# Where we keep downloaded files and caches. It's only created when
+# something is about to be written to it.
+DATA_DIR = MY_DIR / 'data'
+
+DATASETS_YML = DATA_DIR / "datasets.yml"
+
+DATASETS_YML_URL = "https://raw.githubusercontent.com/aepyornis/nyc-db/master/src/nycdb/datasets.yml"
+
+# Where we keep track of the etags and last-modified dates of
+# datasets.yml and the City of New York API metadata we've downloaded.
+METADATA_LASTMOD_DB = DATA_DIR / "metadata_lastmod.db"
+
+
+def ensure_data_dir() -> Path:
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    return DATA_DIR
+
+
+def open_metadata_lastmod() -> lastmod.Lastmod:
+    ensure_data_dir()
+    conn = sqlite3.connect(str(METADATA_LASTMOD_DB))
+    return lastmod.Lastmod(dbhash.SqlDbHash(conn, 'lastmod'))
+
+
+def download_datasets_yml(refresh: bool=False) -> Dict[str, Any]:
+    '''
+    Loads datasets.yml, downloading it if we don't have it yet. If
+    refresh is True, it's revalidated against its source first.
+    '''
+
+    if refresh or not DATASETS_YML.exists():
+        ensure_data_dir()
+        if cached_yaml.refresh(DATASETS_YML, DATASETS_YML_URL, open_metadata_lastmod()):
+            print(f"Downloaded {DATASETS_YML_URL}.")
+    return cached_yaml.load(DATASETS_YML)
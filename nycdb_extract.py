@@ -0,0 +1,369 @@
+"""\
+Extract the parts of NYC-DB that landlord reports use into a SQLite
+file, so that reports can be built without access to Postgres.
+
+Usage:
+  nycdb_extract.py <file> [--chunk-size=<n>] [--profile] [--profile-json=<file>]
+
+Options:
+  -h --help                 Show this screen.
+  --chunk-size=<n>          Number of rows to insert into the extract
+                            at a time [default: 10000].
+  --profile                 Print a summary of where time was spent to
+                            stderr.
+  --profile-json=<file>     Write a trace of every timed stage to the
+                            given file.
+
+Environment variables:
+  DATABASE_URL              The Postgres URL to the NYC-DB instance.
+
+Once the extract is made, set NYCDB_EXTRACT_DB to its path to have
+fun.py and server.py build reports from it instead of DATABASE_URL.
+"""
+
+import os
+import re
+import json
+import sqlite3
+import datetime
+import threading
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import docopt
+import dotenv
+
+import fun
+import profiling
+
+
+# The default number of rows to insert into the extract at a time.
+EXTRACT_CHUNK_SIZE = 10_000
+
+
+class ExtractTable(NamedTuple):
+    name: str
+
+    # The names and kinds of the columns to extract. A kind is one of
+    # "text", "integer", "numeric" or "date". Numerics and dates are
+    # stored as the text Postgres gives us, and converted back into
+    # the Decimals and dates psycopg2 would return when queried.
+    columns: List[Tuple[str, str]]
+
+
+EXTRACT_TABLES = [
+    ExtractTable('hpd_violations', [
+        ('bbl', 'text'), ('inspectiondate', 'date'), ('novdescription', 'text'),
+    ]),
+    ExtractTable('dob_violations', [
+        ('bbl', 'text'), ('issuedate', 'date'), ('description', 'text'),
+    ]),
+    ExtractTable('pluto_18v1', [
+        ('bbl', 'text'), ('numfloors', 'numeric'), ('yearbuilt', 'integer'),
+    ]),
+    ExtractTable('real_property_legals', [
+        ('bbl', 'text'), ('documentid', 'text'),
+    ]),
+    ExtractTable('real_property_master', [
+        ('documentid', 'text'), ('docdate', 'date'), ('recordedfiled', 'date'),
+        ('doctype', 'text'), ('docamount', 'numeric'), ('pcttransferred', 'numeric'),
+    ]),
+    ExtractTable('real_property_parties', [
+        ('documentid', 'text'), ('name', 'text'), ('address1', 'text'),
+        ('address2', 'text'), ('city', 'text'), ('state', 'text'), ('country', 'text'),
+    ]),
+]
+
+# SQLite column types for each kind of column. Anything but integers
+# gets TEXT affinity, so SQLite never turns e.g. "5.50" into a float.
+SQLITE_TYPES = {
+    'text': 'TEXT',
+    'integer': 'INTEGER',
+    'numeric': 'TEXT',
+    'date': 'TEXT',
+}
+
+sqlite3.register_converter('nycdb_date', lambda b: datetime.date.fromisoformat(b.decode('ascii')))
+sqlite3.register_converter('nycdb_numeric', lambda b: Decimal(b.decode('ascii')))
+
+# These are the same as fun.VIOLATIONS_AND_PLUTO_SQL and
+# fun.DOCUMENTS_AND_PARTIES_SQL, translated to SQLite. The BBLs are
+# passed as a JSON array, and dates and numerics are converted by
+# naming their converters in their column aliases. SQLite sorts NULLs
+# in the opposite order to Postgres, so we ask for Postgres' order.
+VIOLATIONS_AND_PLUTO_SQL = f"""
+SELECT source, bbl, rank, total, date AS "date [nycdb_date]", description,
+       numfloors AS "numfloors [nycdb_numeric]", yearbuilt
+FROM (
+    SELECT 'hpd' AS source, bbl,
+           ROW_NUMBER() OVER (PARTITION BY bbl ORDER BY inspectiondate DESC NULLS FIRST) AS rank,
+           COUNT(*) OVER (PARTITION BY bbl) AS total,
+           inspectiondate AS date, novdescription AS description,
+           NULL AS numfloors, NULL AS yearbuilt
+    FROM hpd_violations
+    WHERE bbl IN (SELECT value FROM json_each(:bbls))
+    UNION ALL
+    SELECT 'dob', bbl,
+           ROW_NUMBER() OVER (PARTITION BY bbl ORDER BY issuedate DESC NULLS FIRST),
+           COUNT(*) OVER (PARTITION BY bbl),
+           issuedate, description, NULL, NULL
+    FROM dob_violations
+    WHERE bbl IN (SELECT value FROM json_each(:bbls))
+    UNION ALL
+    SELECT 'pluto', bbl, ROW_NUMBER() OVER (PARTITION BY bbl), NULL,
+           NULL, NULL, numfloors, yearbuilt
+    FROM pluto_18v1
+    WHERE bbl IN (SELECT value FROM json_each(:bbls))
+) AS report
+WHERE rank <= {fun.MAX_VIOLATIONS} OR source = 'pluto'
+ORDER BY bbl, source, rank
+"""
+
+DOCUMENTS_AND_PARTIES_SQL = """
+SELECT rpl.bbl, rpm.documentid, rpm.docdate AS "docdate [nycdb_date]",
+       rpm.recordedfiled AS "recordedfiled [nycdb_date]", rpm.doctype,
+       rpm.docamount AS "docamount [nycdb_numeric]",
+       rpm.pcttransferred AS "pcttransferred [nycdb_numeric]",
+       rpp.documentid, rpp.name, rpp.address1, rpp.address2, rpp.city,
+       rpp.state, rpp.country
+FROM (
+    SELECT DISTINCT bbl, documentid FROM real_property_legals
+    WHERE bbl IN (SELECT value FROM json_each(:bbls))
+) AS rpl
+JOIN real_property_master AS rpm ON rpm.documentid = rpl.documentid
+LEFT JOIN real_property_parties AS rpp ON rpp.documentid = rpm.documentid
+ORDER BY rpl.bbl, rpm.recordedfiled NULLS LAST, rpm.documentid
+"""
+
+REPORT_QUERIES = {
+    'violations_and_pluto': VIOLATIONS_AND_PLUTO_SQL,
+    'documents_and_parties': DOCUMENTS_AND_PARTIES_SQL,
+}
+
+# Backslash escapes in COPY's text format, other than octal and hex ones.
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+COPY_ESCAPE_RE = re.compile(r'\\(x[0-9A-Fa-f]{1,2}|[0-7]{1,3}|.)', re.DOTALL)
+
+
+def _unescape_match(match: 're.Match[str]') -> str:
+    escape = match.group(1)
+    if escape[0] == 'x':
+        return chr(int(escape[1:], 16))
+    if escape[0].isdigit():
+        return chr(int(escape, 8))
+    return COPY_ESCAPES.get(escape, escape)
+
+
+def parse_copy_field(field: bytes) -> Optional[str]:
+    if field == b'\\N':
+        return None
+    text = field.decode('utf-8')
+    if '\\' in text:
+        text = COPY_ESCAPE_RE.sub(_unescape_match, text)
+    return text
+
+
+def parse_copy_row(line: bytes) -> Tuple[Optional[str], ...]:
+    '''
+    Parses a row of the text format that Postgres' COPY outputs.
+    '''
+
+    return tuple(parse_copy_field(field) for field in line.split(b'\t'))
+
+
+class CopyLoader:
+    '''
+    A file-like object for psycopg2's copy_expert() to write the
+    output of "COPY ... TO STDOUT" to. Rows are inserted into the
+    given table of the given SQLite database chunk_size at a time, so
+    the whole table never needs to fit in memory.
+    '''
+
+    def __init__(self, db: sqlite3.Connection, table: ExtractTable,
+                 chunk_size: int=EXTRACT_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.insert_sql = (
+            f"INSERT INTO {table.name} VALUES "
+            f"({', '.join('?' for _ in table.columns)})"
+        )
+        self.rows_loaded = 0
+        self._rows: List[Tuple[Optional[str], ...]] = []
+        self._partial = b''
+
+    def write(self, data: bytes) -> int:
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        self._rows.extend(parse_copy_row(line) for line in lines)
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        self.db.executemany(self.insert_sql, self._rows)
+        self.rows_loaded += len(self._rows)
+        self._rows = []
+
+    def close(self) -> None:
+        if self._partial:
+            raise ValueError("COPY output ended in the middle of a row")
+        self.flush()
+
+
+def create_tables(db: sqlite3.Connection) -> None:
+    for table in EXTRACT_TABLES:
+        columns = ', '.join(f"{name} {SQLITE_TYPES[kind]}" for name, kind in table.columns)
+        db.execute(f"CREATE TABLE {table.name} ({columns})")
+
+
+def create_indexes(db: sqlite3.Connection) -> None:
+    for table_name, column in fun.REPORT_LOOKUP_COLUMNS:
+        db.execute(f"CREATE INDEX {table_name}_{column}_idx ON {table_name} ({column})")
+
+
+def extract_table(conn, db: sqlite3.Connection, table: ExtractTable,
+                  chunk_size: int=EXTRACT_CHUNK_SIZE) -> int:
+    '''
+    Copies the given table from NYC-DB into the given SQLite database,
+    returning the number of rows copied.
+    '''
+
+    loader = CopyLoader(db, table, chunk_size)
+    columns = ', '.join(name for name, _ in table.columns)
+    with conn.cursor() as cur:
+        cur.copy_expert(f"COPY {table.name} ({columns}) TO STDOUT", loader)
+    loader.close()
+    return loader.rows_loaded
+
+
+def extract(conn, path: Path, chunk_size: int=EXTRACT_CHUNK_SIZE) -> Dict[str, int]:
+    '''
+    Extracts everything landlord reports use from the given NYC-DB
+    connection into a SQLite database at the given path, returning
+    the number of rows copied per table. The tables are read in a
+    single snapshot, and the extract only replaces any existing file
+    once it's complete.
+    '''
+
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    counts: Dict[str, int] = {}
+    db = sqlite3.connect(str(tmp_path))
+    try:
+        # If we crash, we start over anyway, so there's no need to
+        # journal or sync as we go.
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        create_tables(db)
+        for table in EXTRACT_TABLES:
+            with profiling.stage(f'extract {table.name}'):
+                counts[table.name] = extract_table(conn, db, table, chunk_size)
+        with profiling.stage('create_indexes'):
+            create_indexes(db)
+            db.execute("ANALYZE")
+        db.commit()
+    except BaseException:
+        db.close()
+        tmp_path.unlink()
+        raise
+    finally:
+        conn.rollback()
+    db.close()
+    os.replace(tmp_path, path)
+    return counts
+
+
+class ExtractCursor(sqlite3.Cursor):
+    '''
+    A SQLite cursor that can stand in for a psycopg2 cursor when
+    building reports with fun.get_bbl_reports().
+    '''
+
+    report_queries = REPORT_QUERIES
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, sql: str, params: Any=None):
+        if isinstance(params, dict):
+            params = {
+                key: json.dumps(value) if isinstance(value, list) else value
+                for key, value in params.items()
+            }
+        return super().execute(sql, () if params is None else params)
+
+
+class ExtractConnection(sqlite3.Connection):
+    def cursor(self, factory=ExtractCursor):
+        return super().cursor(factory)
+
+
+def connect(path: str) -> ExtractConnection:
+    '''
+    Opens the extract at the given path read-only.
+    '''
+
+    if not Path(path).exists():
+        raise FileNotFoundError(f"No NYC-DB extract at {path}")
+    return sqlite3.connect(
+        f"{Path(path).resolve().as_uri()}?mode=ro",
+        uri=True,
+        detect_types=sqlite3.PARSE_COLNAMES,
+        factory=ExtractConnection,
+        check_same_thread=False
+    )
+
+
+class ExtractPool:
+    '''
+    A stand-in for a psycopg2 connection pool that gives each thread
+    its own connection to the extract at the given path.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conns: List[ExtractConnection] = []
+        self._lock = threading.Lock()
+
+    def getconn(self) -> ExtractConnection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def putconn(self, conn: ExtractConnection, close: bool=False) -> None:
+        if close:
+            self._local.conn = None
+            with self._lock:
+                self._conns.remove(conn)
+            conn.close()
+
+    def closeall(self) -> None:
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    dotenv.load_dotenv()
+
+    with profiling.profile(args['--profile'], args['--profile-json']):
+        nycdb = profiling.connect(os.environ['DATABASE_URL'])
+        counts = extract(nycdb, Path(args['<file>']), int(args['--chunk-size']))
+    for table_name, count in counts.items():
+        print(f"Extracted {count:,} rows from {table_name}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""\
+Build an index from the names and addresses of ACRIS parties to the
+BBLs of the documents they're on, so that fun.py can show what else
+a landlord owns.
+
+Usage:
+  portfolio_index.py <postings-db> <file> [--chunk-size=<n>] [--full]
+                     [--profile] [--profile-json=<file>]
+
+Options:
+  -h --help                 Show this screen.
+  --chunk-size=<n>          Number of documents to fetch parties for per
+                            query [default: 1000].
+  --full                    Forget every document we've seen and start
+                            over.
+  --profile                 Print a summary of where time was spent, by
+                            SQL statement and stage, to stderr.
+  --profile-json=<file>     Write a trace of every timed SQL statement
+                            and stage to the given file.
+
+Environment variables:
+  DATABASE_URL              The Postgres URL to the NYC-DB instance.
+
+The postings database is a SQLite file that remembers which ACRIS
+documents have been indexed, so that later runs only fetch the
+parties of documents that are new since the last run (and forget
+those that have gone away). Every run then rewrites the index file.
+
+Once the index is built, set PORTFOLIO_INDEX to its path and run
+"fun.py <address> --portfolio".
+"""
+
+import os
+import re
+import sqlite3
+import itertools
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional
+import docopt
+import dotenv
+
+import fun
+import profiling
+import address_index
+from sorted_index import SortedIndex, write_sorted_items
+
+
+# The default number of documents to fetch parties for per query.
+PORTFOLIO_CHUNK_SIZE = 1000
+
+# Fetches the ID of every ACRIS document.
+DOCUMENTIDS_SQL = "SELECT documentid FROM real_property_master"
+
+# Fetches the parties of a list of documents, along with the BBLs the
+# documents are about. Like fun.DOCUMENTS_AND_PARTIES_SQL, we cast the
+# parameter to match the char(16) documentid columns so that Postgres
+# can use their indexes.
+DOCUMENT_POSTINGS_SQL = """
+SELECT rpp.documentid, rpp.name, rpp.address1, rpp.city, rpl.bbl
+FROM real_property_parties AS rpp
+JOIN real_property_legals AS rpl ON rpl.documentid = rpp.documentid
+WHERE rpp.documentid = ANY(%(documentids)s::char(16)[])
+"""
+
+POSTINGS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS documents (documentid TEXT PRIMARY KEY) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS postings (documentid TEXT, key TEXT, bbl INTEGER)",
+    "CREATE INDEX IF NOT EXISTS postings_documentid_idx ON postings (documentid)",
+]
+
+NAME_WORDS = {
+    'COMPANY': 'CO',
+    'CORPORATION': 'CORP',
+    'INCORPORATED': 'INC',
+    'LIMITED': 'LTD',
+}
+
+NON_NAME_CHARS_RE = re.compile(r'[^A-Z0-9&]+')
+
+NAME_PREFIX = 'name:'
+
+ADDRESS_PREFIX = 'address:'
+
+
+def normalize_party_name(name: str) -> str:
+    '''
+    Normalizes the given party name, e.g. "The Boop Company, L.L.C."
+    becomes "BOOP CO LLC".
+    '''
+
+    words = NON_NAME_CHARS_RE.sub(' ', name.upper().replace('.', '')).split()
+    if words[:1] == ['THE']:
+        words = words[1:]
+    return ' '.join(NAME_WORDS.get(word, word) for word in words)
+
+
+def party_keys(name: Optional[str], address1: Optional[str],
+               city: Optional[str]) -> List[str]:
+    '''
+    Returns the keys that a party with the given name and address is
+    indexed under.
+    '''
+
+    keys = []
+    normalized_name = normalize_party_name(name or '')
+    if normalized_name:
+        keys.append(NAME_PREFIX + normalized_name)
+    normalized_address = address_index.normalize_address(address1 or '')
+    if normalized_address:
+        normalized_city = ' '.join(address_index.split_words(city or ''))
+        keys.append(f"{ADDRESS_PREFIX}{normalized_address}, {normalized_city}")
+    return keys
+
+
+class RefreshResult(NamedTuple):
+    added: int
+    removed: int
+
+
+def open_postings(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    for statement in POSTINGS_SCHEMA:
+        db.execute(statement)
+    return db
+
+
+def _add_documents(conn, db: sqlite3.Connection, documentids: List[str]) -> None:
+    with conn.cursor() as cur:
+        cur.execute(DOCUMENT_POSTINGS_SQL, {'documentids': documentids})
+        db.executemany("INSERT INTO postings VALUES (?, ?, ?)", (
+            (documentid, key, int(bbl))
+            for documentid, name, address1, city, bbl in cur.fetchall()
+            for key in party_keys(name, address1, city)
+        ))
+    db.executemany("INSERT INTO documents VALUES (?)", ((d,) for d in documentids))
+
+
+def refresh_postings(conn, db: sqlite3.Connection, chunk_size: int=PORTFOLIO_CHUNK_SIZE,
+                     full: bool=False) -> RefreshResult:
+    '''
+    Brings the given postings database up to date with the ACRIS
+    documents in the given NYC-DB connection. Documents are assumed
+    not to change once they're recorded, so only the parties of new
+    documents are fetched. Documents that have gone away have their
+    postings removed.
+    '''
+
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        if full:
+            db.execute("DELETE FROM postings")
+            db.execute("DELETE FROM documents")
+        db.execute("DROP TABLE IF EXISTS temp.latest_documents")
+        db.execute("CREATE TEMP TABLE latest_documents (documentid TEXT PRIMARY KEY) WITHOUT ROWID")
+        with profiling.stage('portfolio.list_documents'):
+            rows = fun.friendly_iter(conn, DOCUMENTIDS_SQL, name='ACRISDocumentID')
+            while True:
+                chunk = [(row.documentid,) for row in itertools.islice(rows, chunk_size)]
+                if not chunk:
+                    break
+                db.executemany("INSERT OR IGNORE INTO latest_documents VALUES (?)", chunk)
+
+        db.execute("DELETE FROM postings WHERE documentid NOT IN "
+                   "(SELECT documentid FROM latest_documents)")
+        removed = db.execute("DELETE FROM documents WHERE documentid NOT IN "
+                             "(SELECT documentid FROM latest_documents)").rowcount
+
+        # We read the new documents from a table of their own, since
+        # we'll be adding to the documents table as we go.
+        db.execute("DROP TABLE IF EXISTS temp.added_documents")
+        db.execute("CREATE TEMP TABLE added_documents AS "
+                   "SELECT documentid FROM latest_documents "
+                   "EXCEPT SELECT documentid FROM documents")
+        added = 0
+        with profiling.stage('portfolio.add_documents'):
+            new_documents = db.execute("SELECT documentid FROM added_documents")
+            while True:
+                documentids = [row[0] for row in new_documents.fetchmany(chunk_size)]
+                if not documentids:
+                    break
+                _add_documents(conn, db, documentids)
+                added += len(documentids)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        conn.rollback()
+        db.execute("DROP TABLE IF EXISTS temp.latest_documents")
+        db.execute("DROP TABLE IF EXISTS temp.added_documents")
+    return RefreshResult(added, removed)
+
+
+@profiling.profiled('portfolio.build_index')
+def build_portfolio_index(db: sqlite3.Connection, path: Path) -> int:
+    '''
+    Writes the index of the given postings database to the given
+    path, returning the number of names and addresses in it.
+    '''
+
+    rows = db.execute("SELECT DISTINCT key, bbl FROM postings ORDER BY key, bbl")
+    return write_sorted_items(path, (
+        (key, [bbl for _, bbl in group])
+        for key, group in itertools.groupby(rows, key=lambda row: row[0])
+    ))
+
+
+class Portfolio(NamedTuple):
+    # What the BBLs have in common, e.g. "BOOP LLC" or
+    # "1 MAIN ST, NEW YORK".
+    label: str
+
+    # Whether the label is a party's name or address.
+    kind: str
+
+    bbls: List[str]
+
+
+class PortfolioIndex:
+    '''
+    A memory-mapped index from normalized party names and addresses
+    to the BBLs they're associated with.
+    '''
+
+    def __init__(self, path: Path):
+        self.index = SortedIndex(path)
+
+    def find(self, parties: Iterable[fun.ACRISParty]) -> List[Portfolio]:
+        '''
+        Returns the portfolio of each distinct name and address of the
+        given parties, from the largest to the smallest.
+        '''
+
+        keys = {
+            key: None
+            for party in parties
+            for key in party_keys(party.name, party.address1, party.city)
+        }
+        portfolios = []
+        for key in keys:
+            kind, label = key.split(':', 1)
+            bbls = [f"{bbl:010d}" for bbl in self.index.get(key)]
+            portfolios.append(Portfolio(label, kind, bbls))
+        return sorted(portfolios, key=lambda p: len(p.bbls), reverse=True)
+
+    def close(self) -> None:
+        self.index.close()
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    dotenv.load_dotenv()
+
+    with profiling.profile(args['--profile'], args['--profile-json']):
+        nycdb = profiling.connect(os.environ['DATABASE_URL'])
+        db = open_postings(args['<postings-db>'])
+        result = refresh_postings(nycdb, db, int(args['--chunk-size']), args['--full'])
+        print(f"Added {result.added:,} documents and removed {result.removed:,}.")
+        count = build_portfolio_index(db, Path(args['<file>']))
+        print(f"Indexed {count:,} party names and addresses.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import sys
+import json
+import time
+import functools
+import threading
+import contextlib
+from pathlib import Path
+from typing import (
+    Any, Callable, ContextManager, Dict, Iterator, List, NamedTuple, Optional, TextIO,
+    TYPE_CHECKING)
+
+if TYPE_CHECKING:
+    import requests
+
+
+class Event(NamedTuple):
+    # What kind of thing was timed: "sql", "http" or "stage".
+    kind: str
+
+    # The SQL statement, the request's method and URL, or the stage name.
+    name: str
+
+    # When the event started, in seconds since profiling was enabled.
+    start: float
+
+    seconds: float
+
+    # The number of rows the statement returned or affected, if known.
+    rows: Optional[int] = None
+
+    # The number of bytes of SQL sent or of HTTP response body received,
+    # if known.
+    bytes: Optional[int] = None
+
+    thread: str = ''
+
+
+class SummaryRow(NamedTuple):
+    kind: str
+    name: str
+    calls: int
+    total_seconds: float
+    max_seconds: float
+    rows: int
+    bytes: int
+
+
+class Profiler:
+    '''
+    Collects timed events from any number of threads.
+    '''
+
+    def __init__(self, clock: Callable[[], float]=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.events: List[Event] = []
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, name: str, start: float, seconds: float,
+               rows: Optional[int]=None, nbytes: Optional[int]=None) -> None:
+        event = Event(kind, name, start - self.started, seconds, rows, nbytes,
+                      threading.current_thread().name)
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self) -> List[SummaryRow]:
+        '''
+        Aggregates the events by kind and name, from the most to the
+        least total time spent.
+        '''
+
+        groups: Dict[Any, List[Event]] = {}
+        with self._lock:
+            for event in self.events:
+                groups.setdefault((event.kind, event.name), []).append(event)
+        rows = [
+            SummaryRow(
+                kind=kind,
+                name=name,
+                calls=len(events),
+                total_seconds=sum(e.seconds for e in events),
+                max_seconds=max(e.seconds for e in events),
+                rows=sum(e.rows or 0 for e in events),
+                bytes=sum(e.bytes or 0 for e in events),
+            )
+            for (kind, name), events in groups.items()
+        ]
+        return sorted(rows, key=lambda row: row.total_seconds, reverse=True)
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            events = list(self.events)
+        return {
+            'events': [event._asdict() for event in events],
+            'summary': [row._asdict() for row in self.summary()],
+        }
+
+
+# The profiler that all instrumentation reports to, or None if
+# profiling is disabled (the default). Instrumented code checks this
+# once per call and does nothing else when it's None.
+_profiler: Optional[Profiler] = None
+
+
+def enable(profiler: Optional[Profiler]=None) -> Profiler:
+    global _profiler
+    _profiler = profiler or Profiler()
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    _profiler = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+class _Stage:
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+
+    def __exit__(self, *args):
+        self.profiler.record('stage', self.name, self.start,
+                             self.profiler.clock() - self.start)
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name: str) -> ContextManager:
+    '''
+    Returns a context manager that times its body as the given stage.
+    '''
+
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_STAGE
+    return _Stage(profiler, name)
+
+
+def profiled(name: str):
+    '''
+    Decorator that times every call of the decorated function as
+    the given stage.
+    '''
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return fn(*args, **kwargs)
+            with _Stage(profiler, name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _statement_name(sql: Any) -> str:
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    return ' '.join(str(sql).split())
+
+
+@functools.lru_cache(maxsize=None)
+def get_cursor_factory():
+    '''
+    Returns a psycopg2 cursor class that records how long each
+    statement takes. It's created on first use, so that merely
+    importing this module doesn't import psycopg2.
+    '''
+
+    import psycopg2.extensions
+
+    class ProfilingCursor(psycopg2.extensions.cursor):
+        def _timed(self, method, sql, params):
+            profiler = _profiler
+            if profiler is None:
+                return method(sql, params)
+            start = profiler.clock()
+            try:
+                return method(sql, params)
+            finally:
+                rows = self.rowcount if self.rowcount >= 0 else None
+                profiler.record('sql', _statement_name(sql), start, profiler.clock() - start,
+                                rows=rows, nbytes=len(self.query or b''))
+
+        def execute(self, sql, params=None):
+            return self._timed(super().execute, sql, params)
+
+        def executemany(self, sql, params):
+            return self._timed(super().executemany, sql, params)
+
+    return ProfilingCursor
+
+
+def connection_kwargs() -> Dict[str, Any]:
+    '''
+    Returns the extra keyword arguments to pass to psycopg2.connect()
+    (or a psycopg2 connection pool) so that its statements are
+    profiled, if profiling is enabled.
+    '''
+
+    if _profiler is None:
+        return {}
+    return {'cursor_factory': get_cursor_factory()}
+
+
+def connect(dsn: str):
+    import psycopg2
+
+    with stage('psycopg2.connect'):
+        return psycopg2.connect(dsn, **connection_kwargs())
+
+
+def _response_hook(response: 'requests.Response', *args, **kwargs) -> None:
+    profiler = _profiler
+    if profiler is None:
+        return
+    seconds = response.elapsed.total_seconds()
+    content_length = response.headers.get('Content-Length')
+    profiler.record(
+        'http',
+        f'{response.request.method} {response.url.split("?")[0]}',
+        profiler.clock() - seconds,
+        seconds,
+        nbytes=int(content_length) if content_length is not None else None
+    )
+
+
+def instrument_session(session: 'requests.Session') -> 'requests.Session':
+    '''
+    Makes the given session record every request it makes, if
+    profiling is enabled. Request durations are measured up to when
+    the response's headers arrive, and sizes come from the response's
+    Content-Length, so streamed bodies aren't read early.
+    '''
+
+    if _profiler is not None:
+        session.hooks['response'].append(_response_hook)
+    return session
+
+
+def print_summary(profiler: Profiler, file: Optional[TextIO]=None, max_name_len: int=60) -> None:
+    file = file or sys.stderr
+    print(f"\n{'kind':<6}{'calls':>7}{'total s':>10}{'max s':>9}{'rows':>9}{'bytes':>12}  name",
+          file=file)
+    for row in profiler.summary():
+        name = row.name if len(row.name) <= max_name_len else row.name[:max_name_len - 3] + '...'
+        print(f"{row.kind:<6}{row.calls:>7}{row.total_seconds:>10.3f}{row.max_seconds:>9.3f}"
+              f"{row.rows:>9}{row.bytes:>12}  {name}", file=file)
+
+
+@contextlib.contextmanager
+def profile(show_summary: bool, json_path: Optional[str]) -> Iterator[Optional[Profiler]]:
+    '''
+    Enables profiling for the duration of the context if either a
+    summary or a JSON trace is requested, printing the summary to
+    stderr and writing the trace to the given path when it exits.
+    '''
+
+    if not (show_summary or json_path):
+        yield None
+        return
+    profiler = enable()
+    try:
+        yield profiler
+    finally:
+        disable()
+        if show_summary:
+            print_summary(profiler)
+        if json_path:
+            Path(json_path).write_text(json.dumps(profiler.to_json(), indent=2))
@@ -0,0 +1,261 @@
+"""\
+Serve landlord lookups over HTTP, keeping database connections,
+geocoder connections and recent reports warm between requests.
+
+Usage:
+  server.py [--host=<host>] [--port=<port>] [--pool-size=<n>]
+            [--cache-ttl=<seconds>] [--cache-size=<n>]
+
+Options:
+  -h --help                 Show this screen.
+  --host=<host>             Host to listen on [default: 127.0.0.1].
+  --port=<port>             Port to listen on [default: 8000].
+  --pool-size=<n>           Maximum number of Postgres connections
+                            [default: 8].
+  --cache-ttl=<seconds>     How long to cache each BBL's report
+                            [default: 300].
+  --cache-size=<n>          Maximum number of BBL reports to cache
+                            [default: 10000].
+
+Endpoints:
+  GET /lookup?address=<address>   The same JSON record that
+                                  "fun.py --batch" outputs.
+  GET /bbl/<bbl>                  The JSON report for a BBL.
+  GET /stats                      Cache statistics.
+
+Environment variables:
+  DATABASE_URL              The Postgres URL to the NYC-DB instance.
+  GEOCODING_CACHE_DB        Optional path to a SQLite database used to
+                            cache geocoding results.
+  ADDRESS_INDEX             Optional path to a local address index made
+                            by address_index.py, which is consulted
+                            before the remote geocoder.
+  BBL_SUMMARY_DB            Optional path to a SQLite database of
+                            precomputed BBL reports.
+  NYCDB_EXTRACT_DB          Optional path to an offline extract of
+                            NYC-DB made by nycdb_extract.py, to use
+                            instead of DATABASE_URL.
+"""
+
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import Any, Callable, Dict, Generic, Optional, Tuple, TypeVar
+import docopt
+import dotenv
+
+import fun
+
+
+T = TypeVar('T')
+
+# The default number of seconds to cache each BBL's report.
+REPORT_CACHE_TTL = 300
+
+# The default maximum number of BBL reports to cache.
+REPORT_CACHE_MAX_ENTRIES = 10_000
+
+
+class TTLCache(Generic[T]):
+    '''
+    A thread-safe in-memory cache whose entries expire after ttl
+    seconds. Once there are more than max_entries entries, the least
+    recently used ones are evicted.
+    '''
+
+    def __init__(self, ttl: float, max_entries: int,
+                 clock: Callable[[], float]=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[float, T]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, record_stats: bool=True) -> Optional[T]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                if record_stats:
+                    self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            if record_stats:
+                self.misses += 1
+            return None
+
+    def set(self, key: str, value: T) -> None:
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+
+class Coalescer(Generic[T]):
+    '''
+    Makes concurrent calls for the same key share the result of a
+    single call, so that e.g. a burst of requests for the same BBL
+    only queries the database once.
+    '''
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls: Dict[str, 'Future[T]'] = {}
+        self._lock = threading.Lock()
+
+    def call(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class LookupService:
+    '''
+    Looks up addresses and BBLs, caching each BBL's report for a
+    while and coalescing concurrent lookups of the same BBL.
+    '''
+
+    def __init__(self, geocode: fun.Geocoder, fetch_report: Callable[[str], fun.BBLReport],
+                 ttl: float=REPORT_CACHE_TTL, max_entries: int=REPORT_CACHE_MAX_ENTRIES,
+                 clock: Callable[[], float]=time.monotonic):
+        self.geocode = geocode
+        self.fetch_report = fetch_report
+        self.cache: TTLCache[fun.BBLReport] = TTLCache(ttl, max_entries, clock)
+        self.coalescer: Coalescer[fun.BBLReport] = Coalescer()
+
+    def get_report(self, bbl: str) -> fun.BBLReport:
+        report = self.cache.get(bbl)
+        if report is None:
+            report = self.coalescer.call(bbl, lambda: self._fetch_and_cache(bbl))
+        return report
+
+    def _fetch_and_cache(self, bbl: str) -> fun.BBLReport:
+        # Another request may have cached the report between our
+        # cache miss and becoming the leader of this call.
+        report = self.cache.get(bbl, record_stats=False)
+        if report is None:
+            report = self.fetch_report(bbl)
+            self.cache.set(bbl, report)
+        return report
+
+    def lookup(self, address: str) -> Dict[str, Any]:
+        return fun.lookup_address_with(address, self.geocode, self.get_report)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.cache.stats(), 'coalesced': self.coalescer.coalesced}
+
+
+class LookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: LookupService):
+        super().__init__(address, LookupHandler)
+        self.service = service
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    server: LookupServer
+
+    def send_json(self, status: int, body: Any) -> None:
+        content = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path == '/lookup':
+            addresses = parse_qs(url.query).get('address')
+            if not addresses:
+                self.send_json(400, {'error': "Please provide an address."})
+                return
+            self.send_json(200, service.lookup(addresses[0]))
+        elif url.path.startswith('/bbl/'):
+            bbl = url.path[len('/bbl/'):]
+            if not (len(bbl) == 10 and bbl.isdigit()):
+                self.send_json(400, {'error': "BBLs must be 10 digits."})
+                return
+            try:
+                report = service.get_report(bbl)
+            except Exception as e:
+                self.send_json(500, {'bbl': bbl, 'error': f"{type(e).__name__}: {e}"})
+                return
+            self.send_json(200, fun.bbl_report_to_dict(report))
+        elif url.path == '/stats':
+            self.send_json(200, service.stats())
+        else:
+            self.send_json(404, {'error': "Not found."})
+
+    def log_message(self, *args):
+        pass
+
+
+def create_service(pool_size: int, ttl: float, max_entries: int) -> LookupService:
+    pool = fun.create_pool(pool_size)
+    summaries = fun.open_summary_store()
+    return LookupService(
+        geocode=fun.create_geocoder(),
+        fetch_report=lambda bbl: fun.fetch_bbl_report(pool, bbl, summaries),
+        ttl=ttl,
+        max_entries=max_entries
+    )
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    dotenv.load_dotenv()
+    service = create_service(
+        pool_size=int(args['--pool-size']),
+        ttl=float(args['--cache-ttl']),
+        max_entries=int(args['--cache-size'])
+    )
+    server = LookupServer((args['--host'], int(args['--port'])), service)
+    print(f"Serving on http://{args['--host']}:{server.server_address[1]}/.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
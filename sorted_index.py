@@ -0,0 +1,169 @@
+import os
+import sys
+import mmap
+import array
+import struct
+import bisect
+from pathlib import Path
+from typing import Iterable, Iterator, List, Mapping, Optional, Tuple
+
+
+MAGIC = b'NYCIDX1\n'
+
+# The magic number, the byte order of the arrays that follow, and the
+# number of keys and values.
+HEADER = struct.Struct('=8s1s7xQQ')
+
+BYTE_ORDERS = {'little': b'l', 'big': b'b'}
+
+
+def _padding(offset: int, alignment: int=8) -> int:
+    return -offset % alignment
+
+
+def write_sorted_items(path: Path, items: Iterable[Tuple[str, Iterable[int]]]) -> int:
+    '''
+    Writes a read-only index mapping each of the given keys to a
+    sorted array of distinct 64-bit integers, in a format that
+    SortedIndex can search without loading it into memory:
+
+      * a header (see HEADER),
+      * the offsets of each key in the key data (uint32, one more
+        than the number of keys),
+      * the offsets of each key's values (uint32, one more than the
+        number of keys),
+      * the values of every key, in key order (int64),
+      * the UTF-8 encoded keys, sorted bytewise and concatenated.
+
+    The items must already be sorted by their UTF-8 encoded keys, with
+    no key repeated, e.g. by SQLite's default collation. The arrays are
+    in native byte order. The file only replaces any existing index
+    once it's complete. Returns the number of keys written.
+    '''
+
+    key_data = bytearray()
+    key_offsets = array.array('I', [0])
+    value_offsets = array.array('I', [0])
+    values = array.array('q')
+    last_key: Optional[bytes] = None
+    for key, key_values in items:
+        encoded = key.encode('utf-8')
+        if last_key is not None and encoded <= last_key:
+            raise ValueError(f"Keys must be unique and sorted, but {key!r} is out of order")
+        last_key = encoded
+        key_data.extend(encoded)
+        key_offsets.append(len(key_data))
+        values.extend(sorted(set(key_values)))
+        value_offsets.append(len(values))
+
+    num_keys = len(key_offsets) - 1
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open('wb') as f:
+        f.write(HEADER.pack(MAGIC, BYTE_ORDERS[sys.byteorder], num_keys, len(values)))
+        f.write(key_offsets.tobytes())
+        f.write(value_offsets.tobytes())
+        f.write(b'\0' * _padding(f.tell()))
+        f.write(values.tobytes())
+        f.write(key_data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return num_keys
+
+
+def write_sorted_index(path: Path, entries: Mapping[str, Iterable[int]]) -> int:
+    '''
+    Like write_sorted_items(), but takes the keys and values in any order.
+    '''
+
+    return write_sorted_items(
+        path, sorted(entries.items(), key=lambda item: item[0].encode('utf-8')))
+
+
+class _Keys:
+    '''
+    A read-only sequence of an index's keys, as bytes, for bisect.
+    '''
+
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+
+class SortedIndex:
+    '''
+    A memory-mapped index written by write_sorted_index(). Opening it
+    takes constant time, and looking up a key takes a binary search
+    over the keys, reading only the pages it touches.
+    '''
+
+    def __init__(self, path: Path):
+        with path.open('rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, byte_order, num_keys, num_values = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a sorted index")
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError(f"{path} was written on a machine with a different byte order")
+        offset = HEADER.size
+        key_offsets = view[offset:offset + 4 * (num_keys + 1)].cast('I')
+        offset += 4 * (num_keys + 1)
+        value_offsets = view[offset:offset + 4 * (num_keys + 1)].cast('I')
+        offset += 4 * (num_keys + 1)
+        offset += _padding(offset)
+        self._values = view[offset:offset + 8 * num_values].cast('q')
+        offset += 8 * num_values
+        self._value_offsets = value_offsets
+        self._keys = _Keys(key_offsets, view[offset:])
+
+        # The mmap can only be closed once every view of it is released.
+        self._views = [view, key_offsets, value_offsets, self._values, self._keys.data]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _values_at(self, i: int) -> List[int]:
+        return self._values[self._value_offsets[i]:self._value_offsets[i + 1]].tolist()
+
+    def get(self, key: str) -> List[int]:
+        '''
+        Returns the values of the given key, or an empty list if it
+        isn't in the index.
+        '''
+
+        encoded = key.encode('utf-8')
+        i = bisect.bisect_left(self._keys, encoded)
+        if i < len(self._keys) and self._keys[i] == encoded:
+            return self._values_at(i)
+        return []
+
+    def search_prefix(self, prefix: str, limit: Optional[int]=None) -> Iterator[Tuple[str, List[int]]]:
+        '''
+        Yields the keys that start with the given prefix, and their
+        values, in sorted order, stopping after `limit` keys.
+        '''
+
+        encoded = prefix.encode('utf-8')
+        i = bisect.bisect_left(self._keys, encoded)
+        end = len(self._keys) if limit is None else min(len(self._keys), i + limit)
+        while i < end:
+            key = self._keys[i]
+            if not key.startswith(encoded):
+                return
+            yield key.decode('utf-8'), self._values_at(i)
+            i += 1
+
+    def items(self) -> Iterator[Tuple[str, List[int]]]:
+        return self.search_prefix('')
+
+    def close(self) -> None:
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
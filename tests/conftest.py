@@ -0,0 +1,28 @@
+import threading
+from socketserver import BaseServer
+from typing import List, TypeVar
+
+import pytest
+
+
+S = TypeVar('S', bound=BaseServer)
+
+
+@pytest.fixture
+def serve():
+    '''
+    Returns a function that runs the given server in the background
+    until the end of the test.
+    '''
+
+    servers: List[BaseServer] = []
+
+    def serve(server: S) -> S:
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
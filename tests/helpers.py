@@ -0,0 +1,103 @@
+'''
+Fakes shared by several test modules.
+'''
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional, Type
+
+import geocoding
+
+
+class FakeClock:
+    '''
+    A clock that only moves when the test moves it, or by `step`
+    seconds every time it's read.
+    '''
+
+    def __init__(self, now: float=0.0, step: float=0.0):
+        self.now = now
+        self.step = step
+
+    def __call__(self) -> float:
+        self.now += self.step
+        return self.now
+
+
+class FakeNamedCursor:
+    '''
+    A stand-in for a psycopg2 server-side cursor, which only has a
+    description after the first fetch.
+    '''
+
+    def __init__(self, rows: list, colnames: List[str]):
+        self.rows = rows
+        self.colnames = colnames
+        self.description: Optional[List[tuple]] = None
+        self.fetches = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        self.description = [(name,) for name in self.colnames]
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeNamedCursorConnection:
+    def __init__(self, cursor: FakeNamedCursor):
+        self._cursor = cursor
+        self.cursor_names: List[str] = []
+
+    def cursor(self, name):
+        self.cursor_names.append(name)
+        return self._cursor
+
+
+def make_feature(bbl: str='1000010001', name: str='1 MAIN STREET',
+                 postalcode: str='10001') -> geocoding.Feature:
+    '''
+    Returns a geocoder result for an address in Manhattan.
+    '''
+
+    return geocoding.Feature(
+        type='Feature',
+        geometry=geocoding.FeatureGeometry(type='Point', coordinates=[0.0, 0.0]),
+        properties=geocoding.FeatureProperties(
+            postalcode=postalcode,
+            name=name,
+            region='New York State',
+            locality='New York',
+            borough='Manhattan',
+            borough_gid='whosonfirst:borough:1',
+            label=f'{name}, Manhattan, New York, NY, USA',
+            pad_bbl=bbl,
+        )
+    )
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    '''
+    A local HTTP server listening on a free port. Use the `serve`
+    fixture to run it in the background.
+    '''
+
+    def __init__(self, handler_class: Type[BaseHTTPRequestHandler]):
+        super().__init__(('127.0.0.1', 0), handler_class)
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,83 @@
+import pytest
+
+import address_index
+from address_index import AddressIndex, AddressMatch, AddressQuery
+from .helpers import FakeNamedCursor, FakeNamedCursorConnection
+
+
+PLUTO_ROWS = [
+    ('1012687501', '666 5 AVENUE', 10103),
+    ('1000477501', '100 BROADWAY', 10005),
+    ('3001560007', '100 BROADWAY', 11211),
+    ('1012580001', '1 WEST 42 STREET', None),
+    ('1008620011', '45 EAST 10 STREET', 10003),
+    ('4015230051', '12-34 56 ROAD', '11378'),
+    ('1000010001', None, 10004),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / 'addresses.idx'
+    conn = FakeNamedCursorConnection(FakeNamedCursor(
+        [row for row in PLUTO_ROWS if row[1] is not None], ['bbl', 'address', 'zipcode']))
+    assert address_index.build_address_index(conn, path) == 5
+    index = AddressIndex(path)
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('666 Fifth Avenue', '666 5 AVE'),
+    ('666 5th ave.', '666 5 AVE'),
+    ('1 West 42nd Street', '1 W 42 ST'),
+    ('12-34 56th Rd', '12-34 56 RD'),
+])
+def test_normalize_address(text, expected):
+    assert address_index.normalize_address(text) == expected
+
+
+def test_parse_query():
+    assert address_index.parse_query('666 Fifth Avenue, Manhattan, New York, NY, USA') == \
+        AddressQuery('666 5 AVE', 1, None)
+    assert address_index.parse_query('100 Broadway, Brooklyn NY 11211') == \
+        AddressQuery('100 BROADWAY', 3, 11211)
+    assert address_index.parse_query('100 Broadway, the Bronx') == \
+        AddressQuery('100 BROADWAY', 2, None)
+    assert address_index.parse_query('20 Staten Island Blvd, Staten Island') == \
+        AddressQuery('20 STATEN ISLAND BLVD', 5, None)
+
+
+def test_search_finds_normalized_addresses(index):
+    features = index.search_json('666 fifth avenue, new york, ny')
+    assert features is not None
+    assert features[0]['properties']['pad_bbl'] == '1012687501'
+    assert features[0]['properties']['postalcode'] == '10103'
+    assert features[0]['properties']['label'] == '666 5 AVE, Manhattan, New York, NY, USA'
+    assert features[0]['properties']['borough_gid'] == 'whosonfirst:borough:1'
+    assert features[0]['geometry'] is None
+
+    features = index.search_json('12-34 56th Road')
+    assert features is not None
+    assert features[0]['properties']['pad_bbl'] == '4015230051'
+
+
+def test_search_needs_a_single_bbl(index):
+    assert index.search_json('100 Broadway') is None
+    assert index.search_json('1 Nowhere Street') is None
+
+    features = index.search_json('100 Broadway, Brooklyn')
+    assert features is not None
+    assert features[0]['properties']['pad_bbl'] == '3001560007'
+
+    features = index.search_json('100 Broadway 10005')
+    assert features is not None
+    assert features[0]['properties']['pad_bbl'] == '1000477501'
+
+
+def test_search_falls_back_to_whole_word_prefixes(index):
+    assert index.find('1 w 42') == [AddressMatch('1 W 42 ST', '1012580001', None)]
+    assert index.find('100 broad') == []
+    assert index.find('45 E 1 ST') == []
+    assert index.search_json('45 E 1 ST') is None
+    assert index.find('1') == []
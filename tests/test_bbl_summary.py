@@ -0,0 +1,48 @@
+import datetime
+from decimal import Decimal
+
+import bbl_summary
+from dbhash import DictDbHash
+
+
+def test_dumps_and_loads_preserve_types():
+    data = {
+        'amount': Decimal('1000.00'),
+        'date': datetime.date(2018, 1, 1),
+        'datetime': datetime.datetime(2018, 1, 1, 12, 30),
+        'rows': [[1, 'boop', None]],
+    }
+    assert bbl_summary.loads(bbl_summary.dumps(data)) == data
+    assert type(bbl_summary.loads(bbl_summary.dumps(data))['date']) is datetime.date
+
+
+def test_store_works():
+    store = bbl_summary.BBLSummaryStore(DictDbHash({}), ['acris', 'pluto_18v1'])
+    assert store.get('1000010001') is None
+    store.put('1000010001', {'num': 1})
+    assert store.get('1000010001') == {'num': 1}
+    assert store.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_invalidating_a_dataset_makes_its_summaries_stale():
+    dbhash = DictDbHash({})
+    store = bbl_summary.BBLSummaryStore(dbhash, ['acris', 'pluto_18v1'])
+    store.put_many({'1000010001': 1, '1000010002': 2})
+
+    bbl_summary.invalidate_datasets(dbhash, ['hpd_registrations'])
+    assert store.stale_bbls(['1000010001', '1000010002', '1000010003']) == ['1000010003']
+
+    bbl_summary.invalidate_datasets(dbhash, ['acris'])
+    assert store.get('1000010001') is None
+    assert store.stale_bbls(['1000010001', '1000010002']) == ['1000010001', '1000010002']
+
+    store.put('1000010002', 3)
+    assert store.stale_bbls(['1000010001', '1000010002']) == ['1000010001']
+    assert store.get('1000010002') == 3
+
+
+def test_open_store_works(tmp_path):
+    path = str(tmp_path / 'summaries.db')
+    bbl_summary.open_store(path, ['acris']).put('1000010001', [Decimal('1.5')])
+    bbl_summary.invalidate_datasets(bbl_summary.open_dbhash(path), ['pluto_18v1'])
+    assert bbl_summary.open_store(path, ['acris']).get('1000010001') == [Decimal('1.5')]
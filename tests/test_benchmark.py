@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import benchmark
+
+
+def make_results(**ops_per_sec):
+    return {'results': {
+        name: {'seconds': 1.0, 'ops': ops, 'ops_per_sec': ops}
+        for name, ops in ops_per_sec.items()
+    }}
+
+
+def test_compare_results_flags_regressions():
+    comparisons = benchmark.compare_results(
+        make_results(fast=1000, slow=700, new=5),
+        make_results(fast=900, slow=1000, gone=5)
+    )
+    assert [c.name for c in comparisons] == ['fast', 'slow', 'new']
+    assert [c.is_regression(0.2) for c in comparisons] == [False, True, False]
+    assert comparisons[1].change == pytest.approx(-0.3)
+    assert comparisons[2].change is None
+
+
+def test_compare_results_works_without_baseline():
+    comparisons = benchmark.compare_results(make_results(fast=1000), None)
+    assert comparisons == [benchmark.Comparison('fast', 1000, None)]
+
+
+def test_document_datasets_benchmark_works():
+    results = benchmark.benchmark_document_datasets(10)
+    assert [r.name for r in results] == ['render', 'cached']
+    assert all(r.ops == 10 for r in results)
+
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:       300 |        420 | site
+import time:        50 |         50 |     psycopg2._json
+import time:       900 |        950 |   psycopg2
+import time:       100 |       1050 | fun
+"""
+
+
+def test_parse_importtime():
+    imports = benchmark.parse_importtime(IMPORTTIME_OUTPUT)
+    assert imports[0] == benchmark.ImportTime('_io', 1, 120, 120)
+    assert imports[2] == benchmark.ImportTime('psycopg2._json', 2, 50, 50)
+
+    result = benchmark.StartupResult('fun.py', 0.1, imports)
+    assert [i.module for i in result.heaviest(5)] == ['fun', 'site']
+
+
+def test_committed_baseline_covers_the_suite():
+    baseline = json.loads((benchmark.MY_DIR / 'benchmark_baseline.json').read_text())
+    results = benchmark.results_to_json(benchmark.run_suite([1000], repeat=1))
+    comparisons = benchmark.compare_results(results, baseline)
+    assert comparisons
+    assert all(c.baseline_ops_per_sec is not None for c in comparisons)
+
+
+def test_dict_dbhash_storage_is_discarded_after_each_run():
+    factory = benchmark.DBHASH_FACTORIES[0]
+    assert factory.name == 'DictDbHash'
+    with benchmark.dbhash_dir() as path:
+        results = benchmark.benchmark_dbhash(factory, path, 10)
+        assert path in benchmark._dict_dbhash_storage
+    assert [r.name for r in results] == ['set', 'get', 'set_many', 'reopen', 'delete']
+    assert path not in benchmark._dict_dbhash_storage
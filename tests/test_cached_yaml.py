@@ -0,0 +1,105 @@
+import os
+from typing import List
+
+import pytest
+
+import cached_yaml
+import lastmod
+from dbhash import DictDbHash
+from .helpers import FakeHTTPServer, FakeHTTPHandler
+
+
+def forbid_parsing(monkeypatch):
+    def parse(text):
+        raise AssertionError('YAML should not be parsed')
+
+    monkeypatch.setattr(cached_yaml, 'parse', parse)
+
+
+def test_load_caches_parsed_yaml(monkeypatch, tmp_path):
+    path = tmp_path / 'datasets.yml'
+    path.write_text('foo:\n  files: [1, 2]\n')
+    assert cached_yaml.load(path) == {'foo': {'files': [1, 2]}}
+    assert cached_yaml.cache_path_for(path).exists()
+
+    forbid_parsing(monkeypatch)
+    assert cached_yaml.load(path) == {'foo': {'files': [1, 2]}}
+
+    # Changing the mtime without changing the content shouldn't
+    # require reparsing.
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cached_yaml.load(path) == {'foo': {'files': [1, 2]}}
+
+
+def test_load_reparses_changed_yaml(tmp_path):
+    path = tmp_path / 'datasets.yml'
+    path.write_text('foo: 1\n')
+    assert cached_yaml.load(path) == {'foo': 1}
+    path.write_text('foo: 2\nbar: 3\n')
+    assert cached_yaml.load(path) == {'foo': 2, 'bar': 3}
+
+
+def test_parse_only_loads_plain_data():
+    import yaml
+
+    with pytest.raises(yaml.YAMLError):
+        cached_yaml.parse('foo: !!python/object/apply:os.getcwd []\n')
+
+
+def test_load_ignores_corrupt_cache(tmp_path):
+    path = tmp_path / 'datasets.yml'
+    path.write_text('foo: 1\n')
+    cached_yaml.cache_path_for(path).write_text('{not json')
+    assert cached_yaml.load(path) == {'foo': 1}
+
+
+class FakeYamlServer(FakeHTTPServer):
+    def __init__(self):
+        super().__init__(FakeYamlHandler)
+        self.status_codes: List[int] = []
+        self.body = b'foo: 1\n'
+
+
+class FakeYamlHandler(FakeHTTPHandler):
+    server: FakeYamlServer
+
+    def do_GET(self):
+        etag = f'"{len(self.server.body)}"'
+        if self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        else:
+            status, body = 200, self.server.body
+        self.server.status_codes.append(status)
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def yaml_server(serve):
+    return serve(FakeYamlServer())
+
+
+def test_refresh_revalidates_with_conditional_get(yaml_server, tmp_path):
+    path = tmp_path / 'datasets.yml'
+    lm = lastmod.Lastmod(DictDbHash({}))
+    assert cached_yaml.refresh(path, yaml_server.url('/datasets.yml'), lm) is True
+    assert cached_yaml.load(path) == {'foo': 1}
+
+    assert cached_yaml.refresh(path, yaml_server.url('/datasets.yml'), lm) is False
+    assert yaml_server.status_codes == [200, 304]
+
+    yaml_server.body = b'foo: 2\nbar: 3\n'
+    assert cached_yaml.refresh(path, yaml_server.url('/datasets.yml'), lm) is True
+    assert cached_yaml.load(path) == {'foo': 2, 'bar': 3}
+
+
+def test_refresh_keeps_existing_copy_when_offline(tmp_path):
+    path = tmp_path / 'datasets.yml'
+    path.write_text('foo: 1\n')
+    lm = lastmod.Lastmod(DictDbHash({}))
+    assert cached_yaml.refresh(path, 'http://127.0.0.1:1/datasets.yml', lm) is False
+    assert cached_yaml.load(path) == {'foo': 1}
@@ -1,6 +1,33 @@
+from typing import List
+
 import pytest
 
-from dbhash import AbstractDbHash, DictDbHash, SqlDbHash
+from dbhash import (AbstractDbHash, DictDbHash, SqlDbHash, CachingDbHash, LogDbHash,
+                    prefix_upper_bound)
+
+
+class CountingDbHash(DictDbHash):
+    def __init__(self):
+        super().__init__({})
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, key):
+        self.reads += 1
+        return super().get(key)
+
+    def get_many(self, keys):
+        self.reads += 1
+        return {k: self.d[k] for k in keys if k in self.d}
+
+    def set_many(self, items):
+        self.writes += 1
+        self.d.update(items)
+
+    def delete_many(self, keys):
+        self.writes += 1
+        for key in keys:
+            self.d.pop(key, None)
 
 
 def _test_dbhash_implementation(dbh: AbstractDbHash):
@@ -33,6 +60,28 @@ def _test_dbhash_implementation(dbh: AbstractDbHash):
     dbh.set_or_delete('foo', None)
     assert 'foo' not in dbh
 
+    dbh['a:1'] = 'one'
+    dbh['a:2'] = 'two'
+    dbh['b:1'] = 'uno'
+    assert sorted(dbh.keys('a:')) == ['a:1', 'a:2']
+    assert sorted(dbh.items('b:')) == [('b:1', 'uno')]
+    assert sorted(dbh.keys()) == ['a:1', 'a:2', 'b:1']
+    for key in list(dbh.keys()):
+        del dbh[key]
+    assert list(dbh.items()) == []
+
+    dbh.set_many([('x', '1'), ('y', '2'), ('x', '3')])
+    assert dbh.get_many(['x', 'y', 'z']) == {'x': '3', 'y': '2'}
+    dbh.delete_many(['x', 'z'])
+    assert dbh.get_many(['x', 'y']) == {'y': '2'}
+
+    with dbh.transaction():
+        dbh['t'] = '1'
+        dbh.set_or_delete('y', None)
+    assert dbh.get_many(['t', 'y']) == {'t': '1'}
+    dbh.delete_many(['t'])
+    assert list(dbh.keys()) == []
+
 
 def test_sqlite_sqldbhash():
     from pathlib import Path
@@ -50,5 +99,252 @@ def test_sqlite_sqldbhash():
     dbfile.unlink()
 
 
+def test_prefix_upper_bound():
+    assert prefix_upper_bound('geocode:') == 'geocode;'
+    assert prefix_upper_bound('a\uD7FF') == 'a\uE000'
+    assert prefix_upper_bound('a\U0010FFFF') == 'b'
+    assert prefix_upper_bound('\U0010FFFF') is None
+
+
+def test_sqldbhash_prefix_scans_use_index():
+    import sqlite3
+
+    conn = sqlite3.connect(':memory:')
+    dbh = SqlDbHash(conn, 'blarg')
+    for key in ['a', 'a:', 'a:1', 'a;', 'a\U0010FFFF', 'b', '\U0010FFFF', '\U0010FFFFx']:
+        dbh[key] = 'v'
+    assert sorted(dbh.keys('a:')) == ['a:', 'a:1']
+    assert sorted(dbh.keys('a')) == ['a', 'a:', 'a:1', 'a;', 'a\U0010FFFF']
+    assert sorted(dbh.keys('\U0010FFFF')) == ['\U0010FFFF', '\U0010FFFFx']
+    assert len(list(dbh.items())) == 8
+
+    statements: List[str] = []
+    conn.set_trace_callback(statements.append)
+    list(dbh.items('a:'))
+    [plan] = conn.execute(f'EXPLAIN QUERY PLAN {statements[-1]}').fetchall()
+    assert 'USING INDEX' in plan[-1]
+
+
+def test_sqldbhash_transaction_commits_once():
+    import sqlite3
+
+    conn = sqlite3.connect(':memory:')
+    statements: List[str] = []
+    conn.set_trace_callback(statements.append)
+    dbh = SqlDbHash(conn, 'blarg')
+    statements.clear()
+
+    with dbh.transaction():
+        dbh.set_many((f'key{i}', str(i)) for i in range(100))
+        dbh['key0'] = 'zero'
+        del dbh['key1']
+    assert statements.count('COMMIT') == 1
+    assert dbh.get_many(['key0', 'key1', 'key2']) == {'key0': 'zero', 'key2': '2'}
+
+    # Make sure autocommit is turned back on.
+    statements.clear()
+    dbh['key3'] = 'three'
+    assert statements.count('COMMIT') == 1
+
+
+def test_sqldbhash_transaction_rolls_back_on_error():
+    import sqlite3
+
+    conn = sqlite3.connect(':memory:')
+    dbh = SqlDbHash(conn, 'blarg')
+    dbh['foo'] = 'bar'
+
+    with pytest.raises(ValueError):
+        with dbh.transaction():
+            dbh['foo'] = 'baz'
+            with dbh.transaction():
+                dbh['quux'] = 'blah'
+            raise ValueError()
+
+    assert dbh.get_many(['foo', 'quux']) == {'foo': 'bar'}
+
+
+def test_sqldbhash_get_many_chunks_keys():
+    import sqlite3
+
+    dbh = SqlDbHash(sqlite3.connect(':memory:'), 'blarg')
+    items = [(f'key{i}', str(i)) for i in range(2000)]
+    dbh.set_many(items)
+    assert dbh.get_many(key for key, _ in items) == dict(items)
+
+
 def test_dictdbhash():
     _test_dbhash_implementation(DictDbHash({}))
+
+
+def test_cachingdbhash_write_through():
+    _test_dbhash_implementation(CachingDbHash(DictDbHash({})))
+
+
+def test_cachingdbhash_write_back():
+    _test_dbhash_implementation(CachingDbHash(DictDbHash({}), write_back=True))
+
+
+def test_cachingdbhash_over_sqldbhash():
+    import sqlite3
+
+    dbh = CachingDbHash(SqlDbHash(sqlite3.connect(':memory:'), 'blarg'), max_entries=2)
+    _test_dbhash_implementation(dbh)
+
+
+def test_cachingdbhash_caches_negative_lookups():
+    backend = CountingDbHash()
+    dbh = CachingDbHash(backend)
+    assert 'foo' not in dbh
+    dbh.set_or_delete('foo', None)
+    with pytest.raises(KeyError):
+        del dbh['foo']
+    assert backend.reads == 1
+    assert dbh.stats() == {'hits': 2, 'misses': 1}
+
+
+def test_cachingdbhash_contains_then_del_reads_once():
+    backend = CountingDbHash()
+    backend.d['foo'] = 'bar'
+    dbh = CachingDbHash(backend)
+    if 'foo' in dbh:
+        del dbh['foo']
+    assert backend.reads == 1
+    assert backend.d == {}
+
+
+def test_cachingdbhash_write_back_defers_writes_until_flush():
+    backend = CountingDbHash()
+    dbh = CachingDbHash(backend, write_back=True)
+    for i in range(10):
+        dbh[f'key{i}'] = str(i)
+    dbh.set_or_delete('key0', None)
+    assert dbh['key1'] == '1'
+    assert backend.writes == 0
+    dbh.flush()
+    assert backend.writes == 2
+    assert backend.d == {f'key{i}': str(i) for i in range(1, 10)}
+
+
+def test_cachingdbhash_evicts_least_recently_used():
+    backend = CountingDbHash()
+    backend.d.update({'a': '1', 'b': '2', 'c': '3'})
+    dbh = CachingDbHash(backend, max_entries=2)
+    dbh.get_many(['a', 'b'])
+    dbh.get('a')
+    dbh.get('c')
+    assert backend.reads == 2
+    dbh.get('a')
+    assert backend.reads == 2
+    dbh.get('b')
+    assert backend.reads == 3
+
+
+def test_cachingdbhash_forgets_rolled_back_writes():
+    import sqlite3
+
+    dbh = CachingDbHash(SqlDbHash(sqlite3.connect(':memory:'), 'blarg'))
+    dbh['foo'] = 'bar'
+    with pytest.raises(ValueError):
+        with dbh.transaction():
+            dbh['foo'] = 'baz'
+            raise ValueError()
+    assert dbh['foo'] == 'bar'
+
+
+def test_cachingdbhash_does_not_cache_failed_writes():
+    class FailingDbHash(DictDbHash):
+        def set_many(self, items):
+            raise IOError('disk full')
+
+    backend = FailingDbHash({'foo': 'bar'})
+    dbh = CachingDbHash(backend)
+    assert dbh['foo'] == 'bar'
+    with pytest.raises(IOError):
+        dbh['foo'] = 'baz'
+    assert dbh['foo'] == 'bar'
+
+
+def test_logdbhash(tmp_path):
+    dbh = LogDbHash(tmp_path / 'log')
+    _test_dbhash_implementation(dbh)
+    dbh.close()
+
+
+def test_logdbhash_reopens_with_and_without_sidecar_index(tmp_path):
+    path = tmp_path / 'log'
+    dbh = LogDbHash(path)
+    dbh.set_many([('foo', 'bar'), ('baz', 'quux'), ('\u2603', 'snowman \u2603')])
+    del dbh['baz']
+    dbh.close()
+    assert (tmp_path / 'log.idx').exists()
+
+    dbh = LogDbHash(path)
+    dbh['after'] = 'sidecar'
+    assert dict(dbh.items()) == {'foo': 'bar', '\u2603': 'snowman \u2603', 'after': 'sidecar'}
+
+    # Simulate a crash, so that the sidecar is stale.
+    dbh._file.flush()
+    dbh = LogDbHash(path)
+    assert dict(dbh.items()) == {'foo': 'bar', '\u2603': 'snowman \u2603', 'after': 'sidecar'}
+    dbh.close()
+
+    (tmp_path / 'log.idx').unlink()
+    dbh = LogDbHash(path)
+    assert dict(dbh.items()) == {'foo': 'bar', '\u2603': 'snowman \u2603', 'after': 'sidecar'}
+    dbh.close()
+
+
+def test_logdbhash_discards_torn_final_record(tmp_path):
+    path = tmp_path / 'log'
+    dbh = LogDbHash(path)
+    dbh['foo'] = 'bar'
+    dbh['torn'] = 'a long value that will be cut off'
+    dbh._file.flush()
+    size = path.stat().st_size
+    with path.open('r+b') as f:
+        f.truncate(size - 5)
+
+    dbh = LogDbHash(path)
+    assert dict(dbh.items()) == {'foo': 'bar'}
+    dbh['new'] = 'value'
+    dbh.close()
+
+    dbh = LogDbHash(path)
+    assert dict(dbh.items()) == {'foo': 'bar', 'new': 'value'}
+    dbh.close()
+
+
+def test_logdbhash_compacts(tmp_path):
+    path = tmp_path / 'log'
+    dbh = LogDbHash(path, compact_min_bytes=4096)
+    for i in range(1000):
+        dbh['counter'] = str(i)
+        dbh[f'key{i % 10}'] = str(i)
+    assert path.stat().st_size < 4096 * 2
+    assert dbh['counter'] == '999'
+    assert dbh['key3'] == '993'
+    dbh.close()
+
+    dbh = LogDbHash(path)
+    assert dbh['counter'] == '999'
+    assert len(list(dbh.keys())) == 11
+    dbh.close()
+
+
+def test_logdbhash_transaction_rolls_back_on_error(tmp_path):
+    path = tmp_path / 'log'
+    dbh = LogDbHash(path)
+    dbh['foo'] = 'bar'
+    size = path.stat().st_size
+
+    with pytest.raises(ValueError):
+        with dbh.transaction():
+            dbh['foo'] = 'baz'
+            del dbh['foo']
+            dbh['quux'] = 'blah'
+            raise ValueError()
+
+    assert dict(dbh.items()) == {'foo': 'bar'}
+    assert path.stat().st_size == size
+    dbh.close()
@@ -0,0 +1,118 @@
+import json
+import hashlib
+from typing import List, Dict
+
+import pytest
+
+import downloader
+from .helpers import FakeHTTPServer, FakeHTTPHandler
+
+
+BODY = bytes(range(256)) * 1000
+
+ETAG = '"v1"'
+
+
+class FakeFileServer(FakeHTTPServer):
+    '''
+    A local stand-in for a file host that supports conditional and
+    range requests for a single file.
+    '''
+
+    def __init__(self):
+        super().__init__(FakeFileHandler)
+        self.etag = ETAG
+        self.requests: List[Dict[str, str]] = []
+
+
+class FakeFileHandler(FakeHTTPHandler):
+    server: FakeFileServer
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = BODY
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == self.server.etag:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            body = BODY[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(BODY) - 1}/{len(BODY)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(serve):
+    return serve(FakeFileServer())
+
+
+def write_partial_download(dest, size: int, etag: str):
+    downloader.part_path(dest).write_bytes(BODY[:size])
+    downloader.part_meta_path(dest).write_text(json.dumps({'etag': etag}))
+
+
+def test_download_works(server, tmp_path):
+    dest = tmp_path / 'file.csv'
+    result = downloader.download(server.url('/file.csv'), dest, chunk_size=1000)
+    assert result is not None
+    assert dest.read_bytes() == BODY
+    assert result.size == len(BODY)
+    assert result.sha256 == hashlib.sha256(BODY).hexdigest()
+    assert result.etag == ETAG
+    assert not result.resumed
+    assert not downloader.part_path(dest).exists()
+    assert not downloader.part_meta_path(dest).exists()
+
+
+def test_download_returns_none_when_not_modified(server, tmp_path):
+    dest = tmp_path / 'file.csv'
+    assert downloader.download(server.url('/file.csv'), dest, headers={'If-None-Match': ETAG}) is None
+    assert not dest.exists()
+
+
+def test_download_resumes_partial_downloads(server, tmp_path):
+    dest = tmp_path / 'file.csv'
+    write_partial_download(dest, 12345, ETAG)
+    result = downloader.download(server.url('/file.csv'), dest)
+    assert result is not None
+    assert result.resumed
+    assert server.requests[0]['Range'] == 'bytes=12345-'
+    assert dest.read_bytes() == BODY
+    assert result.sha256 == hashlib.sha256(BODY).hexdigest()
+    assert result.size == len(BODY)
+
+
+def test_download_restarts_stale_partial_downloads(server, tmp_path):
+    dest = tmp_path / 'file.csv'
+    write_partial_download(dest, 12345, '"v0"')
+    result = downloader.download(server.url('/file.csv'), dest)
+    assert result is not None
+    assert not result.resumed
+    assert dest.read_bytes() == BODY
+
+
+def test_interrupted_download_leaves_destination_alone(server, tmp_path, monkeypatch):
+    dest = tmp_path / 'file.csv'
+    dest.write_bytes(b'old contents')
+
+    def explode(*args):
+        raise IOError('kaboom')
+
+    monkeypatch.setattr(downloader.os, 'replace', explode)
+    with pytest.raises(IOError):
+        downloader.download(server.url('/file.csv'), dest)
+    assert dest.read_bytes() == b'old contents'
+    assert downloader.part_path(dest).read_bytes() == BODY
+    assert downloader.resume_headers(dest) == {
+        'Range': f'bytes={len(BODY)}-',
+        'If-Range': ETAG,
+    }
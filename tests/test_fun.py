@@ -0,0 +1,285 @@
+import io
+import json
+import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+import psycopg2
+
+import fun
+import bbl_summary
+import geocoding
+import profiling
+from .helpers import FakeNamedCursor, FakeNamedCursorConnection, make_feature
+
+
+class FakeCursor:
+    '''
+    A stand-in for a psycopg2 cursor that answers the report's
+    queries from canned data and records every statement executed.
+    '''
+
+    def __init__(self, num_docs: int):
+        self.num_docs = num_docs
+        self.queries: List[str] = []
+        self.params: list = []
+        self.description: Optional[List[tuple]] = None
+        self._rows: list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _set_result(self, colnames, rows):
+        self.description = [(name,) for name in colnames]
+        self._rows = rows
+
+    def execute(self, sql, params=None):
+        self.queries.append(sql)
+        self.params.append(params)
+        if sql == fun.VIOLATIONS_AND_PLUTO_SQL:
+            self._set_result(
+                ['source', 'bbl', 'rank', 'total', 'date', 'description', 'numfloors',
+                 'yearbuilt'],
+                [row for bbl in params['bbls'] for row in [
+                    ('hpd', bbl, 1, 3, datetime.date(2018, 3, 1), 'NO HEAT', None, None),
+                    ('hpd', bbl, 2, 3, datetime.date(2018, 2, 1), 'MICE', None, None),
+                    ('pluto', bbl, 1, None, None, None, Decimal('5.00'), 1920),
+                ]]
+            )
+        elif sql == fun.DOCUMENTS_AND_PARTIES_SQL:
+            rows: List[tuple] = []
+            for bbl in params['bbls']:
+                for i in range(self.num_docs):
+                    doc = (bbl, f'doc{i}', datetime.date(2018, 1, 1),
+                           datetime.date(2018, 1, 2), 'DEED', Decimal('1000.00'),
+                           Decimal('100.00'))
+                    rows.append(doc + (f'doc{i}', f'BOOP doc{i}', '1 MAIN ST', None,
+                                       'NEW YORK', 'NY', 'US'))
+                rows.append((bbl, 'docnoparties', None, datetime.date(2018, 1, 3), 'MTGE',
+                             None, None) + (None,) * 7)
+            self._set_result(
+                ['bbl', 'documentid', 'docdate', 'recordedfiled', 'doctype', 'docamount',
+                 'pcttransferred', 'documentid', 'name', 'address1', 'address2',
+                 'city', 'state', 'country'],
+                rows
+            )
+        else:
+            raise AssertionError(f'Unexpected query: {sql}')
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self, cursor: FakeCursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, num_docs: int):
+        self.num_docs = num_docs
+        self.checked_out = 0
+
+    def getconn(self):
+        self.checked_out += 1
+        return FakeConnection(FakeCursor(self.num_docs))
+
+    def putconn(self, conn, close=False):
+        self.checked_out -= 1
+
+
+def run_main(monkeypatch, num_docs: int) -> FakeCursor:
+    cursor = FakeCursor(num_docs)
+    feature = make_feature()
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street'])
+    monkeypatch.setattr(geocoding, 'search', lambda text: [feature])
+    monkeypatch.setattr(psycopg2, 'connect', lambda url: FakeConnection(cursor))
+    monkeypatch.setenv('DATABASE_URL', 'postgres://fake')
+    monkeypatch.delenv('GEOCODING_CACHE_DB', raising=False)
+    monkeypatch.delenv('BBL_SUMMARY_DB', raising=False)
+    monkeypatch.delenv('NYCDB_EXTRACT_DB', raising=False)
+    fun.main()
+    return cursor
+
+
+def test_report_takes_two_parameterized_queries(monkeypatch):
+    few = run_main(monkeypatch, num_docs=2)
+    many = run_main(monkeypatch, num_docs=1000)
+    assert len(few.queries) == len(many.queries) == 2
+    assert many.params == [{'bbls': ['1000010001']}] * 2
+    assert '1000010001' not in ''.join(many.queries)
+
+
+def test_report_counts_and_violations_come_from_one_query(monkeypatch):
+    cursor = FakeCursor(num_docs=0)
+    report = fun.get_bbl_report(cursor, '1000010001')
+    assert report.num_hpd_viols == 3
+    assert report.num_dob_viols == 0
+    assert report.hpd_viols == [
+        fun.HPDViolation(datetime.date(2018, 3, 1), 'NO HEAT'),
+        fun.HPDViolation(datetime.date(2018, 2, 1), 'MICE'),
+    ]
+    assert report.plutos == [fun.PlutoInfo('1000010001', Decimal('5.00'), 1920)]
+    assert [d.documentid for d in report.docs] == ['docnoparties']
+    assert report.parties == {'docnoparties': []}
+
+
+def test_parties_are_grouped_onto_documents(monkeypatch, capsys):
+    run_main(monkeypatch, num_docs=2)
+    out = capsys.readouterr().out
+    assert out.endswith(
+        "On 2018-01-01 a DEED for $1,000.00 (100.00% transferred) was signed between:\n"
+        "  BOOP doc0 / 1 MAIN ST / NEW YORK / NY\n"
+        "On 2018-01-01 a DEED for $1,000.00 (100.00% transferred) was signed between:\n"
+        "  BOOP doc1 / 1 MAIN ST / NEW YORK / NY\n"
+        "On 2018-01-03 a MTGE was signed between:\n"
+    )
+
+
+def test_batch_reports_failures_per_record_in_input_order(monkeypatch):
+    feature = make_feature()
+    monkeypatch.setattr(geocoding, 'search',
+                        lambda text: None if text == 'nowhere' else [feature])
+    pool = FakePool(num_docs=1)
+    out = io.StringIO()
+    addresses = fun.read_addresses(io.StringIO("1 main street\n\nnowhere\n1 main st\n"))
+    fun.run_batch(pool, addresses, workers=2, outfile=out)
+
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r['address'] for r in records] == ['1 main street', 'nowhere', '1 main st']
+    assert records[1] == {'address': 'nowhere', 'error': 'Unable to find geolocation info.'}
+    assert records[0]['bbl'] == '1000010001'
+    assert records[0]['pluto'] == [{'bbl': '1000010001', 'numfloors': '5.00', 'yearbuilt': 1920}]
+    assert records[0]['documents'][0]['parties'][0]['name'] == 'BOOP doc0'
+    assert pool.checked_out == 0
+
+
+def test_batch_survives_database_errors(monkeypatch):
+    feature = make_feature()
+    monkeypatch.setattr(geocoding, 'search', lambda text: [feature])
+
+    def explode(cur, bbl):
+        raise ValueError('kaboom')
+
+    monkeypatch.setattr(fun, 'get_bbl_report', explode)
+    pool = FakePool(num_docs=1)
+    out = io.StringIO()
+    fun.run_batch(pool, ['a', 'b'], workers=2, outfile=out)
+
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert records == [
+        {'address': 'a', 'label': feature.properties.label, 'error': 'ValueError: kaboom'},
+        {'address': 'b', 'label': feature.properties.label, 'error': 'ValueError: kaboom'},
+    ]
+    assert pool.checked_out == 0
+
+
+def test_row_classes_are_cached_and_renamed():
+    cursor = FakeCursor(num_docs=1)
+    params = {'bbls': ['1000010001']}
+    first = fun.friendly_execute(cursor, fun.DOCUMENTS_AND_PARTIES_SQL, params=params)
+    second = fun.friendly_execute(cursor, fun.DOCUMENTS_AND_PARTIES_SQL, params=params)
+    assert type(first[0]) is type(second[0])
+    assert first[0]._fields[7:9] == ('documentid_', 'name')
+    assert fun.get_row_class('Row', ('class', 'class_'))._fields == ('class_', 'class__')
+
+
+def test_friendly_iter_streams_rows_in_batches():
+    cursor = FakeNamedCursor([(i, f'name{i}') for i in range(5)], ['id', 'name'])
+    conn = FakeNamedCursorConnection(cursor)
+    rows = list(fun.friendly_iter(conn, "SELECT id, name FROM boop", itersize=2))
+    assert [(row.id, row.name) for row in rows] == [(i, f'name{i}') for i in range(5)]
+    assert cursor.fetches == 4
+    assert conn.cursor_names[0].startswith('friendly_iter_')
+
+
+def test_friendly_iter_works_with_empty_results():
+    conn = FakeNamedCursorConnection(FakeNamedCursor([], ['id', 'name']))
+    assert list(fun.friendly_iter(conn, "SELECT id, name FROM boop")) == []
+
+
+class FakeBuildConnection(FakeConnection):
+    def __init__(self, cursor: FakeCursor, bbls: List[str]):
+        super().__init__(cursor)
+        self.bbls = bbls
+
+    def cursor(self, name=None):
+        if name is None:
+            return self._cursor
+        return FakeNamedCursor([(bbl,) for bbl in self.bbls], ['bbl'])
+
+
+def test_report_summaries_round_trip():
+    report = fun.get_bbl_report(FakeCursor(num_docs=2), '1000010001')
+    summary = bbl_summary.loads(bbl_summary.dumps(fun.bbl_report_to_summary(report)))
+    assert fun.bbl_report_from_summary('1000010001', summary) == report
+
+
+def test_build_summaries_only_builds_stale_summaries(tmp_path):
+    summaries = bbl_summary.open_store(str(tmp_path / 'summaries.db'), fun.REPORT_DATASETS)
+    cursor = FakeCursor(num_docs=1)
+    conn = FakeBuildConnection(cursor, ['1000010001', '1000010002', '1000010003'])
+    assert fun.build_summaries(conn, summaries, chunk_size=2) == 3
+    assert len(cursor.queries) == 4
+
+    summaries.invalidate(['hpd_registrations'])
+    assert fun.build_summaries(conn, summaries, chunk_size=2) == 0
+
+    summaries.invalidate(['acris'])
+    assert fun.build_summaries(conn, summaries, chunk_size=2) == 3
+
+
+def test_main_reads_summaries_first(monkeypatch, capsys, tmp_path):
+    path = str(tmp_path / 'summaries.db')
+    report = fun.get_bbl_report(FakeCursor(num_docs=2), '1000010001')
+    bbl_summary.open_store(path, fun.REPORT_DATASETS).put(
+        '1000010001', fun.bbl_report_to_summary(report))
+
+    def explode(url):
+        raise AssertionError('Should not connect to NYC-DB')
+
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street'])
+    monkeypatch.setattr(geocoding, 'search', lambda text: [make_feature()])
+    monkeypatch.setattr(psycopg2, 'connect', explode)
+    monkeypatch.delenv('GEOCODING_CACHE_DB', raising=False)
+    monkeypatch.setenv('BBL_SUMMARY_DB', path)
+    monkeypatch.delenv('NYCDB_EXTRACT_DB', raising=False)
+    fun.main()
+    assert "  BOOP doc1 / 1 MAIN ST / NEW YORK / NY\n" in capsys.readouterr().out
+
+
+def test_main_profiles_stages(monkeypatch, capsys, tmp_path):
+    cursor = FakeCursor(num_docs=1)
+    connect_kwargs = []
+
+    def connect(url, **kwargs):
+        connect_kwargs.append(kwargs)
+        return FakeConnection(cursor)
+
+    trace = tmp_path / 'trace.json'
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street', '--profile',
+                                     f'--profile-json={trace}'])
+    monkeypatch.setattr(geocoding, 'search', lambda text: [make_feature()])
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    monkeypatch.setenv('DATABASE_URL', 'postgres://fake')
+    monkeypatch.delenv('GEOCODING_CACHE_DB', raising=False)
+    monkeypatch.delenv('BBL_SUMMARY_DB', raising=False)
+    monkeypatch.delenv('NYCDB_EXTRACT_DB', raising=False)
+    fun.main()
+
+    assert connect_kwargs == [{'cursor_factory': profiling.get_cursor_factory()}]
+    assert 'get_bbl_reports' in capsys.readouterr().err
+    names = {event['name'] for event in json.loads(trace.read_text())['events']}
+    assert names == {'psycopg2.connect', 'get_bbl_reports', 'print_bbl_report'}
@@ -0,0 +1,385 @@
+import json
+import threading
+import time
+from typing import List, Dict, Optional
+from urllib.parse import urlparse, parse_qs
+
+import pydantic
+import pytest
+import requests
+
+import geocoding
+import address_index
+from dbhash import DictDbHash
+from sorted_index import write_sorted_index
+from .helpers import FakeClock, FakeHTTPServer, FakeHTTPHandler
+
+
+FEATURE_JSON = {
+    'type': 'Feature',
+    'geometry': {'type': 'Point', 'coordinates': [-73.97, 40.76]},
+    'properties': {
+        'postalcode': '10019',
+        'name': '666 FIFTH AVENUE',
+        'region': 'New York State',
+        'locality': 'New York',
+        'borough': 'Manhattan',
+        'borough_gid': 'whosonfirst:borough:1',
+        'label': '666 FIFTH AVENUE, Manhattan, New York, NY, USA',
+        'pad_bbl': '1012687501',
+    }
+}
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, features: list, headers: Optional[Dict[str, str]]=None):
+        self.status_code = status_code
+        self._features = features
+        self.headers = headers or {}
+
+    def json(self):
+        return {'features': self._features}
+
+
+class FakeSession:
+    def __init__(self):
+        self.queries: List[str] = []
+
+    def get(self, url, params, timeout):
+        text = params['text']
+        self.queries.append(text)
+        if text.startswith('error'):
+            return FakeResponse(500, [])
+        if text.startswith('nowhere'):
+            return FakeResponse(200, [])
+        return FakeResponse(200, [FEATURE_JSON])
+
+
+@pytest.fixture(autouse=True)
+def no_address_index(monkeypatch):
+    monkeypatch.delenv('ADDRESS_INDEX', raising=False)
+    monkeypatch.setattr(geocoding, '_address_index', None)
+
+
+def make_cache(monkeypatch, **kwargs):
+    fake_requests = FakeSession()
+    monkeypatch.setattr(geocoding, '_session', fake_requests)
+    clock = FakeClock(now=1000.0)
+    cache = geocoding.GeocodingCache(DictDbHash({}), clock=clock, **kwargs)
+    return cache, fake_requests, clock
+
+
+def test_search_works(monkeypatch):
+    monkeypatch.setattr(geocoding, '_session', FakeSession())
+    features = geocoding.search('666 fifth avenue')
+    assert features is not None
+    assert features[0].properties.pad_bbl == '1012687501'
+    assert geocoding.search('nowhere') == []
+    assert geocoding.search('error') is None
+
+
+def test_cache_hits_on_normalized_text(monkeypatch):
+    cache, fake_requests, _ = make_cache(monkeypatch)
+    first = cache.search('666 Fifth Avenue')
+    second = cache.search('  666  FIFTH avenue ')
+    assert first == second
+    assert fake_requests.queries == ['666 Fifth Avenue']
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_cache_persists_in_dbhash(monkeypatch):
+    cache, fake_requests, clock = make_cache(monkeypatch)
+    cache.search('666 fifth avenue')
+    other = geocoding.GeocodingCache(cache.dbhash, clock=clock)
+    assert other.search('666 fifth avenue') is not None
+    assert other.hits == 1
+    assert len(fake_requests.queries) == 1
+
+
+def test_cache_expires_entries(monkeypatch):
+    cache, fake_requests, clock = make_cache(monkeypatch, ttl=100)
+    cache.search('666 fifth avenue')
+    clock.now += 101
+    cache.search('666 fifth avenue')
+    assert len(fake_requests.queries) == 2
+    assert cache.misses == 2
+
+
+def test_cache_negative_results(monkeypatch):
+    cache, fake_requests, clock = make_cache(monkeypatch, negative_ttl=10)
+    assert cache.search('nowhere') == []
+    assert cache.search('nowhere') == []
+    assert len(fake_requests.queries) == 1
+    clock.now += 11
+    assert cache.search('nowhere') == []
+    assert len(fake_requests.queries) == 2
+
+
+def test_cache_does_not_cache_errors(monkeypatch):
+    cache, fake_requests, _ = make_cache(monkeypatch)
+    assert cache.search('error') is None
+    assert cache.search('error') is None
+    assert len(fake_requests.queries) == 2
+
+
+def test_cache_evicts_least_recently_used(monkeypatch):
+    cache, fake_requests, clock = make_cache(monkeypatch, max_entries=2)
+    cache.search('a')
+    clock.now += 1
+    cache.search('b')
+    clock.now += 1
+    cache.search('a')
+    clock.now += 1
+    cache.search('c')
+    assert cache.evictions == 1
+    assert sorted(cache.dbhash.keys(cache.ENTRY_PREFIX)) == ['geocode:a', 'geocode:c']
+
+    # Make sure the LRU order survives reopening the cache.
+    reopened = geocoding.GeocodingCache(cache.dbhash, clock=clock, max_entries=2)
+    clock.now += 1
+    reopened.search('a')
+    clock.now += 1
+    reopened.search('d')
+    assert sorted(cache.dbhash.keys(cache.ENTRY_PREFIX)) == ['geocode:a', 'geocode:d']
+
+
+class CountingDbHash(DictDbHash):
+    def __init__(self):
+        super().__init__({})
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        super().__setitem__(key, value)
+
+
+def test_cache_batches_access_time_writes(monkeypatch):
+    dbh = CountingDbHash()
+    cache, fake_requests, clock = make_cache(monkeypatch, atime_batch=3)
+    cache.dbhash = dbh
+    cache.search('a')
+    writes_after_put = dbh.writes
+    clock.now += 1
+    cache.search('a')
+    cache.search('a')
+    assert dbh.writes == writes_after_put
+    assert dbh.d['geocode_atime:a'] == repr(1000.0)
+
+    cache.close()
+    assert dbh.writes == writes_after_put + 1
+    assert dbh.d['geocode_atime:a'] == repr(1001.0)
+
+    for _ in range(3):
+        clock.now += 1
+        cache.search('a')
+    assert dbh.d['geocode_atime:a'] == repr(1004.0)
+
+
+def test_cache_search_many_only_fetches_misses(monkeypatch):
+    cache, _, _ = make_cache(monkeypatch)
+    cache.search('666 fifth avenue')
+    fetched: List[str] = []
+
+    def fake_search_many_json(texts, **kwargs):
+        texts = list(texts)
+        fetched.extend(texts)
+        return [[] if text == 'nowhere' else [FEATURE_JSON] for text in texts]
+
+    monkeypatch.setattr(geocoding, '_search_many_json', fake_search_many_json)
+    results = cache.search_many(['666 Fifth Avenue', 'nowhere', 'NOWHERE'])
+    assert fetched == ['nowhere']
+    assert results[1] == results[2] == []
+    assert results[0] is not None and results[0][0].properties.pad_bbl == '1012687501'
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0}
+
+
+def test_token_bucket_limits_rate():
+    clock = FakeClock(now=1000.0)
+    sleeps: List[float] = []
+
+    def sleep(secs: float):
+        sleeps.append(secs)
+        clock.now += secs
+
+    bucket = geocoding.TokenBucket(rate=2, capacity=2, clock=clock, sleep=sleep)
+    start = clock.now
+    for _ in range(6):
+        bucket.acquire()
+    assert clock.now - start == 2.0
+    assert len(sleeps) == 4
+
+
+class FakeGeosearchServer(FakeHTTPServer):
+    '''
+    A local stand-in for the geosearch API. Searches for text starting
+    with "flaky" fail with a 503 the first time they're made, and
+    searches for text starting with "bad" always fail with a 400.
+    '''
+
+    def __init__(self, delay: float=0.0):
+        super().__init__(FakeGeosearchHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.attempts: Dict[str, int] = {}
+        self.connections = 0
+
+
+class FakeGeosearchHandler(FakeHTTPHandler):
+    server: FakeGeosearchServer
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        text = parse_qs(urlparse(self.path).query)['text'][0]
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            attempt = self.server.attempts.get(text, 0) + 1
+            self.server.attempts[text] = attempt
+        time.sleep(self.server.delay)
+        if text.startswith('bad'):
+            status = 400
+        elif text.startswith('flaky') and attempt == 1:
+            status = 503
+        else:
+            status = 200
+        feature = json.loads(json.dumps(FEATURE_JSON))
+        feature['properties']['name'] = text
+        body = json.dumps({'features': [feature]}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+
+def run_fake_server(serve, monkeypatch, delay: float=0.0) -> FakeGeosearchServer:
+    server = serve(FakeGeosearchServer(delay))
+    monkeypatch.setattr(geocoding, 'GEOCODING_SEARCH_URL', server.url('/v1/search'))
+    return server
+
+
+def test_search_many_returns_results_in_order(serve, monkeypatch):
+    server = run_fake_server(serve, monkeypatch, delay=0.01)
+    texts = [f'{i} main street' for i in range(40)]
+    results = geocoding.search_many(texts, concurrency=4, rate_limit=None)
+    assert [r[0].properties.name for r in results] == texts  # type: ignore
+    assert server.max_in_flight <= 4
+    assert server.connections <= 4
+
+
+def test_search_many_retries_with_backoff(serve, monkeypatch):
+    server = run_fake_server(serve, monkeypatch)
+    results = geocoding.search_many(['flaky 1', 'bad 2', 'flaky 3'],
+                                    concurrency=2, rate_limit=None,
+                                    retries=2, backoff=0.01)
+    assert results[0] is not None and results[0][0].properties.name == 'flaky 1'
+    assert results[1] is None
+    assert results[2] is not None and results[2][0].properties.name == 'flaky 3'
+    assert server.attempts == {'flaky 1': 2, 'bad 2': 1, 'flaky 3': 2}
+
+
+class ScriptedSession:
+    '''
+    A session whose get() returns (or raises) the given outcomes
+    in order.
+    '''
+
+    def __init__(self, outcomes: list):
+        self.outcomes = outcomes
+        self.calls = 0
+
+    def get(self, url, params, timeout):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_parse_retry_after():
+    assert geocoding.parse_retry_after(None) is None
+    assert geocoding.parse_retry_after('120') == 120.0
+    assert geocoding.parse_retry_after('Wed, 21 Oct 2015 07:28:30 GMT',
+                                       now=1445412480.0) == 30.0
+    assert geocoding.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT',
+                                       now=1445412490.0) == 0.0
+    assert geocoding.parse_retry_after('soon') is None
+
+
+def test_search_many_honors_retry_after(monkeypatch):
+    sleeps: List[float] = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    session = ScriptedSession([
+        FakeResponse(429, [], {'Retry-After': '7'}),
+        FakeResponse(200, [FEATURE_JSON]),
+    ])
+    results = geocoding.search_many(['666 fifth avenue'], rate_limit=None,
+                                    backoff=0.01, session=session)  # type: ignore
+    assert results[0] is not None
+    assert sleeps == [7.0]
+
+
+def test_search_many_logs_traceback_after_retries(monkeypatch, caplog):
+    monkeypatch.setattr(time, 'sleep', lambda secs: None)
+    session = ScriptedSession([requests.ConnectionError('nope')])
+    results = geocoding.search_many(['666 fifth avenue'], rate_limit=None,
+                                    retries=2, session=session)  # type: ignore
+    assert results == [None]
+    assert session.calls == 3
+    [record] = caplog.records
+    assert record.exc_info is not None
+    assert isinstance(record.exc_info[1], requests.ConnectionError)
+
+
+class MalformedResponse(FakeResponse):
+    def json(self):
+        return {'error': 'no features here'}
+
+
+def test_search_many_isolates_malformed_responses(caplog):
+    responses = {
+        'good 1': FakeResponse(200, [FEATURE_JSON]),
+        'missing features': MalformedResponse(200, []),
+        'invalid feature': FakeResponse(200, [{'type': 'Feature'}]),
+        'good 2': FakeResponse(200, [FEATURE_JSON]),
+    }
+
+    class Session:
+        def get(self, url, params, timeout):
+            return responses[params['text']]
+
+    results = geocoding.search_many(list(responses), rate_limit=None,
+                                    session=Session())  # type: ignore
+    assert [r is not None for r in results] == [True, False, False, True]
+    errors = sorted(type(r.exc_info[1]).__name__ for r in caplog.records if r.exc_info)
+    assert errors == [KeyError.__name__, pydantic.ValidationError.__name__]
+
+
+def test_search_consults_address_index_first(monkeypatch, tmp_path):
+    path = tmp_path / 'addresses.idx'
+    write_sorted_index(path, {'666 5 AVE': [address_index.pack_value('1012687501', 10103)]})
+    monkeypatch.setenv('ADDRESS_INDEX', str(path))
+    cache, fake_requests, _ = make_cache(monkeypatch)
+
+    features = geocoding.search('666 Fifth Avenue, Manhattan')
+    assert features is not None
+    assert features[0].properties.pad_bbl == '1012687501'
+    assert features[0].geometry is None
+    assert features[0].properties.borough_gid == 'whosonfirst:borough:1'
+    features = cache.search('666 5th ave')
+    assert features is not None
+    assert features[0].properties.pad_bbl == '1012687501'
+    assert fake_requests.queries == []
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    features = geocoding.search('1 main street')
+    assert features is not None
+    assert fake_requests.queries == ['1 main street']
@@ -0,0 +1,418 @@
+import json
+from typing import Dict, List, Optional
+
+import psycopg2
+import pytest
+
+import cached_yaml
+import fun
+import introspect_schema
+import nycdb_data
+import lastmod
+from dbhash import DictDbHash
+from introspect_schema import TableMeta, ColumnMeta, DataType, TableMetadataFile
+from .helpers import FakeHTTPServer, FakeHTTPHandler
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries: List[str] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.queries.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, cursor: FakeCursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def make_catalog_rows(num_tables: int):
+    rows = []
+    for i in range(num_tables):
+        rows.extend([
+            (f'table{i}', 'bbl', False, 'character', None, None, 10),
+            (f'table{i}', 'tags', True, 'ARRAY', 'text', None, None),
+            (f'table{i}', 'counts', True, 'ARRAY', 'integer', None, None),
+            (f'table{i}', 'amount', True, 'numeric', None, 2, None),
+        ])
+    return rows
+
+
+def introspect(monkeypatch, tables, rows) -> FakeCursor:
+    cursor = FakeCursor(rows)
+    monkeypatch.setattr(psycopg2, 'connect',
+                        lambda url: FakeConnection(cursor))
+    monkeypatch.setenv('DATABASE_URL', 'postgres://fake')
+    introspect_schema.introspect_schema_and_populate_table_metadata(tables)
+    return cursor
+
+
+def test_query_count_is_constant(monkeypatch):
+    few = introspect(monkeypatch, {}, make_catalog_rows(1))
+    many = introspect(monkeypatch, {}, make_catalog_rows(200))
+    assert len(few.queries) == len(many.queries) == 1
+
+
+def test_metadata_is_populated(monkeypatch):
+    tables = {
+        'table0': TableMeta(
+            'table0',
+            description='A table.',
+            columns={
+                'bbl': ColumnMeta('bbl', description='The BBL.'),
+                'not_in_db': ColumnMeta('not_in_db'),
+            }
+        ),
+        'not_in_db': TableMeta('not_in_db'),
+    }
+    introspect(monkeypatch, tables, make_catalog_rows(2))
+
+    assert list(tables.keys()) == ['table0', 'table1']
+    table = tables['table0']
+    assert table.description == 'A table.'
+    assert list(table.columns.keys()) == ['bbl', 'tags', 'counts', 'amount']
+    assert table.columns['bbl'] == ColumnMeta(
+        'bbl',
+        description='The BBL.',
+        data_type=DataType.character,
+        character_maximum_length=10,
+        is_nullable=False,
+        is_in_db_schema=True
+    )
+    assert table.columns['tags'].data_type == DataType.array
+    assert table.columns['tags'].data_subtype == DataType.text
+    assert table.columns['counts'].data_subtype == DataType.integer
+    assert table.columns['amount'].numeric_scale == 2
+    assert table.columns['amount'].data_subtype is None
+
+
+class FakeMetadataServer(FakeHTTPServer):
+    def __init__(self):
+        super().__init__(FakeMetadataHandler)
+        self.requests: List[str] = []
+        self.status_codes: List[int] = []
+        self.version = 1
+
+
+class FakeMetadataHandler(FakeHTTPHandler):
+    server: FakeMetadataServer
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        etag = f'"{self.path}-v{self.server.version}"'
+        if self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        else:
+            status = 200
+            body = json.dumps({
+                'name': f'Table at {self.path}',
+                'description': f'Version {self.server.version}',
+                'columns': [{'fieldName': 'bbl', 'name': 'BBL'}],
+            }).encode('utf-8')
+        self.server.status_codes.append(status)
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def metadata_server(serve):
+    return serve(FakeMetadataServer())
+
+
+def test_refresh_table_metadata_files_revalidates(metadata_server, tmp_path):
+    files = [
+        TableMetadataFile('dataset', f'table{i}', metadata_server.url(f'/views/{i}'),
+                          tmp_path / f'table{i}.json')
+        for i in range(5)
+    ]
+    lm = lastmod.Lastmod(DictDbHash({}))
+
+    introspect_schema.refresh_table_metadata_files(files, lm, workers=3)
+    assert sorted(metadata_server.status_codes) == [200] * 5
+    assert lm.get_info(files[0].url).etag == '"/views/0-v1"'
+    assert introspect_schema.load_table_metadata_file(files[0]) == TableMeta(
+        'table0',
+        verbose_name='Table at /views/0',
+        description='Version 1.',
+        description_source=introspect_schema.API_VIEW_SOURCE,
+        dataset='dataset',
+        columns={'bbl': ColumnMeta('bbl', verbose_name='BBL')}
+    )
+
+    metadata_server.status_codes.clear()
+    introspect_schema.refresh_table_metadata_files(files, lm, workers=3)
+    assert metadata_server.status_codes == [304] * 5
+
+    metadata_server.status_codes.clear()
+    metadata_server.version = 2
+    introspect_schema.refresh_table_metadata_files(files, lm, workers=3)
+    assert metadata_server.status_codes == [200] * 5
+    assert introspect_schema.load_table_metadata_file(files[0]).description == 'Version 2.'
+
+
+def test_refresh_table_metadata_files_falls_back_to_cached_copy(tmp_path):
+    path = tmp_path / 'table.json'
+    path.write_text('{"cached": true}')
+    files = [TableMetadataFile('dataset', 'table', 'http://127.0.0.1:1/views/0', path)]
+    introspect_schema.refresh_table_metadata_files(files, lastmod.Lastmod(DictDbHash({})))
+    assert path.read_text() == '{"cached": true}'
+
+    path.unlink()
+    with pytest.raises(Exception):
+        introspect_schema.refresh_table_metadata_files(files, lastmod.Lastmod(DictDbHash({})))
+
+
+DATASETS_YML = """\
+hpd_violations:
+  files:
+    - url: https://data.cityofnewyork.us/api/views/wvxf-dwi5/rows.csv?accessType=DOWNLOAD
+      dest: hpd_violations.csv
+  schema:
+    table_name: hpd_violations
+pluto:
+  files:
+    - url: https://example.com/pluto.zip
+      dest: pluto.zip
+  schema:
+    table_name: pluto_18v1
+"""
+
+CATALOG_ROWS = [
+    ('hpd_violations', 'bbl', False, 'character', None, None, 10),
+    ('hpd_violations', 'novdescription', True, 'text', None, None, None),
+    ('pluto_18v1', 'bbl', False, 'character', None, None, 10),
+    ('pluto_18v1', 'numfloors', True, 'numeric', None, 2, None),
+]
+
+
+def write_hpd_metadata(path, description: str):
+    path.write_text(json.dumps({
+        'name': 'Housing Maintenance Code Violations',
+        'description': description,
+        'columns': [{'fieldName': 'novdescription', 'name': 'NOV Description',
+                     'description': 'What the violation is'}],
+    }))
+
+
+@pytest.fixture
+def data_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(nycdb_data, 'DATA_DIR', tmp_path)
+    monkeypatch.setattr(nycdb_data, 'DATASETS_YML', tmp_path / 'datasets.yml')
+    monkeypatch.setattr(nycdb_data, 'METADATA_LASTMOD_DB', tmp_path / 'lastmod.db')
+    monkeypatch.setattr(introspect_schema, 'SCHEMA_SNAPSHOT', tmp_path / 'snapshot.json')
+    monkeypatch.setenv('DATABASE_URL', 'postgres://fake')
+    (tmp_path / 'datasets.yml').write_text(DATASETS_YML)
+    write_hpd_metadata(tmp_path / 'hpd_violations.json', 'Violations')
+    return tmp_path
+
+
+def run_main(monkeypatch, capsys, *args, etag: Optional[str]=None):
+    connections: List[FakeConnection] = []
+    renders: List[str] = []
+    refreshed: List[str] = []
+    original_render_table = introspect_schema.render_table
+
+    def connect(url):
+        connections.append(FakeConnection(FakeCursor(CATALOG_ROWS)))
+        return connections[-1]
+
+    def render_table(table):
+        renders.append(table.name)
+        return original_render_table(table)
+
+    def refresh_yaml(path, url, lm):
+        refreshed.append(path.name)
+        return False
+
+    def refresh_table_metadata_files(files, lm):
+        # Pretend the server is serving metadata with the given etag.
+        for f in files:
+            refreshed.append(f.path.name)
+            if not f.path.exists() or lm.get_info(f.url).etag != etag:
+                write_hpd_metadata(f.path, 'Violations')
+                lm.set_info(lastmod.LastmodInfo(url=f.url, etag=etag))
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    monkeypatch.setattr(introspect_schema, 'render_table', render_table)
+    monkeypatch.setattr(cached_yaml, 'refresh', refresh_yaml)
+    monkeypatch.setattr(introspect_schema, 'refresh_table_metadata_files',
+                        refresh_table_metadata_files)
+    monkeypatch.setattr('sys.argv', ['introspect_schema.py', *args])
+    introspect_schema.main()
+    return capsys.readouterr().out, len(connections), renders, refreshed
+
+
+def test_main_reuses_snapshot_when_nothing_changed(monkeypatch, capsys, data_dir):
+    first, num_connections, renders, refreshed = run_main(monkeypatch, capsys)
+    assert num_connections == 1
+    assert renders == ['hpd_violations', 'pluto_18v1']
+    assert refreshed == []
+    assert '> Violations.' in first
+    assert '`numfloors` - A numeric float value.' in first
+
+    second, num_connections, renders, refreshed = run_main(monkeypatch, capsys)
+    assert second == first
+    assert num_connections == 0
+    assert renders == []
+    assert refreshed == []
+
+    forced, num_connections, renders, refreshed = run_main(monkeypatch, capsys, '--force')
+    assert forced == first
+    assert num_connections == 1
+    assert renders == ['hpd_violations', 'pluto_18v1']
+    assert refreshed == []
+
+
+def test_main_refresh_reuses_snapshot_when_nothing_changed(monkeypatch, capsys, data_dir):
+    first, _, _, _ = run_main(monkeypatch, capsys, '--refresh', etag='"v1"')
+
+    out, num_connections, renders, refreshed = run_main(monkeypatch, capsys, '--refresh',
+                                                        etag='"v1"')
+    assert out == first
+    assert num_connections == 0
+    assert renders == []
+    assert refreshed == ['datasets.yml', 'hpd_violations.json']
+
+
+def test_main_refresh_only_rerenders_tables_with_changed_etags(monkeypatch, capsys, data_dir):
+    first, _, _, _ = run_main(monkeypatch, capsys, '--refresh', etag='"v1"')
+
+    out, num_connections, renders, _ = run_main(monkeypatch, capsys, '--refresh',
+                                                etag='"v2"')
+    assert out == first
+    assert num_connections == 1
+    assert renders == ['hpd_violations']
+
+
+def test_main_only_downloads_missing_metadata(monkeypatch, capsys, data_dir):
+    (data_dir / 'hpd_violations.json').unlink()
+    out, _, _, refreshed = run_main(monkeypatch, capsys)
+    assert refreshed == ['hpd_violations.json']
+    assert '> Violations.' in out
+
+
+def test_main_only_rerenders_changed_tables(monkeypatch, capsys, data_dir):
+    run_main(monkeypatch, capsys)
+    write_hpd_metadata(data_dir / 'hpd_violations.json', 'New violations')
+
+    out, num_connections, renders, _ = run_main(monkeypatch, capsys)
+    assert num_connections == 1
+    assert renders == ['hpd_violations']
+    assert '> New violations.' in out
+
+
+def test_snapshot_round_trips(tmp_path):
+    tables: Dict[str, TableMeta] = {}
+    introspect_schema.populate_table_metadata_from_catalog_rows(tables, make_catalog_rows(3))
+    snapshot = introspect_schema.SchemaSnapshot('abcd', tables, {'table0': ('ef', '# hi')})
+    introspect_schema.save_snapshot(snapshot, tmp_path / 'snapshot.json')
+    assert introspect_schema.load_snapshot(tmp_path / 'snapshot.json') == snapshot
+    assert introspect_schema.load_snapshot(tmp_path / 'nonexistent.json') is None
+
+
+def make_plan(node_type: str, relation: str, children=()):
+    return {'Node Type': node_type, 'Relation Name': relation, 'Plans': list(children)}
+
+
+EXPLAIN_OUTPUT = [{
+    'Plan': {
+        'Node Type': 'Append',
+        'Shared Hit Blocks': 12,
+        'Shared Read Blocks': 3,
+        'Plans': [
+            make_plan('Seq Scan', 'hpd_violations'),
+            make_plan('Bitmap Heap Scan', 'dob_violations',
+                      [{'Node Type': 'Bitmap Index Scan', 'Index Name': 'dob_bbl_idx'}]),
+        ],
+    },
+    'Planning Time': 0.5,
+    'Execution Time': 12.25,
+}]
+
+
+class FakeAdvisorCursor(FakeCursor):
+    def __init__(self, index_rows):
+        super().__init__(index_rows)
+        self.params: list = []
+
+    def execute(self, sql, params=None):
+        super().execute(sql, params)
+        self.params.append(params)
+
+    def fetchone(self):
+        return (EXPLAIN_OUTPUT,)
+
+
+class FakeAdvisorConnection(FakeConnection):
+    def rollback(self):
+        pass
+
+
+def test_advise_indexes_works():
+    rows = [
+        ('hpd_violations', None),
+        ('dob_violations', 'bbl'),
+        ('dob_violations', 'isndobbisviol'),
+        ('pluto_18v1', 'borough'),
+    ]
+    advice = introspect_schema.advise_indexes(rows, [
+        ('hpd_violations', 'bbl'),
+        ('dob_violations', 'bbl'),
+        ('pluto_18v1', 'bbl'),
+        ('real_property_legals', 'bbl'),
+    ])
+    assert advice.missing == [('hpd_violations', 'bbl'), ('pluto_18v1', 'bbl')]
+    assert advice.missing_tables == ['real_property_legals']
+    assert introspect_schema.create_index_sql('hpd_violations', 'bbl') == (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS hpd_violations_bbl_idx "
+        "ON hpd_violations (bbl);"
+    )
+
+
+def test_summarize_plan_flags_seq_scans():
+    summary = introspect_schema.summarize_plan('boop', EXPLAIN_OUTPUT)
+    assert summary == introspect_schema.PlanSummary(
+        name='boop',
+        planning_ms=0.5,
+        execution_ms=12.25,
+        shared_hit_blocks=12,
+        shared_read_blocks=3,
+        seq_scans=['hpd_violations'],
+    )
+
+
+def test_main_advise_indexes_works(monkeypatch, capsys, tmp_path):
+    rows = [(table, None) for table, _ in fun.REPORT_LOOKUP_COLUMNS]
+    cursor = FakeAdvisorCursor(rows)
+    monkeypatch.setattr(psycopg2, 'connect',
+                        lambda url: FakeAdvisorConnection(cursor))
+    monkeypatch.setenv('DATABASE_URL', 'postgres://fake')
+    plan_json = tmp_path / 'plans.json'
+    monkeypatch.setattr('sys.argv', ['introspect_schema.py', '--advise-indexes',
+                                     '--bbl=1000010001', f'--plan-json={plan_json}'])
+    introspect_schema.main()
+
+    out = capsys.readouterr().out
+    assert "-- WARNING: violations_and_pluto sequentially scans hpd_violations.\n" in out
+    assert out.count("CREATE INDEX CONCURRENTLY") == len(fun.REPORT_LOOKUP_COLUMNS)
+    assert cursor.params[1:] == [{'bbls': ['1000010001']}] * len(fun.REPORT_QUERIES)
+    assert all(q.startswith("EXPLAIN (ANALYZE, BUFFERS") for q in cursor.queries[1:])
+    plans = json.loads(plan_json.read_text())
+    assert [p['summary']['name'] for p in plans] == list(fun.REPORT_QUERIES)
@@ -0,0 +1,47 @@
+import sqlite3
+from typing import List
+
+from dbhash import DictDbHash, SqlDbHash
+from lastmod import Lastmod, LastmodInfo
+
+
+def test_set_info_and_get_info_work():
+    lm = Lastmod(DictDbHash({}))
+    assert lm.get_info('http://a') == LastmodInfo(url='http://a')
+
+    info = LastmodInfo(url='http://a', etag='"blah"', last_modified='Tue', size=5,
+                       sha256='abcd')
+    lm.set_info(info)
+    assert lm.get_info('http://a') == info
+
+    lm.set_info(LastmodInfo(url='http://a', etag='"new"'))
+    assert lm.get_info('http://a') == LastmodInfo(url='http://a', etag='"new"')
+    assert sorted(lm.dbhash.keys()) == ['etag:http://a']
+
+
+def test_bulk_operations_use_one_transaction_and_constant_statements():
+    conn = sqlite3.connect(':memory:')
+    statements: List[str] = []
+    conn.set_trace_callback(statements.append)
+    lm = Lastmod(SqlDbHash(conn, 'lastmod'))
+    statements.clear()
+
+    infos = [LastmodInfo(url=f'http://{i}', etag=f'"{i}"') for i in range(200)]
+    lm.set_infos(infos)
+    assert statements.count('COMMIT') == 1
+
+    statements.clear()
+    result = lm.get_infos(info.url for info in infos)
+    assert list(result.values()) == infos
+    assert len(statements) < 10
+
+
+def test_urls_lists_every_tracked_url():
+    dbh = DictDbHash({'geocode:blah': 'not a url'})
+    lm = Lastmod(dbh)
+    lm.set_infos([
+        LastmodInfo(url='http://b', last_modified='Tue'),
+        LastmodInfo(url='http://a', etag='"a"', sha256='abcd'),
+        LastmodInfo(url='http://c'),
+    ])
+    assert lm.urls() == ['http://a', 'http://b']
@@ -0,0 +1,241 @@
+import io
+import json
+import sqlite3
+import datetime
+from decimal import Decimal
+from typing import Dict, List
+
+import psycopg2
+import pytest
+
+import fun
+import geocoding
+import nycdb_extract
+from fun import BBLReport, HPDViolation, DOBViolation, PlutoInfo, ACRISDocument, ACRISParty
+from .helpers import make_feature
+
+
+BBL = '1000010001'
+
+OTHER_BBL = '2000020002'
+
+
+def copy_text(rows: List[List[str]]) -> bytes:
+    return ''.join('\t'.join(row) + '\n' for row in rows).encode('utf-8')
+
+
+COPY_OUTPUT = {
+    'hpd_violations': copy_text(
+        [[BBL, f'2018-01-{day:02}', f'VIOLATION {day}'] for day in range(1, 13)] + [
+            [BBL, '\\N', 'NO HEAT\\tAT ALL\\\\'],
+            [OTHER_BBL, '2019-05-01', 'MICE'],
+        ]
+    ),
+    'dob_violations': copy_text([
+        [BBL, '2017-03-04', 'CAFÉ ON FIRE'],
+    ]),
+    'pluto_18v1': copy_text([
+        [BBL, '5.50', '1920'],
+        [OTHER_BBL, '\\N', '1931'],
+    ]),
+    'real_property_legals': copy_text([
+        [BBL, 'doc1'],
+        [BBL, 'doc1'],
+        [BBL, 'doc2'],
+    ]),
+    'real_property_master': copy_text([
+        ['doc1', '2018-01-01', '2018-01-02', 'DEED', '1000.00', '100.00'],
+        ['doc2', '\\N', '2017-05-01', 'MTGE', '\\N', '\\N'],
+    ]),
+    'real_property_parties': copy_text([
+        ['doc1', 'BOOP', '1 MAIN ST', '\\N', 'NEW YORK', 'NY', 'US'],
+        ['doc1', 'BLAP', '2 MAIN ST', 'APT 1', 'NEW YORK', 'NY', 'US'],
+    ]),
+}
+
+
+class FakeCopyCursor:
+    '''
+    A stand-in for a psycopg2 cursor that answers COPY statements
+    from canned data, writing it in small pieces that don't line up
+    with rows (or characters).
+    '''
+
+    def __init__(self, conn: 'FakeCopyConnection'):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def copy_expert(self, sql, file):
+        self.conn.statements.append(sql)
+        data = self.conn.tables[sql.split()[1]]
+        for i in range(0, len(data), 7):
+            file.write(data[i:i + 7])
+
+
+class FakeCopyConnection:
+    def __init__(self, tables: Dict[str, bytes]):
+        self.tables = tables
+        self.statements: List[str] = []
+        self.session: dict = {}
+
+    def set_session(self, **kwargs):
+        self.session = kwargs
+
+    def cursor(self):
+        return FakeCopyCursor(self)
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def extract_path(tmp_path):
+    path = tmp_path / 'nycdb.db'
+    nycdb_extract.extract(FakeCopyConnection(COPY_OUTPUT), path, chunk_size=5)
+    return path
+
+
+def test_parse_copy_row():
+    assert nycdb_extract.parse_copy_row(b'a\\tb\\nc\t\\N\t\\\\N\t\\101\\x42\t') == (
+        'a\tb\nc', None, '\\N', 'AB', '')
+
+
+def test_copy_loader_inserts_in_chunks():
+    db = sqlite3.connect(':memory:')
+    nycdb_extract.create_tables(db)
+    table = nycdb_extract.EXTRACT_TABLES[0]
+    inserted: List[int] = []
+    loader = nycdb_extract.CopyLoader(db, table, chunk_size=5)
+    original_flush = loader.flush
+
+    def flush():
+        inserted.append(len(loader._rows))
+        original_flush()
+
+    loader.flush = flush  # type: ignore
+    loader.write(COPY_OUTPUT['hpd_violations'])
+    loader.close()
+    assert inserted == [14, 0]
+    assert loader.rows_loaded == 14
+
+    loader = nycdb_extract.CopyLoader(db, table)
+    loader.write(b'1000010001\t2018-01-01')
+    with pytest.raises(ValueError, match='middle of a row'):
+        loader.close()
+
+
+def test_extract_copies_tables_in_one_snapshot(tmp_path):
+    conn = FakeCopyConnection(COPY_OUTPUT)
+    path = tmp_path / 'nycdb.db'
+    counts = nycdb_extract.extract(conn, path, chunk_size=5)
+    assert counts == {
+        'hpd_violations': 14,
+        'dob_violations': 1,
+        'pluto_18v1': 2,
+        'real_property_legals': 3,
+        'real_property_master': 2,
+        'real_property_parties': 2,
+    }
+    assert conn.session == {'isolation_level': 'REPEATABLE READ', 'readonly': True}
+    assert conn.statements[0] == (
+        "COPY hpd_violations (bbl, inspectiondate, novdescription) TO STDOUT")
+    assert not (tmp_path / 'nycdb.db.tmp').exists()
+
+    db = sqlite3.connect(str(path))
+    indexes = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert indexes == {f'{table}_{column}_idx' for table, column in fun.REPORT_LOOKUP_COLUMNS}
+
+
+def test_extract_leaves_existing_file_alone_on_failure(tmp_path):
+    path = tmp_path / 'nycdb.db'
+    path.write_text('old extract')
+    tables = {**COPY_OUTPUT, 'pluto_18v1': b'1000010001\t5.50'}
+    with pytest.raises(ValueError):
+        nycdb_extract.extract(FakeCopyConnection(tables), path)
+    assert path.read_text() == 'old extract'
+    assert not (tmp_path / 'nycdb.db.tmp').exists()
+
+
+def test_reports_from_extract_match_postgres_types(extract_path):
+    conn = nycdb_extract.connect(str(extract_path))
+    with conn.cursor() as cur:
+        reports = fun.get_bbl_reports(cur, [BBL, OTHER_BBL])
+
+    assert reports[BBL] == BBLReport(
+        bbl=BBL,
+        num_hpd_viols=13,
+        num_dob_viols=1,
+        hpd_viols=[HPDViolation(None, 'NO HEAT\tAT ALL\\')] + [
+            HPDViolation(datetime.date(2018, 1, day), f'VIOLATION {day}')
+            for day in range(12, 3, -1)
+        ],
+        dob_viols=[DOBViolation(datetime.date(2017, 3, 4), 'CAFÉ ON FIRE')],
+        plutos=[PlutoInfo(BBL, Decimal('5.50'), 1920)],
+        docs=[
+            ACRISDocument('doc2', None, datetime.date(2017, 5, 1), 'MTGE', None, None),
+            ACRISDocument('doc1', datetime.date(2018, 1, 1), datetime.date(2018, 1, 2),
+                          'DEED', Decimal('1000.00'), Decimal('100.00')),
+        ],
+        parties={
+            'doc2': [],
+            'doc1': [
+                ACRISParty('doc1', 'BOOP', '1 MAIN ST', None, 'NEW YORK', 'NY', 'US'),
+                ACRISParty('doc1', 'BLAP', '2 MAIN ST', 'APT 1', 'NEW YORK', 'NY', 'US'),
+            ],
+        }
+    )
+    assert reports[OTHER_BBL] == BBLReport(
+        OTHER_BBL, 1, 0, [HPDViolation(datetime.date(2019, 5, 1), 'MICE')], [],
+        [PlutoInfo(OTHER_BBL, None, 1931)], [], {})
+
+
+def test_duplicate_legals_rows_are_reported_once(extract_path):
+    conn = nycdb_extract.connect(str(extract_path))
+    with conn.cursor() as cur:
+        report = fun.get_bbl_report(cur, BBL)
+    assert [doc.documentid for doc in report.docs] == ['doc2', 'doc1']
+    assert [party.name for party in report.parties['doc1']] == ['BOOP', 'BLAP']
+
+
+def test_extract_is_read_only(extract_path):
+    conn = nycdb_extract.connect(str(extract_path))
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM pluto_18v1")
+
+
+def test_batch_reads_extract_from_many_threads(monkeypatch, extract_path):
+    feature = make_feature(BBL)
+    monkeypatch.setenv('NYCDB_EXTRACT_DB', str(extract_path))
+    pool = fun.create_pool(4)
+    out = io.StringIO()
+    try:
+        fun.run_batch(pool, ['1 main street'] * 20, 4, out, geocode=lambda text: [feature])
+    finally:
+        pool.closeall()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert len(records) == 20
+    assert all(record['num_hpd_violations'] == 13 for record in records)
+    assert records[0]['pluto'] == [{'bbl': BBL, 'numfloors': '5.50', 'yearbuilt': 1920}]
+
+
+def test_main_uses_extract_instead_of_postgres(monkeypatch, capsys, extract_path):
+    def explode(url, **kwargs):
+        raise AssertionError('Should not connect to NYC-DB')
+
+    feature = make_feature(BBL)
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street'])
+    monkeypatch.setattr(geocoding, 'search', lambda text: [feature])
+    monkeypatch.setattr(psycopg2, 'connect', explode)
+    monkeypatch.delenv('GEOCODING_CACHE_DB', raising=False)
+    monkeypatch.delenv('BBL_SUMMARY_DB', raising=False)
+    monkeypatch.setenv('NYCDB_EXTRACT_DB', str(extract_path))
+    fun.main()
+    out = capsys.readouterr().out
+    assert "The property has 13 HPD violations and 1 DOB violations." in out
+    assert "On 2018-01-01 a DEED for $1,000.00 (100.00% transferred) was signed" in out
+    assert "  BLAP / 2 MAIN ST / APT 1 / NEW YORK / NY\n" in out
@@ -0,0 +1,165 @@
+from typing import Dict, List, Tuple
+
+import pytest
+
+import fun
+import geocoding
+import bbl_summary
+import portfolio_index
+from fun import BBLReport, ACRISDocument, ACRISParty
+from portfolio_index import Portfolio, PortfolioIndex
+from .helpers import FakeNamedCursor, make_feature
+
+
+# The parties of each ACRIS document and the BBLs it's about.
+ACRIS: Dict[str, Tuple[List[tuple], List[str]]] = {
+    'doc1': ([('BOOP LLC', '1 MAIN STREET', 'NEW YORK')], ['1000010001']),
+    'doc2': ([('Boop, L.L.C.', '1 Main St', 'New York'),
+              ('BANK', '2 WALL ST', 'NEW YORK')], ['1000010002', '1000010003']),
+    'doc3': ([('THE BLAP COMPANY', None, None)], ['1000010001']),
+}
+
+
+class FakePostingsCursor:
+    def __init__(self, conn: 'FakeACRISConnection'):
+        self.conn = conn
+        self._rows: list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params):
+        assert sql == portfolio_index.DOCUMENT_POSTINGS_SQL
+        self.conn.fetched.extend(params['documentids'])
+        self._rows = [
+            (documentid, name, address1, city, bbl)
+            for documentid in params['documentids']
+            for name, address1, city in self.conn.acris[documentid][0]
+            for bbl in self.conn.acris[documentid][1]
+        ]
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeACRISConnection:
+    def __init__(self, acris: Dict[str, Tuple[List[tuple], List[str]]]):
+        self.acris = acris
+        self.fetched: List[str] = []
+
+    def set_session(self, **kwargs):
+        pass
+
+    def cursor(self, name=None):
+        if name:
+            return FakeNamedCursor([(d,) for d in self.acris], ['documentid'])
+        return FakePostingsCursor(self)
+
+    def rollback(self):
+        pass
+
+
+def refresh_and_build(tmp_path, acris, **kwargs):
+    db = portfolio_index.open_postings(str(tmp_path / 'postings.db'))
+    conn = FakeACRISConnection(acris)
+    result = portfolio_index.refresh_postings(conn, db, chunk_size=2, **kwargs)
+    portfolio_index.build_portfolio_index(db, tmp_path / 'portfolio.idx')
+    return result, conn.fetched, PortfolioIndex(tmp_path / 'portfolio.idx')
+
+
+def boop(address1='1 MAIN ST', city='NEW YORK') -> ACRISParty:
+    return ACRISParty('doc9', 'BOOP LLC', address1, None, city, 'NY', 'US')
+
+
+def test_normalize_party_name():
+    assert portfolio_index.normalize_party_name('The Boop Company, L.L.C.') == 'BOOP CO LLC'
+    assert portfolio_index.normalize_party_name('  ') == ''
+
+
+def test_party_keys():
+    assert portfolio_index.party_keys('Boop Inc.', '1 Main Street', 'New York') == [
+        'name:BOOP INC', 'address:1 MAIN ST, NEW YORK']
+    assert portfolio_index.party_keys(None, None, None) == []
+
+
+def test_portfolio_index_finds_related_bbls(tmp_path):
+    result, fetched, index = refresh_and_build(tmp_path, ACRIS)
+    assert result == portfolio_index.RefreshResult(added=3, removed=0)
+    assert sorted(fetched) == ['doc1', 'doc2', 'doc3']
+
+    assert index.find([boop(), boop(city='BROOKLYN')]) == [
+        Portfolio('BOOP LLC', 'name', ['1000010001', '1000010002', '1000010003']),
+        Portfolio('1 MAIN ST, NEW YORK', 'address', ['1000010001', '1000010002', '1000010003']),
+        Portfolio('1 MAIN ST, BROOKLYN', 'address', []),
+    ]
+
+
+def test_portfolio_index_refreshes_incrementally(tmp_path):
+    refresh_and_build(tmp_path, ACRIS)
+    acris = {
+        'doc2': ACRIS['doc2'],
+        'doc3': ACRIS['doc3'],
+        'doc4': ([('BOOP LLC', None, None)], ['3000010001']),
+    }
+    result, fetched, index = refresh_and_build(tmp_path, acris)
+    assert result == portfolio_index.RefreshResult(added=1, removed=1)
+    assert fetched == ['doc4']
+    assert index.find([boop(address1=None)]) == [
+        Portfolio('BOOP LLC', 'name', ['1000010002', '1000010003', '3000010001']),
+    ]
+
+    result, fetched, _ = refresh_and_build(tmp_path, acris, full=True)
+    assert result == portfolio_index.RefreshResult(added=3, removed=0)
+    assert sorted(fetched) == ['doc2', 'doc3', 'doc4']
+
+
+def test_main_lists_portfolio(monkeypatch, capsys, tmp_path):
+    _, _, index = refresh_and_build(tmp_path, ACRIS)
+    index.close()
+    report = BBLReport(
+        bbl='1000010001', num_hpd_viols=0, num_dob_viols=0, hpd_viols=[], dob_viols=[],
+        plutos=[], docs=[ACRISDocument('doc1', None, None, 'DEED', None, None)],
+        parties={'doc1': [boop()]}
+    )
+    summaries_path = str(tmp_path / 'summaries.db')
+    bbl_summary.open_store(summaries_path, fun.REPORT_DATASETS).put(
+        report.bbl, fun.bbl_report_to_summary(report))
+    feature = make_feature(report.bbl, name='1 MAIN ST', postalcode='10004')
+
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street', '--portfolio'])
+    monkeypatch.setattr(geocoding, 'search', lambda text: [feature])
+    monkeypatch.delenv('GEOCODING_CACHE_DB', raising=False)
+    monkeypatch.setenv('BBL_SUMMARY_DB', summaries_path)
+    monkeypatch.setenv('PORTFOLIO_INDEX', str(tmp_path / 'portfolio.idx'))
+    fun.main()
+    out = capsys.readouterr().out
+    assert (
+        "The name BOOP LLC is associated with 2 other properties:\n"
+        "  * 1000010002\n"
+        "  * 1000010003\n"
+    ) in out
+    assert "The address 1 MAIN ST, NEW YORK is associated with 2 other properties:" in out
+
+
+def test_main_needs_portfolio_index(monkeypatch, capsys):
+    monkeypatch.setattr('sys.argv', ['fun.py', '1 main street', '--portfolio'])
+    monkeypatch.delenv('PORTFOLIO_INDEX', raising=False)
+    with pytest.raises(SystemExit):
+        fun.main()
+    assert "Please set PORTFOLIO_INDEX" in capsys.readouterr().out
+
+
+def test_print_portfolios_truncates_long_portfolios(capsys):
+    report = BBLReport('1000010001', 0, 0, [], [], [], [], {})
+    bbls = [f'10000100{i:02}' for i in range(1, 31)]
+    fun.print_portfolios(report, [Portfolio('BANK', 'name', bbls)], max_bbls=3)
+    assert capsys.readouterr().out == (
+        "The name BANK is associated with 29 other properties:\n"
+        "  * 1000010002\n"
+        "  * 1000010003\n"
+        "  * 1000010004\n"
+        "  ...and 26 more.\n"
+    )
@@ -0,0 +1,88 @@
+import json
+
+import requests
+
+import profiling
+from .helpers import FakeClock, FakeHTTPServer, FakeHTTPHandler
+
+
+@profiling.profiled('boop')
+def boop(value):
+    return value * 2
+
+
+def test_nothing_is_recorded_when_disabled():
+    profiling.disable()
+    assert boop(2) == 4
+    with profiling.stage('blah'):
+        pass
+    assert profiling.get_profiler() is None
+    assert profiling.connection_kwargs() == {}
+    session = profiling.instrument_session(requests.Session())
+    assert session.hooks['response'] == []
+
+
+def test_stages_are_recorded_and_summarized():
+    profiler = profiling.Profiler(clock=FakeClock(now=100.0, step=1.0))
+    profiling.enable(profiler)
+    try:
+        assert boop(2) == 4
+        assert boop(3) == 6
+        with profiling.stage('blah'):
+            with profiling.stage('inner'):
+                pass
+    finally:
+        profiling.disable()
+    assert [(e.kind, e.name, e.start, e.seconds) for e in profiler.events] == [
+        ('stage', 'boop', 1.0, 1.0),
+        ('stage', 'boop', 3.0, 1.0),
+        ('stage', 'inner', 6.0, 1.0),
+        ('stage', 'blah', 5.0, 3.0),
+    ]
+    assert [(r.name, r.calls, r.total_seconds) for r in profiler.summary()] == [
+        ('blah', 1, 3.0),
+        ('boop', 2, 2.0),
+        ('inner', 1, 1.0),
+    ]
+    assert profiling.connection_kwargs() == {}
+
+
+class FakeHandler(FakeHTTPHandler):
+    def do_GET(self):
+        body = b'hello there'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_http_requests_are_recorded(serve):
+    url = serve(FakeHTTPServer(FakeHandler)).url('/boop')
+    with profiling.profile(show_summary=False, json_path=None):
+        assert profiling.get_profiler() is None
+    profiler = profiling.enable()
+    try:
+        session = profiling.instrument_session(requests.Session())
+        session.get(f'{url}?q=1').raise_for_status()
+    finally:
+        profiling.disable()
+    [event] = profiler.events
+    assert event.kind == 'http'
+    assert event.name == f'GET {url}'
+    assert event.bytes == 11
+
+
+def test_profile_writes_summary_and_json(capsys, tmp_path):
+    path = tmp_path / 'trace.json'
+    with profiling.profile(show_summary=True, json_path=str(path)) as profiler:
+        assert profiling.get_profiler() is profiler
+        boop(1)
+    assert profiling.get_profiler() is None
+    assert 'boop' in capsys.readouterr().err
+    trace = json.loads(path.read_text())
+    assert [e['name'] for e in trace['events']] == ['boop']
+    assert trace['summary'][0]['calls'] == 1
+
+
+def test_statement_names_collapse_whitespace():
+    assert profiling._statement_name(b"SELECT *\n    FROM boop") == "SELECT * FROM boop"
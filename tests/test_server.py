@@ -0,0 +1,129 @@
+import datetime
+import threading
+from decimal import Decimal
+from typing import List
+
+import pytest
+
+import fun
+import loadtest
+import server
+from .helpers import FakeClock, make_feature
+
+
+def test_ttl_cache_expires_and_evicts_entries():
+    clock = FakeClock()
+    cache: server.TTLCache[int] = server.TTLCache(ttl=10, max_entries=2, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    clock.now = 11
+    assert cache.get('a') is None
+    assert cache.get('c') is None
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'entries': 0}
+
+
+def test_coalescer_shares_concurrent_calls():
+    coalescer: server.Coalescer[int] = server.Coalescer()
+    started = threading.Event()
+    release = threading.Event()
+    calls: List[int] = []
+    results: List[int] = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 5
+
+    leader = threading.Thread(target=lambda: results.append(coalescer.call('k', slow)))
+    leader.start()
+    started.wait()
+    followers = [
+        threading.Thread(target=lambda: results.append(coalescer.call('k', slow)))
+        for _ in range(3)
+    ]
+    for t in followers:
+        t.start()
+    while coalescer.coalesced < 3:
+        pass
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+    assert results == [5] * 4
+    assert len(calls) == 1
+
+    # Once the call is done, the next one for the key starts afresh.
+    assert coalescer.call('k', lambda: 6) == 6
+
+
+def test_coalescer_propagates_errors():
+    coalescer: server.Coalescer[int] = server.Coalescer()
+
+    def explode():
+        raise ValueError('kaboom')
+
+    with pytest.raises(ValueError):
+        coalescer.call('k', explode)
+    assert coalescer.call('k', lambda: 1) == 1
+
+
+FEATURE = make_feature()
+
+
+def make_report(bbl: str) -> fun.BBLReport:
+    return fun.BBLReport(
+        bbl=bbl,
+        num_hpd_viols=1,
+        num_dob_viols=0,
+        hpd_viols=[fun.HPDViolation(datetime.date(2018, 3, 1), 'NO HEAT')],
+        dob_viols=[],
+        plutos=[fun.PlutoInfo(bbl, Decimal('5.00'), 1920)],
+        docs=[],
+        parties={}
+    )
+
+
+@pytest.fixture
+def lookup_server(serve):
+    fetched: List[str] = []
+
+    def fetch_report(bbl):
+        fetched.append(bbl)
+        return make_report(bbl)
+
+    def geocode(address):
+        return None if address == 'nowhere' else [FEATURE]
+
+    service = server.LookupService(geocode, fetch_report)
+    httpd = serve(server.LookupServer(('127.0.0.1', 0), service))
+    httpd.fetched = fetched
+    return httpd
+
+
+def test_server_caches_reports(lookup_server):
+    url = f'http://127.0.0.1:{lookup_server.server_address[1]}'
+    result = loadtest.run_load_test(url, ['1 main st', 'nowhere'], num_requests=20,
+                                    concurrency=4)
+    assert len(result.results) == 20
+    assert result.errors == 10
+    assert lookup_server.fetched == ['1000010001']
+
+    session = loadtest._get_session()
+    res = session.get(f'{url}/bbl/1000010001')
+    assert res.json()['pluto'] == [{'bbl': '1000010001', 'numfloors': '5.00',
+                                    'yearbuilt': 1920}]
+    assert session.get(f'{url}/bbl/boop').status_code == 400
+    assert session.get(f'{url}/lookup').status_code == 400
+    assert session.get(f'{url}/stats').json()['entries'] == 1
+
+
+def test_percentile_works():
+    values = [float(i) for i in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 50.0
+    assert loadtest.percentile(values, 99) == 99.0
+    assert loadtest.percentile(values, 100) == 100.0
+    assert loadtest.percentile([3.0], 50) == 3.0
+    assert loadtest.percentile([], 50) == 0.0
@@ -0,0 +1,52 @@
+import pytest
+
+from sorted_index import SortedIndex, write_sorted_index, write_sorted_items
+
+
+def test_sorted_index_round_trips(tmp_path):
+    path = tmp_path / 'test.idx'
+    write_sorted_index(path, {
+        'B': [3, 1, 2, 1],
+        'A': [5],
+        'AB': [-1, 2 ** 40],
+        'É': [7],
+    })
+    index = SortedIndex(path)
+    assert len(index) == 4
+    assert index.get('A') == [5]
+    assert index.get('B') == [1, 2, 3]
+    assert index.get('AB') == [-1, 2 ** 40]
+    assert index.get('É') == [7]
+    assert index.get('C') == []
+    assert index.get('') == []
+    assert list(index.search_prefix('A')) == [('A', [5]), ('AB', [-1, 2 ** 40])]
+    assert list(index.search_prefix('A', limit=1)) == [('A', [5])]
+    assert list(index.search_prefix('Z')) == []
+    assert [key for key, _ in index.items()] == ['A', 'AB', 'B', 'É']
+    index.close()
+    assert not (tmp_path / 'test.idx.tmp').exists()
+
+
+def test_empty_sorted_index(tmp_path):
+    path = tmp_path / 'empty.idx'
+    write_sorted_index(path, {})
+    index = SortedIndex(path)
+    assert len(index) == 0
+    assert index.get('A') == []
+    assert list(index.items()) == []
+
+
+def test_sorted_index_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.idx'
+    path.write_bytes(b'not an index at all, really' * 2)
+    with pytest.raises(ValueError, match='not a sorted index'):
+        SortedIndex(path)
+
+
+def test_write_sorted_items_needs_sorted_keys(tmp_path):
+    with pytest.raises(ValueError, match='out of order'):
+        write_sorted_items(tmp_path / 'test.idx', [('B', [1]), ('A', [2])])
+    with pytest.raises(ValueError, match='out of order'):
+        write_sorted_items(tmp_path / 'test.idx', [('A', [1]), ('A', [2])])
+    assert write_sorted_items(tmp_path / 'test.idx', [('A', [2, 1]), ('B', [])]) == 2
+    assert SortedIndex(tmp_path / 'test.idx').get('A') == [1, 2]
@@ -0,0 +1,35 @@
+import sys
+import subprocess
+
+import pytest
+
+import benchmark
+
+
+# Dependencies that take a noticeable amount of time to import, and
+# that no entry point needs just to print its usage.
+HEAVY_MODULES = {'psycopg2', 'pydantic', 'requests', 'yaml', 'geocoding'}
+
+IMPORT_WITHOUT_MKDIR = '''
+import pathlib
+
+def mkdir(*args, **kwargs):
+    raise AssertionError("Importing created a directory")
+
+pathlib.Path.mkdir = mkdir
+import fun, introspect_schema, update_dataset_lastmod, server, nycdb_extract, address_index
+import portfolio_index
+'''
+
+
+@pytest.mark.parametrize('script', benchmark.STARTUP_SCRIPTS)
+def test_help_does_not_import_heavy_modules(script):
+    result = benchmark.measure_startup(script, repeat=1)
+    imported = {i.module.split('.')[0] for i in result.imports}
+    assert 'docopt' in imported
+    assert imported & HEAVY_MODULES == set()
+
+
+def test_importing_entry_points_does_not_create_directories():
+    subprocess.run([sys.executable, '-c', IMPORT_WITHOUT_MKDIR], cwd=benchmark.MY_DIR,
+                   check=True)
@@ -0,0 +1,98 @@
+import hashlib
+from pathlib import Path
+from typing import List
+
+import lastmod
+import downloader
+import update_dataset_lastmod as udl
+from dbhash import DictDbHash
+from .helpers import FakeHTTPServer, FakeHTTPHandler
+
+
+class FakeDatasetServer(FakeHTTPServer):
+    '''
+    A local stand-in for a dataset host. Every path has the ETag
+    "<path>-v1", except for paths starting with "/new", which
+    always have a new ETag.
+    '''
+
+    def __init__(self):
+        super().__init__(FakeDatasetHandler)
+        self.requests: List[str] = []
+
+
+class FakeDatasetHandler(FakeHTTPHandler):
+    server: FakeDatasetServer
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        etag = f'"{self.path}-v1"'
+        if self.path.startswith('/new'):
+            etag = f'"{self.path}-v{len(self.server.requests)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'some,csv,data\n'
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_check_files_reports_changed_and_unchanged_files(serve, capsys, tmp_path):
+    server = serve(FakeDatasetServer())
+    lm = lastmod.Lastmod(DictDbHash({}))
+    lm.set_info(lastmod.LastmodInfo(url=server.url('/old.csv'), etag='"/old.csv-v1"'))
+    (tmp_path / 'old.csv').write_text('some,old,data\n')
+    fileinfos = [
+        udl.FileInfo(url=server.url('/old.csv'), filename='old.csv'),
+        udl.FileInfo(url=server.url('/new.csv'), filename='new.csv'),
+        udl.FileInfo(url=server.url('/other.csv'), filename='other.csv'),
+    ]
+    results = udl.check_files(udl.create_session(2), lm, fileinfos, workers=2,
+                              download_dir=tmp_path)
+    udl.save_results(lm, results)
+    udl.print_summary(results, 1.0)
+
+    assert [r.status_code for r in results] == [304, 200, 200]
+    assert lm.get_info(server.url('/other.csv')) == lastmod.LastmodInfo(
+        url=server.url('/other.csv'),
+        etag='"/other.csv-v1"',
+        last_modified='Wed, 21 Oct 2015 07:28:00 GMT',
+        size=14,
+        sha256=hashlib.sha256(b'some,csv,data\n').hexdigest()
+    )
+    assert (tmp_path / 'other.csv').read_text() == 'some,csv,data\n'
+    assert (tmp_path / 'old.csv').read_text() == 'some,old,data\n'
+    assert 'Checked 3 files in 1.00s: 2 changed, 1 unchanged, 0 errors.' in \
+        capsys.readouterr().out
+
+    # Now that we've recorded all the etags, only the file that is
+    # always new should be changed.
+    results = udl.check_files(udl.create_session(2), lm, fileinfos, workers=2,
+                              download_dir=tmp_path)
+    assert [r.changed for r in results] == [False, True, False]
+
+
+def test_check_files_reports_errors(tmp_path):
+    lm = lastmod.Lastmod(DictDbHash({}))
+    fileinfos = [udl.FileInfo(url='http://127.0.0.1:1/nope.csv', filename='nope.csv')]
+    results = udl.check_files(udl.create_session(1), lm, fileinfos, workers=1,
+                              download_dir=tmp_path)
+    assert results[0].status_code is None
+    assert results[0].error
+    assert not results[0].changed
+
+
+def test_get_changed_datasets_works():
+    results = [
+        udl.CheckResult(udl.FileInfo('http://a', 'a.csv', 'acris'), 304, 0.1),
+        udl.CheckResult(udl.FileInfo('http://b', 'b.csv', 'pluto_18v1'), 200, 0.1,
+                        download=downloader.DownloadResult(Path('b.csv'), 1, 'x', None, None, False)),
+    ]
+    assert udl.get_changed_datasets(results) == {'pluto_18v1'}
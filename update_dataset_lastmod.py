@@ -1,49 +1,210 @@
+"""\
+Check which NYC-DB dataset files have changed since the last run.
+
+Usage:
+  update_dataset_lastmod.py [--workers=<n>] [--download-dir=<dir>]
+
+Options:
+  -h --help                 Show this screen.
+  --workers=<n>             Number of files to check concurrently [default: 8].
+  --download-dir=<dir>      Directory to download changed files into.
+                            Defaults to the "data" directory.
+
+Environment variables:
+  BBL_SUMMARY_DB            Optional path to the database of precomputed
+                            BBL reports built by fun.py. Reports built
+                            from any changed datasets are invalidated.
+"""
+
+import os
 import sqlite3
-from typing import Dict
-import requests
-import yaml
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set, TYPE_CHECKING
+import docopt
 
 import dbhash
 import lastmod
-import introspect_schema
+import bbl_summary
+import downloader
+import nycdb_data
+
+if TYPE_CHECKING:
+    import requests
+
+
+class FileInfo(NamedTuple):
+    url: str
+    filename: str
+
+    # The name of the NYC-DB dataset the file belongs to.
+    dataset: Optional[str] = None
+
+
+class CheckResult(NamedTuple):
+    fileinfo: FileInfo
+
+    # The HTTP status code of the response, or None if an error occurred.
+    status_code: Optional[int]
+
+    # How long the check took.
+    seconds: float
+
+    # The file's new lastmod info, if it changed.
+    lminfo: Optional[lastmod.LastmodInfo] = None
+
+    # Details about the file's new download, if it changed.
+    download: Optional[downloader.DownloadResult] = None
+
+    error: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return self.download is not None
+
+
+def get_fileinfos(datasets_yml) -> List[FileInfo]:
+    return [
+        FileInfo(url=fileinfo['url'], filename=fileinfo['dest'], dataset=name)
+        for name, dataset in datasets_yml.items()
+        for fileinfo in dataset['files']
+    ]
+
+
+def create_session(pool_size: int) -> 'requests.Session':
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def check_file(session: 'requests.Session', fileinfo: FileInfo,
+               lminfo: lastmod.LastmodInfo, download_dir: Path) -> CheckResult:
+    '''
+    Makes a conditional request for the given file to find out if
+    it has changed since its lastmod info was recorded, downloading
+    it if so.
+    '''
+
+    dest = download_dir / fileinfo.filename
+    headers: Dict[str, str] = {}
+    if dest.exists():
+        if lminfo.etag:
+            headers['If-None-Match'] = lminfo.etag
+        if lminfo.last_modified:
+            headers['If-Modified-Since'] = lminfo.last_modified
+    start = time.perf_counter()
+    try:
+        download = downloader.download(fileinfo.url, dest, session, headers)
+    except Exception as e:
+        return CheckResult(fileinfo, None, time.perf_counter() - start,
+                           error=f"{type(e).__name__}: {e}")
+    seconds = time.perf_counter() - start
+    if download is None:
+        return CheckResult(fileinfo, 304, seconds)
+    return CheckResult(
+        fileinfo,
+        206 if download.resumed else 200,
+        seconds,
+        lminfo=lastmod.LastmodInfo(
+            url=fileinfo.url,
+            etag=download.etag,
+            last_modified=download.last_modified,
+            size=download.size,
+            sha256=download.sha256
+        ),
+        download=download
+    )
+
+
+def check_files(session: 'requests.Session', lm: lastmod.Lastmod,
+                fileinfos: List[FileInfo], workers: int,
+                download_dir: Path) -> List[CheckResult]:
+    '''
+    Concurrently checks all the given files, downloading the ones
+    that changed, and returns the results in the same order.
+    '''
+
+    lminfos = lm.get_infos(fileinfo.url for fileinfo in fileinfos)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda fileinfo: check_file(session, fileinfo, lminfos[fileinfo.url],
+                                        download_dir),
+            fileinfos
+        ))
+
+
+def save_results(lm: lastmod.Lastmod, results: List[CheckResult]) -> None:
+    lm.set_infos(result.lminfo for result in results if result.lminfo is not None)
+
+
+def get_changed_datasets(results: List[CheckResult]) -> Set[str]:
+    return {
+        result.fileinfo.dataset for result in results
+        if result.changed and result.fileinfo.dataset is not None
+    }
+
+
+def print_result(result: CheckResult) -> None:
+    print(f"\nProcessed {result.fileinfo.filename} in {result.seconds:.2f}s.")
+    if result.error:
+        print(f"  Error fetching {result.fileinfo.url}: {result.error}")
+        return
+    print(f"  Got HTTP {result.status_code}.")
+    if result.download is not None:
+        resumed = " (resumed)" if result.download.resumed else ""
+        print(f"  Downloaded {result.download.size:,} bytes to "
+              f"{result.download.path}{resumed}.")
+        print(f"  sha256: {result.download.sha256}")
+    if result.lminfo is not None:
+        print(f"  Updating etag={result.lminfo.etag}, "
+              f"last_modified={result.lminfo.last_modified}.")
+
+
+def print_summary(results: List[CheckResult], seconds: float) -> None:
+    changed = [r for r in results if r.changed]
+    errors = [r for r in results if r.error]
+    unchanged = len(results) - len(changed) - len(errors)
+    slowest = max(results, key=lambda r: r.seconds, default=None)
+    print(f"\nChecked {len(results)} files in {seconds:.2f}s: "
+          f"{len(changed)} changed, {unchanged} unchanged, {len(errors)} errors.")
+    for result in changed:
+        print(f"  Changed: {result.fileinfo.filename}")
+    for result in errors:
+        print(f"  Error: {result.fileinfo.filename}")
+    if slowest is not None:
+        print(f"Slowest check was {slowest.fileinfo.filename} ({slowest.seconds:.2f}s).")
 
 
 def main():
-    datasets_yml = introspect_schema.download_datasets_yml()
+    args = docopt.docopt(__doc__)
+    workers = int(args['--workers'])
+    download_dir = Path(args['--download-dir'] or nycdb_data.DATA_DIR)
+
+    datasets_yml = nycdb_data.download_datasets_yml(refresh=True)
     conn = sqlite3.connect('dataset_lastmod_dbhash.db')
     storage = dbhash.SqlDbHash(conn, 'lastmod')
     lm = lastmod.Lastmod(storage)
-    print("Processing all dataset files.")
-    for dataset in datasets_yml.values():
-        for fileinfo in dataset['files']:
-            url = fileinfo['url']
-            filename = fileinfo['dest']
-
-            print(f"\nProcessing {filename}.")
-
-            lminfo = lm.get_info(url)
-            headers: Dict[str, str] = {}
-            if lminfo.etag:
-                print(f"  etag: {lminfo.etag}")
-                headers['If-None-Match'] = lminfo.etag
-            if lminfo.last_modified:
-                print(f"  last modified: {lminfo.last_modified}")
-                headers['If-Modified-Since'] = lminfo.last_modified
-            print(f"  Fetching from {url}...")
-            res = requests.get(url, headers=headers, stream=True)
-            print(f"  Got HTTP {res.status_code}.")
-            if res.status_code == 200:
-                print(f"\n  *** DOWNLOADING {filename} ***\n")
-                etag = res.headers.get('ETag')
-                last_modified = res.headers.get('Last-Modified')
-                lminfo = lastmod.LastmodInfo(
-                    url=url,
-                    etag=etag,
-                    last_modified=last_modified
-                )
-                print(f"  Updating etag={etag}, last_modified={last_modified}.")
-                lm.set_info(lminfo)
-            res.close()
+    fileinfos = get_fileinfos(datasets_yml)
+    print(f"Processing all {len(fileinfos)} dataset files.")
+    start = time.perf_counter()
+    results = check_files(create_session(workers), lm, fileinfos, workers, download_dir)
+    for result in results:
+        print_result(result)
+    save_results(lm, results)
+    print_summary(results, time.perf_counter() - start)
+
+    changed_datasets = get_changed_datasets(results)
+    summary_db = os.environ.get('BBL_SUMMARY_DB')
+    if summary_db and changed_datasets:
+        bbl_summary.invalidate_datasets(bbl_summary.open_dbhash(summary_db),
+                                        changed_datasets)
+        print(f"Invalidated BBL summaries built from: {', '.join(sorted(changed_datasets))}.")
 
 
 if __name__ == '__main__':